@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import traceback
+
+import markdown
+import simplejson as json
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+# Importing server also starts the delta trackers exported on /metrics
+from server import (
+    STREAM_KEEPALIVE_S,
+    admin_error,
+    encode_json,
+    parse_delta_analysis_args,
+    parse_profile_args,
+    parse_question_args,
+    parse_symbol_analysis_args,
+    question_max_age_s,
+    response_cache,
+    symbol_analysis_key,
+    tick_stream_format,
+)
+from sidd.binance.profiling import sample_profile
+from sidd.binance.cmdinterface import subscribe_delta_analysis
+from sidd.binance.connector.asyncclient import get_async_client
+from sidd.binance.connector.exchange import get_exchange
+
+# The same endpoints as server.py, served on asyncio. Market data for /symbol_analysis and /question is fetched with
+# aiohttp, so queries waiting on Binance don't hold a thread each and can't starve /health and /metrics. Run with
+# gunicorn's aiohttp worker:
+#
+#     gunicorn -b 0.0.0.0:8000 aioserver:app -w 1 -k aiohttp.GunicornWebWorker
+routes = web.RouteTableDef()
+
+
+@routes.get("/")
+async def index(request):
+    readme_file = open("README.md", "r")
+    md_template_string = markdown.markdown(
+        readme_file.read(), extensions=["fenced_code"]
+    )
+
+    return web.Response(text=md_template_string, content_type="text/html")
+
+
+@routes.get("/symbol_analysis")
+async def symbols(request):
+    args = parse_symbol_analysis_args(request.query)
+
+    async def compute_response():
+        return encode_json(await args.async_handler(args))
+
+    return _json_text_response(
+        await response_cache.get_async(
+            "symbol_analysis",
+            symbol_analysis_key(args),
+            compute_response,
+            args.max_age / 1000,
+        )
+    )
+
+
+@routes.get("/delta_analysis")
+async def delta_analysis(request):
+    args = parse_delta_analysis_args(request.query)
+    (mimetype, keepalive, format_tick) = tick_stream_format(
+        request.query, request.headers.get("Accept")
+    )
+    subscription = subscribe_delta_analysis(args)
+    loop = asyncio.get_event_loop()
+    published = asyncio.Event()
+    subscription.on_publish = lambda: loop.call_soon_threadsafe(published.set)
+    response = web.StreamResponse(headers={"Content-Type": mimetype})
+    try:
+        await response.prepare(request)
+        while True:
+            published.clear()
+            symbol_data_with_deltas = subscription.next_tick(0)
+            if subscription.closed:
+                return response
+            if symbol_data_with_deltas is not None:
+                await response.write(format_tick(symbol_data_with_deltas).encode())
+                continue
+            try:
+                await asyncio.wait_for(published.wait(), STREAM_KEEPALIVE_S)
+            except asyncio.TimeoutError:
+                await response.write(keepalive.encode())
+    except ConnectionResetError:
+        # The client went away
+        return response
+    finally:
+        # Runs once the client disconnects, dropping the tracker if nobody else uses it
+        subscription.on_publish = None
+        subscription.close()
+
+
+@routes.get(r"/question/{question:\d+}")
+async def questions(request):
+    question = int(request.match_info["question"])
+    args = parse_question_args(question)
+
+    async def compute_response():
+        return encode_json(await args.async_handler(args))
+
+    return _json_text_response(
+        await response_cache.get_async(
+            "question",
+            ("question", question),
+            compute_response,
+            question_max_age_s(question),
+        )
+    )
+
+
+@routes.get("/admin/profile")
+async def profile(request):
+    error = admin_error(request.headers.get("Authorization"))
+    if error is not None:
+        return _json_response(*error)
+    (duration_s, interval_s) = parse_profile_args(request.query)
+    # Sampled from another thread, so the event loop keeps serving (and shows up in) the profile
+    collapsed_stacks = await asyncio.get_event_loop().run_in_executor(
+        None, sample_profile, duration_s, interval_s
+    )
+    return web.Response(text=collapsed_stacks, content_type="text/plain")
+
+
+@routes.get("/health")
+async def health(request):
+    return web.Response(text="Looking good!")
+
+
+@routes.get("/metrics")
+async def metrics(request):
+    return web.Response(
+        body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST}
+    )
+
+
+# Same error responses as server.py
+@web.middleware
+async def handle_errors(request, handler):
+    try:
+        return await handler(request)
+    except web.HTTPException:
+        raise
+    except ValueError as e:
+        logging.error(traceback.format_exc())
+        return _json_response(
+            {"error_type": "ValueError", "message": str(e)}, status=400
+        )
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        return _json_response({"method": str(e)}, status=400)
+
+
+def _json_response(data, status=200):
+    return _json_text_response(json.dumps(data), status)
+
+
+def _json_text_response(text, status=200):
+    return web.Response(text=text, status=status, content_type="application/json")
+
+
+async def load_exchange(app):
+    # The first load blocks on exchange info, so it is done before taking requests rather than on the event loop
+    await asyncio.get_event_loop().run_in_executor(None, get_exchange)
+
+
+async def close_async_client(app):
+    await get_async_client().close()
+
+
+app = web.Application(middlewares=[handle_errors])
+app.add_routes(routes)
+app.on_startup.append(load_exchange)
+app.on_cleanup.append(close_async_client)
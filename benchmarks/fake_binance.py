@@ -0,0 +1,154 @@
+import argparse
+import json
+import random
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock
+from urllib.parse import parse_qs, urlparse
+
+QUOTE_ASSETS = ["USDT", "BTC", "ETH", "BNB"]
+# Weight limit advertised in exchange info. High enough that benchmarks measure our code rather than the rate limiter.
+RATE_LIMIT = 1000000
+# Serialized order books kept around, as building a 5000 level book takes longer than serving it
+MAX_CACHED_DEPTHS = 256
+
+
+# Stand-in for the Binance endpoints the analytics use (exchange info, 24 hour tickers and depth), with made up but
+# realistically sized data. Every response waits latency_s first, like a real round trip to Binance would.
+class FakeBinance:
+    def __init__(self, num_symbols=2000, latency_s=0, seed=1):
+        random.seed(seed)
+        num_base_assets = -(-num_symbols // len(QUOTE_ASSETS))
+        self.symbols = [
+            (f"A{base:04d}{quote}", f"A{base:04d}", quote)
+            for base in range(num_base_assets)
+            for quote in QUOTE_ASSETS
+        ][:num_symbols]
+        self.latency_s = latency_s
+        self.tickers = {}
+        for (symbol, _, _) in self.symbols:
+            bid_price = round(random.uniform(0.01, 1000), 2)
+            self.tickers[symbol] = {
+                "symbol": symbol,
+                "volume": f"{random.uniform(1, 1e7):.8f}",
+                "count": random.randint(1, 10**6),
+                "bidPrice": f"{bid_price:.8f}",
+                "askPrice": f"{bid_price + 0.01:.8f}",
+            }
+        self.exchange_info_body = json.dumps(
+            {
+                "rateLimits": [
+                    {
+                        "rateLimitType": "REQUEST_WEIGHT",
+                        "interval": "MINUTE",
+                        "intervalNum": 1,
+                        "limit": RATE_LIMIT,
+                    }
+                ],
+                "symbols": [
+                    {
+                        "symbol": symbol,
+                        "baseAsset": base_asset,
+                        "quoteAsset": quote_asset,
+                    }
+                    for (symbol, base_asset, quote_asset) in self.symbols
+                ],
+            }
+        ).encode()
+        self.tickers_body = json.dumps(list(self.tickers.values())).encode()
+        self._depths = OrderedDict()
+        self._depths_lock = Lock()
+
+    def depth(self, symbol, limit):
+        ticker = self.tickers[symbol]
+        bid_price = float(ticker["bidPrice"])
+        ask_price = float(ticker["askPrice"])
+        return {
+            "lastUpdateId": 1,
+            "bids": [
+                [
+                    f"{max(bid_price - level * 0.01, 0.00000001):.8f}",
+                    f"{1 + level % 7:.8f}",
+                ]
+                for level in range(limit)
+            ],
+            "asks": [
+                [f"{ask_price + level * 0.01:.8f}", f"{1 + level % 5:.8f}"]
+                for level in range(limit)
+            ],
+        }
+
+    def depth_body(self, symbol, limit):
+        key = (symbol, limit)
+        with self._depths_lock:
+            body = self._depths.get(key)
+            if body is not None:
+                self._depths.move_to_end(key)
+                return body
+        body = json.dumps(self.depth(symbol, limit)).encode()
+        with self._depths_lock:
+            self._depths[key] = body
+            while len(self._depths) > MAX_CACHED_DEPTHS:
+                self._depths.popitem(last=False)
+        return body
+
+    def serve(self, port=0):
+        fake_binance = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {
+                    key: values[0] for (key, values) in parse_qs(url.query).items()
+                }
+                if fake_binance.latency_s:
+                    time.sleep(fake_binance.latency_s)
+                if url.path == "/api/v3/exchangeInfo":
+                    body = fake_binance.exchange_info_body
+                elif url.path == "/api/v3/ticker/24hr" and "symbol" in query:
+                    body = json.dumps(fake_binance.tickers[query["symbol"]]).encode()
+                elif url.path == "/api/v3/ticker/24hr":
+                    body = fake_binance.tickers_body
+                elif url.path == "/api/v3/depth":
+                    body = fake_binance.depth_body(
+                        query["symbol"], int(query.get("limit", 100))
+                    )
+                else:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("x-mbx-used-weight", "1")
+                self.send_header("x-mbx-used-weight-1m", "1")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return _ThreadingHTTPServer(("127.0.0.1", port), Handler)
+
+
+# http.server.ThreadingHTTPServer, which is only in Python 3.7+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a fake Binance REST API.")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--symbols", type=int, default=2000)
+    parser.add_argument(
+        "--latency_ms", type=float, default=0, help="Delay before every response."
+    )
+    args = parser.parse_args()
+    server = FakeBinance(args.symbols, args.latency_ms / 1000).serve(args.port)
+    print(f"Serving a fake Binance on port {server.server_address[1]}.", flush=True)
+    server.serve_forever()
@@ -0,0 +1,299 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from decimal import Decimal
+from itertools import cycle, islice
+from statistics import mean
+
+from benchmarks.fake_binance import FakeBinance
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Distinct queries, so that the response cache doesn't answer them all from one computation
+SYMBOL_ANALYSIS_PATHS = [
+    f"/symbol_analysis?quote_assets={quote_asset}&order_by=trades[desc]&limit={limit}"
+    f"&fields=symbol,trades,spread,order_book_bid_total_value[100]"
+    for quote_asset in ["USDT", "BTC", "ETH", "BNB"]
+    for limit in [3, 4, 5]
+] + [
+    f"/symbol_analysis?quote_assets={quote_asset}&where=volume>{volume}&order_by=volume[desc]&limit=5"
+    f"&fields=symbol,volume,order_book_bid_value_within_bps[50],order_book_sell_vwap[10]"
+    for quote_asset in ["USDT", "BTC"]
+    for volume in [1000, 100000]
+]
+QUESTION_PATHS = [f"/question/{question}" for question in [1, 2, 3, 4]]
+
+
+# Runs every benchmark against a fake Binance in a separate process (so it doesn't compete with us for the GIL) and
+# returns the results
+def run_benchmarks(num_symbols, latency_ms, concurrencies, num_requests):
+    port = _free_port()
+    fake_binance_process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.fake_binance",
+            "--port",
+            str(port),
+            "--symbols",
+            str(num_symbols),
+            "--latency_ms",
+            str(latency_ms),
+        ],
+        cwd=ROOT_DIR,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        _wait_for_port(port)
+        # Read when the connector and server modules are imported
+        os.environ["BINANCE_API_URLS"] = f"http://127.0.0.1:{port}"
+        os.environ["BINANCE_TICKER_STREAMING"] = ""
+        os.environ["BINANCE_ORDER_BOOK_STREAMING"] = ""
+        os.environ["BINANCE_MAX_QUERY_WEIGHT"] = str(10**6)
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as no_delta_trackers:
+            # Background delta trackers would only add noise
+            json.dump([], no_delta_trackers)
+            no_delta_trackers.flush()
+            os.environ["DELTA_TRACKERS_FILE"] = no_delta_trackers.name
+            import server
+            from sidd.binance.responsecache import RESPONSE_CACHE_TTL_S, ResponseCache
+        # The server logs every request at debug level, raw responses included, which would dwarf everything else
+        logging.getLogger().setLevel(logging.WARNING)
+        results = {
+            "order_book_parse": benchmark_order_book_parse(),
+            "symbol_analysis_ordering": benchmark_symbol_analysis_ordering(),
+            "delta_tracker_tick": benchmark_delta_tracker_tick(),
+        }
+        # Uncached, every request runs its analysis. Cached, identical requests share responses for the server's
+        # default response cache TTL, or their max_age_ms if that's shorter. The symbol analyses here want fresh
+        # market data, so they only share responses with identical requests arriving together.
+        response_caches = [
+            ("uncached", _NoResponseCache()),
+            ("cached", ResponseCache(ttl_s=RESPONSE_CACHE_TTL_S)),
+        ]
+        for (name, paths) in [
+            ("symbol_analysis_endpoint", SYMBOL_ANALYSIS_PATHS),
+            ("question_endpoint", QUESTION_PATHS),
+        ]:
+            results[name] = {}
+            for (cache_name, response_cache) in response_caches:
+                server.response_cache = response_cache
+                results[name][cache_name] = [
+                    benchmark_endpoint(server.app, paths, concurrency, num_requests)
+                    for concurrency in concurrencies
+                ]
+        return results
+    finally:
+        fake_binance_process.terminate()
+        fake_binance_process.wait()
+
+
+# Latency and throughput of requests to the Flask app, cycling through paths, from concurrency threads at once
+def benchmark_endpoint(app, paths, concurrency, num_requests):
+    def timed_request(path):
+        start = time.perf_counter()
+        response = app.test_client().get(path)
+        return time.perf_counter() - start, response.status_code
+
+    # Fills the caches that don't expire (like the exchange index) before timing anything
+    for path in paths:
+        app.test_client().get(path)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        timings = list(executor.map(timed_request, islice(cycle(paths), num_requests)))
+    elapsed_s = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": num_requests,
+        "errors": len([status for (_, status) in timings if status != 200]),
+        "throughput_rps": num_requests / elapsed_s,
+        "latency_ms": _percentiles([latency * 1000 for (latency, _) in timings]),
+    }
+
+
+# Cost of parsing an order book and reading it. Levels are only decoded once read, so parsing alone would time next
+# to nothing: "full" reads the total value of every level, "top" that of the top read_levels levels only.
+def benchmark_order_book_parse(num_levels=5000, read_levels=200, repeat=50):
+    from sidd.binance.connector.orderbook import OrderBook
+
+    raw_depth = FakeBinance(num_symbols=1).depth("A0000USDT", num_levels)
+    results = {"levels_per_side": num_levels}
+    for (name, levels_read) in [("full", num_levels), ("top", read_levels)]:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            order_book = OrderBook.from_raw_input(
+                raw_depth, num_levels
+            ).with_num_levels(levels_read)
+            order_book.total_notional_value_of_bids()
+            order_book.total_notional_value_of_asks()
+        elapsed_s = time.perf_counter() - start
+        results[name] = {
+            "levels_read_per_side": levels_read,
+            "books_per_s": repeat / elapsed_s,
+            "levels_per_s": 2 * levels_read * repeat / elapsed_s,
+        }
+    return results
+
+
+# CPU cost of ordering every symbol by a ticker field, with tickers already cached
+def benchmark_symbol_analysis_ordering(repeat=50):
+    from sidd.binance.analytics import symbol_analysis
+    from sidd.binance.connector.exchange import get_exchange
+
+    num_symbols = len(get_exchange().symbols())
+    # Tickers fetched now are fresh enough for every run below
+    symbol_analysis(fields=["symbol", "volume"], max_age_ms=10**9)
+    results = {"symbols": num_symbols}
+    for (name, order_by) in [("unordered", None), ("ordered", "volume[desc]")]:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            symbol_analysis(
+                order_by=order_by,
+                limit=5,
+                fields=["symbol", "volume"],
+                max_age_ms=10**9,
+            )
+        results[f"{name}_ms"] = (time.perf_counter() - start) / repeat * 1000
+    results["ordering_us_per_symbol"] = (
+        (results["ordered_ms"] - results["unordered_ms"]) * 1000 / num_symbols
+    )
+    return results
+
+
+# Time DeltaTracker.update takes per tick, for increasingly many tracked symbols
+def benchmark_delta_tracker_tick(num_ticks=200):
+    from sidd.binance.analytics import DeltaTracker
+
+    results = []
+    for num_symbols in [5, 100, 2000]:
+        delta_tracker = DeltaTracker(["spread", "volume"])
+        ticks = [
+            [
+                {
+                    "symbol": f"A{symbol:04d}USDT",
+                    "spread": Decimal(tick % 7) / 100,
+                    "volume": Decimal(symbol * tick),
+                }
+                for symbol in range(num_symbols)
+            ]
+            for tick in range(num_ticks)
+        ]
+        start = time.perf_counter()
+        for rows in ticks:
+            delta_tracker.update(rows)
+        elapsed_s = time.perf_counter() - start
+        results.append(
+            {
+                "symbols": num_symbols,
+                "tick_ms": elapsed_s / num_ticks * 1000,
+                "us_per_symbol": elapsed_s / num_ticks / num_symbols * 1000000,
+            }
+        )
+    return results
+
+
+# Stands in for the server's response cache, computing every response
+class _NoResponseCache:
+    def get(self, endpoint, key, compute, max_ttl_s=None):
+        return compute()
+
+
+def _percentiles(values):
+    values = sorted(values)
+    return {
+        "mean": mean(values),
+        "p50": values[int(0.5 * (len(values) - 1))],
+        "p95": values[int(0.95 * (len(values) - 1))],
+        "p99": values[int(0.99 * (len(values) - 1))],
+        "max": values[-1],
+    }
+
+
+def _free_port():
+    with socket.socket() as free_socket:
+        free_socket.bind(("127.0.0.1", 0))
+        return free_socket.getsockname()[1]
+
+
+def _wait_for_port(port, timeout_s=30):
+    deadline = time.monotonic() + timeout_s
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def _git_revision():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the analytics against a local fake Binance."
+    )
+    parser.add_argument(
+        "--symbols", type=int, default=2000, help="Symbols the fake Binance lists."
+    )
+    parser.add_argument(
+        "--latency_ms",
+        type=float,
+        default=20,
+        help="Delay before every fake Binance response.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=str,
+        default="1,8,32",
+        help="Comma separated list. Numbers of concurrent clients to benchmark the endpoints with.",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=200,
+        help="Requests to each endpoint at each concurrency.",
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="File to write results to."
+    )
+    args = parser.parse_args()
+    concurrencies = [int(concurrency) for concurrency in args.concurrency.split(",")]
+    report = {
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "symbols": args.symbols,
+            "latency_ms": args.latency_ms,
+            "concurrency": concurrencies,
+            "requests": args.requests,
+        },
+        "results": run_benchmarks(
+            args.symbols, args.latency_ms, concurrencies, args.requests
+        ),
+    }
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(report_json)
+    print(report_json)
@@ -0,0 +1,45 @@
+import argparse
+import logging
+import os
+
+# The fetcher is what the shared cache is fetched into, so it talks to Binance itself
+SHARED_CACHE_DIR = os.environ.pop("BINANCE_SHARED_CACHE_DIR", None)
+# Port the fetcher exports its metrics on, including the delta trackers' gauges
+METRICS_PORT = int(os.environ.get("BINANCE_FETCHER_METRICS_PORT", 8001))
+
+from prometheus_client import start_http_server
+
+# Importing server also starts the delta trackers, which only the fetcher runs when workers share market data
+import server  # noqa: F401
+from sidd.binance.connector.sharedcache import MarketDataFetcher
+
+# Owns all Binance I/O for gunicorn workers sharing market data through BINANCE_SHARED_CACHE_DIR, publishing what they
+# ask for there. Started and stopped by gunicorn (gunicorn.conf.py), or on its own:
+#   BINANCE_SHARED_CACHE_DIR=/dev/shm/binance python fetcher.py
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fetch market data for workers sharing it"
+    )
+    parser.add_argument(
+        "--directory",
+        default=SHARED_CACHE_DIR,
+        required=SHARED_CACHE_DIR is None,
+        help="Directory to share market data through (default BINANCE_SHARED_CACHE_DIR)",
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=METRICS_PORT,
+        help="Port to export metrics on, 0 to not export them",
+    )
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.INFO)
+    if args.metrics_port:
+        start_http_server(args.metrics_port)
+    MarketDataFetcher(args.directory).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
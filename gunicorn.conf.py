@@ -0,0 +1,24 @@
+import os
+import subprocess
+import sys
+
+# When workers share market data (BINANCE_SHARED_CACHE_DIR), the fetcher they share it through is started before
+# them and stopped after them, so workers can be scaled to cores without multiplying API weight.
+SHARED_CACHE_DIR = os.environ.get("BINANCE_SHARED_CACHE_DIR")
+
+_fetcher = None
+
+
+def on_starting(server):
+    global _fetcher
+    if SHARED_CACHE_DIR:
+        server.log.info(f"Starting the market data fetcher for {SHARED_CACHE_DIR}")
+        _fetcher = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(__file__), "fetcher.py")]
+        )
+
+
+def on_exit(server):
+    if _fetcher is not None:
+        _fetcher.terminate()
+        _fetcher.wait()
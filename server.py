@@ -1,19 +1,67 @@
+import hmac
 import logging
+import os
+import re
 import threading
 import traceback
 
 import markdown
 import simplejson as json
-from flask import Flask, request
+from flask import Flask, Response, request
 from prometheus_client import Gauge, generate_latest
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
 
-from sidd.binance.analytics import get_delta_tracker
-from sidd.binance.cmdinterface import get_parser
+from sidd.binance.cmdinterface import (
+    QUESTION_ANALYSES,
+    get_parser,
+    subscribe_delta_analysis,
+    symbol_analysis_options,
+)
+from sidd.binance.connector.clientadapter import SHARED_CACHE_DIR
+from sidd.binance.profiling import sample_profile, stage_timer
+from sidd.binance.responsecache import ResponseCache
+from sidd.binance.tracking import get_tracking_engine
+
+# Most Binance API weight a single /symbol_analysis request may spend
+MAX_QUERY_WEIGHT = int(os.environ.get("BINANCE_MAX_QUERY_WEIGHT", 300))
+# Shortest interval a /delta_analysis stream may tick at
+MIN_DELTA_INTERVAL_MS = int(os.environ.get("MIN_DELTA_INTERVAL_MS", 1000))
+# Most /delta_analysis streams open at once. Each holds a server thread for as long as it's open, so this should stay
+# well below gunicorn's --threads, leaving threads for /health and queries. aioserver.py streams don't hold threads.
+MAX_DELTA_STREAMS = int(os.environ.get("MAX_DELTA_STREAMS", 4))
+# Seconds a /delta_analysis stream may go without sending anything, so proxies don't close it while waiting for a tick
+STREAM_KEEPALIVE_S = 15
+# Bearer token that admin endpoints (/admin/profile) require. Admin endpoints are disabled when it isn't set.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+# Delta trackers whose deltas are exported as Prometheus gauges, each named after its delta field (e.g. spread_delta).
+# A JSON list of tracker definitions in the file at DELTA_TRACKERS_FILE replaces these.
+DEFAULT_DELTA_TRACKERS = [
+    # Question 6 - how the spread changes for the top 5 most traded USDT securities
+    {
+        "name": "usdt_most_traded",
+        "quote_assets": ["USDT"],
+        "order_by": "trades[desc]",
+        "limit": 5,
+        "fields": ["symbol", "base_asset", "quote_asset", "trades", "spread"],
+        "delta_fields": ["spread"],
+        "interval_ms": 10000,
+    }
+]
+DELTA_TRACKERS_FILE = os.environ.get("DELTA_TRACKERS_FILE")
+
+# symbol_analysis options whose order doesn't change the response
+UNORDERED_OPTIONS = ["quote_assets", "base_assets", "where"]
 
 app = Flask(__name__)
-spread_delta_metric = Gauge(
-    "spread_delta", "Spread delta", ["symbol", "base_asset", "quote_asset"]
-)
+# Parsing doesn't change the parser, so requests share one
+parser = get_parser()
+response_cache = ResponseCache()
+delta_metrics = {}
+delta_metrics_lock = threading.Lock()
+delta_stream_slots = threading.BoundedSemaphore(MAX_DELTA_STREAMS)
+encode_json_stage = stage_timer("encode_json")
 
 gunicorn_error_logger = logging.getLogger("gunicorn.error")
 app.logger.handlers.extend(gunicorn_error_logger.handlers)
@@ -23,30 +71,96 @@ logging.basicConfig(
 )
 
 
-# Thread for answering question 6 - up to date prometheus metrics for most traded USDT quoted currencies. This metric
-# specifically tracks how the spread changes for the top 5 most traded USDT securities
-class USDTSpreadDeltaThread(threading.Thread):
+# Gauges exported for each delta field of a tracker on top of <field>_delta, by metric name suffix and the rolling
+# statistic they export
+ROLLING_STAT_METRICS = {
+    "ewma": "ewma",
+    "rolling_mean": "mean",
+    "rolling_std": "std",
+    "rolling_min": "min",
+    "rolling_max": "max",
+    "pct_change": "pct_change",
+}
+
+
+def get_delta_metric(delta_field, suffix="delta"):
+    metric_name = re.sub(r"\W+", "_", delta_field).strip("_") + f"_{suffix}"
+    with delta_metrics_lock:
+        if metric_name not in delta_metrics:
+            delta_metrics[metric_name] = Gauge(
+                metric_name,
+                f"{suffix.replace('_', ' ').capitalize()} of {delta_field}",
+                ["tracker", "symbol", "base_asset", "quote_asset"],
+            )
+        return delta_metrics[metric_name]
+
+
+# Keeps the gauges of one configured delta tracker up to date
+class DeltaMetricsThread(threading.Thread):
+    def __init__(self, tracker_definition):
+        super().__init__(daemon=True)
+        tracker_definition = dict(tracker_definition)
+        self.name = tracker_definition.pop("name")
+        # Gauges are labelled with the assets of each symbol
+        tracker_definition["fields"] = list(tracker_definition.get("fields", []))
+        for field in ["symbol", "base_asset", "quote_asset"]:
+            if field not in tracker_definition["fields"]:
+                tracker_definition["fields"].append(field)
+        self.tracker_definition = tracker_definition
+        # (metric, function reading its value from a row) pairs
+        self.metrics = []
+        for delta_field in tracker_definition["delta_fields"]:
+            self.metrics.append(
+                (
+                    get_delta_metric(delta_field),
+                    lambda symbol_data, delta_field=delta_field: symbol_data["deltas"][
+                        delta_field
+                    ],
+                )
+            )
+            for (suffix, stat) in ROLLING_STAT_METRICS.items():
+                self.metrics.append(
+                    (
+                        get_delta_metric(delta_field, suffix),
+                        lambda symbol_data, delta_field=delta_field, stat=stat: (
+                            symbol_data["stats"][delta_field] or {}
+                        ).get(stat),
+                    )
+                )
+
     def run(self):
-        delta_tracker = get_delta_tracker(
-            quote_assets=["USDT"],
-            order_by="trades[desc]",
-            limit=5,
-            fields=["symbol", "base_asset", "quote_asset", "trades", "spread"],
-            delta_fields=["spread"],
-            interval_ms=10000,
-        )
-        for symbol_data in delta_tracker.start():
-            symbol = symbol_data["symbol"]
-            base_asset = symbol_data["base_asset"]
-            quote_asset = symbol_data["quote_asset"]
-            spread = symbol_data["deltas"]["spread"]
-            if spread is not None:
-                spread_delta_metric.labels(
-                    symbol=symbol, base_asset=base_asset, quote_asset=quote_asset
-                ).set(spread)
+        subscription = get_tracking_engine().subscribe(**self.tracker_definition)
+        for symbol_data in subscription:
+            labels = [
+                self.name,
+                symbol_data["symbol"],
+                symbol_data["base_asset"],
+                symbol_data["quote_asset"],
+            ]
+            for (metric, value_function) in self.metrics:
+                if symbol_data["status"] == "left":
+                    try:
+                        metric.remove(*labels)
+                    except KeyError:
+                        # It left before it had a value for this metric
+                        pass
+                    continue
+                value = value_function(symbol_data)
+                if value is not None:
+                    metric.labels(*labels).set(value)
+
 
+def load_delta_trackers():
+    if not DELTA_TRACKERS_FILE:
+        return DEFAULT_DELTA_TRACKERS
+    with open(DELTA_TRACKERS_FILE, "r") as delta_trackers_file:
+        return json.load(delta_trackers_file)
 
-USDTSpreadDeltaThread().start()
+
+# Workers sharing market data leave the delta trackers to the fetcher (fetcher.py), which exports them once
+if not SHARED_CACHE_DIR:
+    for delta_tracker_definition in load_delta_trackers():
+        DeltaMetricsThread(delta_tracker_definition).start()
 
 
 @app.route("/")
@@ -61,12 +175,212 @@ def index():
 
 @app.route("/symbol_analysis")
 def symbols():
+    args = parse_symbol_analysis_args(request.args)
+    return response_cache.get(
+        "symbol_analysis",
+        symbol_analysis_key(args),
+        lambda: encode_json(args.handler(args)),
+        # Cached no longer than the market data it's built from may be old
+        args.max_age / 1000,
+    )
+
+
+# Streams the rows of every tick of a delta tracker, as server-sent events or newline delimited JSON. Clients asking
+# for the same delta analysis share one tracker, so they also see the same ticks.
+@app.route("/delta_analysis")
+def delta_analysis():
+    args = parse_delta_analysis_args(request.args)
+    (mimetype, keepalive, format_tick) = tick_stream_format(
+        request.args, request.headers.get("Accept")
+    )
+    if not delta_stream_slots.acquire(blocking=False):
+        return {
+            "error_type": "TooManyStreams",
+            "message": f"All {MAX_DELTA_STREAMS} delta analysis streams are taken, try again later.",
+        }, 503
+    try:
+        # Subscribed before the response starts, so that bad queries still get an error response
+        subscription = subscribe_delta_analysis(args)
+    except Exception:
+        delta_stream_slots.release()
+        raise
+
+    def stream():
+        while True:
+            symbol_data_with_deltas = subscription.next_tick(STREAM_KEEPALIVE_S)
+            if subscription.closed:
+                return
+            if symbol_data_with_deltas is None:
+                yield keepalive
+            else:
+                yield format_tick(symbol_data_with_deltas)
+
+    # Called once the client disconnects, even if the stream never started (e.g. HEAD requests), dropping the tracker
+    # if nobody else uses it
+    def close():
+        subscription.close()
+        delta_stream_slots.release()
+
+    response = Response(stream(), mimetype=mimetype)
+    response.call_on_close(close)
+    return response
+
+
+@app.route("/question/<int:question>")
+def questions(question):
+    args = parse_question_args(question)
+    return response_cache.get(
+        "question",
+        ("question", question),
+        lambda: encode_json(args.handler(args)),
+        question_max_age_s(question),
+    )
+
+
+# Samples the stack of every thread for a while, e.g. to see where a slow query spends its time, and returns how often
+# each stack was seen in collapsed stack format for flame graph tools
+@app.route("/admin/profile")
+def profile():
+    error = admin_error(request.headers.get("Authorization"))
+    if error is not None:
+        return error
+    (duration_s, interval_s) = parse_profile_args(request.args)
+    return Response(sample_profile(duration_s, interval_s), mimetype="text/plain")
+
+
+# Request parsing is shared with aioserver.py, which serves the same endpoints on asyncio. Query args can be any
+# mapping with a get method.
+def parse_symbol_analysis_args(query_args):
     command = ["symbol_analysis"]
-    raw_quote_assets = request.args.get("quote_assets")
-    raw_base_assets = request.args.get("base_assets")
-    raw_order_by = request.args.get("order_by")
-    raw_limit = request.args.get("limit", default=5)
-    raw_fields = request.args.get("fields")
+    command += _symbol_analysis_arguments(query_args)
+    raw_group_by = query_args.get("group_by")
+    raw_aggregates = query_args.get("aggregates")
+    if raw_group_by:
+        command += ["-g", raw_group_by]
+    if raw_aggregates:
+        command += ["-a", raw_aggregates]
+    return parser.parse_args(command)
+
+
+def parse_delta_analysis_args(query_args):
+    command = ["delta_analysis"]
+    command += _symbol_analysis_arguments(query_args)
+    raw_delta_fields = query_args.get("delta_fields")
+    raw_interval_ms = query_args.get("interval_ms")
+    raw_window = query_args.get("window")
+    if raw_delta_fields:
+        command += ["-d", raw_delta_fields]
+    if raw_interval_ms:
+        command += ["-i", raw_interval_ms]
+    if raw_window:
+        command += ["-n", raw_window]
+    args = parser.parse_args(command)
+    # Even if MIN_DELTA_INTERVAL_MS is set to 0, trackers can't tick without an interval
+    min_interval_ms = max(1, MIN_DELTA_INTERVAL_MS)
+    if args.interval < min_interval_ms:
+        raise ValueError(
+            f"The interval must be at least {min_interval_ms} milliseconds."
+        )
+    return args
+
+
+def parse_question_args(question):
+    command = ["binance_question"]
+    if question == 5:
+        raise ValueError(
+            "Question 5 never stops generating deltas, stream them from /delta_analysis instead."
+        )
+    command += [str(question)]
+    return parser.parse_args(command)
+
+
+# Answers are cached no longer than the market data they're built from may be old
+def question_max_age_s(question):
+    return QUESTION_ANALYSES[question].get("max_age_ms", 0) / 1000
+
+
+# Error response for requests to admin endpoints without the admin token, None if they have it
+def admin_error(raw_authorization):
+    if not ADMIN_TOKEN:
+        return {
+            "error_type": "NotFound",
+            "message": "Admin endpoints are disabled.",
+        }, 404
+    if not hmac.compare_digest(
+        (raw_authorization or "").encode(), f"Bearer {ADMIN_TOKEN}".encode()
+    ):
+        return {
+            "error_type": "Forbidden",
+            "message": "Wrong or missing admin token.",
+        }, 403
+    return None
+
+
+# Returns how long to profile for and how often to sample, in seconds
+def parse_profile_args(query_args):
+    raw_seconds = query_args.get("seconds", "10")
+    raw_interval_ms = query_args.get("interval_ms", "10")
+    try:
+        return float(raw_seconds), float(raw_interval_ms) / 1000
+    except ValueError:
+        raise ValueError("seconds and interval_ms must be numbers.")
+
+
+def encode_json(data):
+    with encode_json_stage.time():
+        return json.dumps(data)
+
+
+# Response cache key of a symbol analysis. Queries that only differ in the order of their assets or predicates, or
+# in whitespace, get the same key.
+def symbol_analysis_key(args):
+    key = ["symbol_analysis"]
+    for (name, value) in sorted(symbol_analysis_options(args).items()):
+        if isinstance(value, list):
+            if name == "where":
+                value = [re.sub(r"\s+", "", predicate) for predicate in value]
+            value = tuple(sorted(set(value)) if name in UNORDERED_OPTIONS else value)
+        key.append((name, value))
+    return tuple(key)
+
+
+# Returns the mimetype, keepalive message and tick formatter of a delta analysis stream, picked by the format query
+# arg or else the Accept header
+def tick_stream_format(query_args, raw_accept=None):
+    raw_format = query_args.get("format")
+    if raw_format:
+        if raw_format not in ["sse", "ndjson"]:
+            raise ValueError("The format must be sse or ndjson.")
+    elif (
+        parse_accept_header(raw_accept, MIMEAccept).best_match(
+            ["application/x-ndjson", "text/event-stream"]
+        )
+        == "text/event-stream"
+    ):
+        raw_format = "sse"
+    if raw_format == "sse":
+        return (
+            "text/event-stream",
+            ": keepalive\n\n",
+            lambda symbol_data_with_deltas: f"data: {json.dumps(symbol_data_with_deltas)}\n\n",
+        )
+    return (
+        "application/x-ndjson",
+        "\n",
+        lambda symbol_data_with_deltas: f"{json.dumps(symbol_data_with_deltas)}\n",
+    )
+
+
+# Command line arguments shared by /symbol_analysis and /delta_analysis
+def _symbol_analysis_arguments(query_args):
+    command = []
+    raw_quote_assets = query_args.get("quote_assets")
+    raw_base_assets = query_args.get("base_assets")
+    raw_order_by = query_args.get("order_by")
+    raw_limit = query_args.get("limit", 5)
+    raw_fields = query_args.get("fields")
+    raw_max_age_ms = query_args.get("max_age_ms")
+    raw_where = query_args.get("where")
     if raw_quote_assets:
         command += ["-q", raw_quote_assets]
     if raw_base_assets:
@@ -77,22 +391,12 @@ def symbols():
         command += ["-l", str(raw_limit)]
     if raw_fields:
         command += ["-f", raw_fields]
-    parser = get_parser()
-    args = parser.parse_args(command)
-    return json.dumps(args.handler(args))
-
-
-@app.route("/question/<int:question>")
-def questions(question):
-    command = ["binance_question"]
-    if question == 5:
-        raise ValueError(
-            "Any request with infinite generation is not supported at this time."
-        )
-    command += [str(question)]
-    parser = get_parser()
-    args = parser.parse_args(command)
-    return json.dumps(args.handler(args))
+    if raw_max_age_ms:
+        command += ["-m", raw_max_age_ms]
+    if raw_where:
+        command += ["-W", raw_where]
+    command += ["-w", str(MAX_QUERY_WEIGHT)]
+    return command
 
 
 @app.route("/health")
@@ -1,145 +1,822 @@
+import heapq
+import operator
 import re
-from copy import deepcopy
-from time import sleep
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+from statistics import median
+from time import monotonic
 from typing import Iterable, Optional
 
+from prometheus_client import Histogram
+
 from sidd.binance.connector.exchange import get_exchange
+from sidd.binance.connector.ratelimit import (
+    WeightAccount,
+    request_weight,
+    weight_account,
+)
+from sidd.binance.connector.snapshot import COLUMNS as SNAPSHOT_COLUMNS
+from sidd.binance.connector.staleness import StalenessBudget
+from sidd.binance.profiling import stage_timer
+from sidd.binance.rollingstats import WINDOW_SAMPLES, RollingWindow
+
+# Market data a field may need on top of the exchange index. Sources are paired with a parameter, e.g. the number of
+# order book levels for DEPTH_SOURCE
+TICKER_SOURCE = "ticker_24hr"
+DEPTH_SOURCE = "depth"
+# Order book levels read by fields that look at price bands and fill sizes rather than a number of levels. Bands
+# reaching past this many levels only count the levels within them. This matches the depth streamed order books are
+# kept to, so these fields are served from memory when order book streaming is on.
+BAND_NUM_LEVELS = 1000
+# Number of distinct (fields, order_by, where) query plans kept compiled
+QUERY_PLAN_CACHE_SIZE = 256
+
+delta_tick_lag_metric = Histogram(
+    "delta_tracker_tick_lag_seconds",
+    "How far behind schedule delta tracker ticks started",
+)
+delta_compute_time_metric = Histogram(
+    "delta_tracker_compute_seconds",
+    "Time delta tracker ticks spent running the analysis and computing deltas",
+)
+query_weight_metric = Histogram(
+    "symbol_analysis_weight",
+    "API weight each symbol analysis spent fetching market data it didn't have cached",
+    buckets=[0, 1, 5, 10, 40, 50, 100, 200, 300, 500, 1000, 2000, 5000],
+)
+# Stages of running a query plan once its market data is at hand. Reading a field whose market data isn't cached
+# also fetches it, so these can contain fetch_depth time.
+plan_stage = stage_timer("plan")
+filter_stage = stage_timer("filter")
+order_stage = stage_timer("order")
+read_fields_stage = stage_timer("read_fields")
+group_stage = stage_timer("group")
 
 # A field regex could take any number of matches. These regex's should be paired with a function that evaluates
-# these matches into another function that routes the field to a certain value in the Symbol data model. The tuples
-# below represent
-# (name, regex, function to value, can order by field?, can use for delta analysis?)
+# these matches into another function that routes the field to a certain value in the Symbol data model, given a
+# StalenessBudget for any cached market data it reads. The last function evaluates the matches into the list of
+# (source, parameter) market data the field reads, so that it can be fetched ahead of time. The tuples below represent
+# (name, regex, function to value, can order by field?, can use for delta analysis?, function to data sources)
 FIELD_FUNCTIONS = [
-    ("symbol", r"symbol", lambda matches: lambda symbol: symbol.symbol, False, False),
+    (
+        "symbol",
+        r"symbol",
+        lambda matches: lambda symbol, budget: symbol.symbol,
+        False,
+        False,
+        lambda matches: [],
+    ),
     (
         "base_asset",
         r"base_asset",
-        lambda matches: lambda symbol: symbol.base_asset,
-        True,
+        lambda matches: lambda symbol, budget: symbol.base_asset,
         True,
+        False,
+        lambda matches: [],
     ),
     (
         "quote_asset",
         r"quote_asset",
-        lambda matches: lambda symbol: symbol.quote_asset,
-        True,
+        lambda matches: lambda symbol, budget: symbol.quote_asset,
         True,
+        False,
+        lambda matches: [],
     ),
     (
         "volume",
         r"volume",
-        lambda matches: lambda symbol: symbol.ticker_24hr(bulk_request=True).volume,
+        lambda matches: lambda symbol, budget: symbol.ticker_24hr(
+            budget, bulk_request=True
+        ).volume,
         True,
         True,
+        lambda matches: [(TICKER_SOURCE, None)],
     ),
     (
         "trades",
         r"trades",
-        lambda matches: lambda symbol: symbol.ticker_24hr(bulk_request=True).trades,
+        lambda matches: lambda symbol, budget: symbol.ticker_24hr(
+            budget, bulk_request=True
+        ).trades,
         True,
         True,
+        lambda matches: [(TICKER_SOURCE, None)],
     ),
     (
         "bid_price",
         r"bid_price",
-        lambda matches: lambda symbol: symbol.ticker_24hr(bulk_request=True).bid_price,
+        lambda matches: lambda symbol, budget: symbol.ticker_24hr(
+            budget, bulk_request=True
+        ).bid_price,
         True,
         True,
+        lambda matches: [(TICKER_SOURCE, None)],
     ),
     (
         "ask_price",
         r"ask_price",
-        lambda matches: lambda symbol: symbol.ticker_24hr(bulk_request=True).ask_price,
+        lambda matches: lambda symbol, budget: symbol.ticker_24hr(
+            budget, bulk_request=True
+        ).ask_price,
         True,
         True,
+        lambda matches: [(TICKER_SOURCE, None)],
     ),
     (
         "spread",
         r"spread",
-        lambda matches: lambda symbol: symbol.ticker_24hr(bulk_request=True).spread,
+        lambda matches: lambda symbol, budget: symbol.ticker_24hr(
+            budget, bulk_request=True
+        ).spread,
         True,
         True,
+        lambda matches: [(TICKER_SOURCE, None)],
     ),
     (
         "order_book_bid_total_value[<number of levels>]",
         r"order_book_bid_total_value\[(\d+)\]",
-        lambda matches: lambda symbol: symbol.depth(
-            num_levels=int(matches[0])
+        lambda matches: lambda symbol, budget: symbol.depth(
+            num_levels=int(matches[0]), budget=budget
         ).total_notional_value_of_bids(),
         False,
         True,
+        lambda matches: [(DEPTH_SOURCE, int(matches[0]))],
     ),
     (
         "order_book_ask_total_value[<number of levels>]",
         r"order_book_ask_total_value\[(\d+)\]",
-        lambda matches: lambda symbol: symbol.depth(
-            num_levels=int(matches[0])
+        lambda matches: lambda symbol, budget: symbol.depth(
+            num_levels=int(matches[0]), budget=budget
         ).total_notional_value_of_asks(),
         False,
         True,
+        lambda matches: [(DEPTH_SOURCE, int(matches[0]))],
+    ),
+    (
+        "order_book_bid_value_within_bps[<basis points from mid>]",
+        r"order_book_bid_value_within_bps\[(\d+(?:\.\d+)?)\]",
+        lambda matches: lambda symbol, budget: symbol.depth(
+            num_levels=BAND_NUM_LEVELS, budget=budget
+        ).notional_value_of_bids_within_bps(matches[0]),
+        False,
+        True,
+        lambda matches: [(DEPTH_SOURCE, BAND_NUM_LEVELS)],
+    ),
+    (
+        "order_book_ask_value_within_bps[<basis points from mid>]",
+        r"order_book_ask_value_within_bps\[(\d+(?:\.\d+)?)\]",
+        lambda matches: lambda symbol, budget: symbol.depth(
+            num_levels=BAND_NUM_LEVELS, budget=budget
+        ).notional_value_of_asks_within_bps(matches[0]),
+        False,
+        True,
+        lambda matches: [(DEPTH_SOURCE, BAND_NUM_LEVELS)],
+    ),
+    (
+        "order_book_bid_quantity_to_move[<percent>]",
+        r"order_book_bid_quantity_to_move\[(\d+(?:\.\d+)?)\]",
+        lambda matches: lambda symbol, budget: symbol.depth(
+            num_levels=BAND_NUM_LEVELS, budget=budget
+        ).quantity_to_move_bids(matches[0]),
+        False,
+        True,
+        lambda matches: [(DEPTH_SOURCE, BAND_NUM_LEVELS)],
+    ),
+    (
+        "order_book_ask_quantity_to_move[<percent>]",
+        r"order_book_ask_quantity_to_move\[(\d+(?:\.\d+)?)\]",
+        lambda matches: lambda symbol, budget: symbol.depth(
+            num_levels=BAND_NUM_LEVELS, budget=budget
+        ).quantity_to_move_asks(matches[0]),
+        False,
+        True,
+        lambda matches: [(DEPTH_SOURCE, BAND_NUM_LEVELS)],
+    ),
+    (
+        "order_book_sell_vwap[<quantity>]",
+        r"order_book_sell_vwap\[(\d+(?:\.\d+)?)\]",
+        lambda matches: lambda symbol, budget: symbol.depth(
+            num_levels=BAND_NUM_LEVELS, budget=budget
+        ).vwap_to_sell(matches[0]),
+        False,
+        False,
+        lambda matches: [(DEPTH_SOURCE, BAND_NUM_LEVELS)],
+    ),
+    (
+        "order_book_buy_vwap[<quantity>]",
+        r"order_book_buy_vwap\[(\d+(?:\.\d+)?)\]",
+        lambda matches: lambda symbol, budget: symbol.depth(
+            num_levels=BAND_NUM_LEVELS, budget=budget
+        ).vwap_to_buy(matches[0]),
+        False,
+        False,
+        lambda matches: [(DEPTH_SOURCE, BAND_NUM_LEVELS)],
     ),
 ]
 
 # An order regex starts with a field as defined by FIELD_FUNCTIONS and can end in [asc] or [desc] for
 # ascending or descending order. The regex's should be paired with a function that evaluates the matches
-# (the field from from the regex) into a tuple of the key symbols should be sorted by and whether the sort
+# (the field from from the regex) into a tuple of the field symbols should be sorted by and whether the sort
 # should be reversed (it is ascending order, by default).
 ORDER_FUNCTIONS = [
-    (r"^(.*)\[asc\]$", lambda matches: (_get_field_function(matches[0]), False)),
-    (r"^(.*)\[desc\]$", lambda matches: (_get_field_function(matches[0]), True)),
-    (r"^(.*)$", lambda matches: (_get_field_function(matches[0]), False)),
+    (r"^(.*)\[asc\]$", lambda matches: (matches[0], False)),
+    (r"^(.*)\[desc\]$", lambda matches: (matches[0], True)),
+    (r"^(.*)$", lambda matches: (matches[0], False)),
+]
+
+_COMPILED_FIELD_FUNCTIONS = [
+    (name, re.compile(regex), function, can_order, can_delta, sources)
+    for (name, regex, function, can_order, can_delta, sources) in FIELD_FUNCTIONS
+]
+_COMPILED_ORDER_FUNCTIONS = [
+    (re.compile(regex), function) for (regex, function) in ORDER_FUNCTIONS
 ]
 
+# A where predicate is a field as defined by FIELD_FUNCTIONS, a comparison and a number (e.g. "volume>1000000").
+# Symbols whose value for the field doesn't compare that way to the number are left out of the analysis.
+PREDICATE_REGEX = re.compile(r"^(.+?)\s*(<=|>=|!=|=|<|>)\s*(-?[\d.]+)$")
+PREDICATE_OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "=": operator.eq,
+    "!=": operator.ne,
+}
 
+# Fields symbols can be grouped by, and functions that aggregate the (non-missing) values of a field over each group.
+# Aggregates are written as a function of a field (e.g. "median(spread)"), or as a bare "count" of the symbols.
+GROUP_BY_FIELDS = ["base_asset", "quote_asset"]
+AGGREGATE_FUNCTIONS = {
+    "sum": sum,
+    "mean": lambda values: sum(values) / len(values) if values else None,
+    "median": lambda values: median(values) if values else None,
+    "min": lambda values: min(values) if values else None,
+    "max": lambda values: max(values) if values else None,
+    "count": len,
+}
+# Fields whose values aren't numbers, which can only be counted
+NON_NUMERIC_FIELDS = ["symbol", "base_asset", "quote_asset"]
+AGGREGATE_REGEX = re.compile(rf"^({'|'.join(AGGREGATE_FUNCTIONS)})\((.+)\)$")
+
+
+# Ticks every interval_s on the monotonic clock, measured from the first tick rather than from whenever the previous
+# tick finished, so time spent fetching doesn't push later ticks back. Ticks that were missed entirely are skipped
+# instead of being run back to back.
+class MonotonicSchedule:
+    def __init__(self, interval_s):
+        if interval_s <= 0:
+            raise ValueError(
+                f"Schedules must tick at a positive interval, but were given {interval_s} seconds."
+            )
+        self.interval_s = interval_s
+        self.next_tick_at = None
+
+    def time_until_next_tick(self):
+        now = monotonic()
+        if self.next_tick_at is None:
+            self.next_tick_at = now
+        else:
+            self.next_tick_at += self.interval_s
+            if self.next_tick_at < now - self.interval_s:
+                missed_ticks = (now - self.next_tick_at) // self.interval_s
+                self.next_tick_at += missed_ticks * self.interval_s
+        return max(0, self.next_tick_at - now)
+
+    # How far behind schedule the current tick started
+    def lag(self):
+        return max(0, monotonic() - self.next_tick_at)
+
+
+# Deltas of the analyses a tracker runs every tick (see tracking.TrackingEngine, which schedules the ticks)
 class DeltaTracker:
-    def __init__(self, analysis_function, delta_fields, interval_ms):
-        self.analysis_function = analysis_function
+    def __init__(self, delta_fields, window=WINDOW_SAMPLES):
         self.delta_fields = delta_fields
-        self.interval_s = interval_ms / 1000
+        self.window = window
         self.current_values = {}
-        self.keep_running = True
+        # Rolling windows of each delta field, for each symbol currently in the analysis
+        self.rolling_windows = {}
 
-    def start(self):
-        while self.keep_running:
-            current_symbol_analysis = self.analysis_function()
-            for symbol_data in current_symbol_analysis:
-                symbol = symbol_data["symbol"]
+    # Returns every symbol of a new analysis with a "deltas" dict of how much each delta field moved since the last
+    # tick (None for symbols that just entered), a "stats" dict of rolling statistics over each delta field's last
+    # `window` ticks (see RollingWindow.stats), and a "status" of "entered" or "stayed". Symbols that dropped out of
+    # the analysis follow once more with their last values and a "status" of "left".
+    def update(self, current_symbol_analysis):
+        previous_values = self.current_values
+        current_values = {}
+        symbol_data_with_deltas = []
+        for symbol_data in current_symbol_analysis:
+            symbol = symbol_data["symbol"]
+            current_values[symbol] = symbol_data
+            previous_symbol_data = previous_values.get(symbol)
+            if previous_symbol_data is None:
+                deltas = dict.fromkeys(self.delta_fields)
+                status = "entered"
+                self.rolling_windows[symbol] = {
+                    delta_field: RollingWindow(self.window)
+                    for delta_field in self.delta_fields
+                }
+            else:
                 deltas = {
-                    delta_field: abs(
-                        symbol_data[delta_field]
-                        - self.current_values[symbol][delta_field]
+                    delta_field: _delta(
+                        symbol_data[delta_field], previous_symbol_data[delta_field]
                     )
-                    if symbol in self.current_values
-                    else None
                     for delta_field in self.delta_fields
                 }
-                symbol_data_with_delta = deepcopy(symbol_data)
-                symbol_data_with_delta["deltas"] = deltas
-                yield symbol_data_with_delta
-            self.current_values = {
-                symbol_data["symbol"]: symbol_data
-                for symbol_data in current_symbol_analysis
-            }
-            sleep(self.interval_s)
-
-    def stop(self):
-        self.keep_running = False
-
-
-def _get_field_function(field):
-    for (_, possible_field, function, _, _) in FIELD_FUNCTIONS:
-        matcher = re.compile(possible_field)
+                status = "stayed"
+            stats = {}
+            for (delta_field, rolling_window) in self.rolling_windows[symbol].items():
+                if symbol_data[delta_field] is not None:
+                    rolling_window.add(symbol_data[delta_field])
+                stats[delta_field] = rolling_window.stats()
+            # Rows only hold immutable values, so a shallow copy is enough to not touch the analysis' own rows
+            symbol_data_with_deltas.append(
+                {**symbol_data, "deltas": deltas, "stats": stats, "status": status}
+            )
+        for (symbol, previous_symbol_data) in previous_values.items():
+            if symbol not in current_values:
+                rolling_windows = self.rolling_windows.pop(symbol)
+                symbol_data_with_deltas.append(
+                    {
+                        **previous_symbol_data,
+                        "deltas": dict.fromkeys(self.delta_fields),
+                        "stats": {
+                            delta_field: rolling_window.stats()
+                            for (delta_field, rolling_window) in rolling_windows.items()
+                        },
+                        "status": "left",
+                    }
+                )
+        self.current_values = current_values
+        return symbol_data_with_deltas
+
+
+def _delta(value, previous_value):
+    if value is None or previous_value is None:
+        return None
+    return abs(value - previous_value)
+
+
+# Everything symbol_analysis needs to know about a (fields, order_by, where) query, worked out once. Fields are
+# resolved to their accessors and the market data they read, so that evaluating the query is a loop over symbols and
+# accessors. Queries reading tickers are evaluated against the exchange's columnar market snapshot wherever a field is
+# one of its columns.
+class QueryPlan:
+    def __init__(self, fields, order_by=None, where=()):
+        self.fields = list(fields)
+        self.field_functions = [
+            (field, *_compile_field(field)) for field in self.fields
+        ]
+        self.field_sources = {
+            source for field in self.fields for source in _compile_field(field)[1]
+        }
+        if order_by:
+            (self.order_field, self.reverse) = _get_order(order_by)
+            (self.order_function, self.order_sources) = _compile_field(self.order_field)
+            if not _can_order(self.order_field):
+                possible_orders = [
+                    name
+                    for (name, _, _, can_order, _, _) in FIELD_FUNCTIONS
+                    if can_order
+                ]
+                raise ValueError(
+                    f'Symbols can\'t be ordered by "{self.order_field}". Must be one of {possible_orders}'
+                )
+        else:
+            (self.order_field, self.order_function, self.order_sources) = (
+                None,
+                None,
+                [],
+            )
+            self.reverse = False
+        self.predicates = [_compile_predicate(predicate) for predicate in where]
+        self.predicate_sources = {
+            source for (_, _, _, _, sources) in self.predicates for source in sources
+        }
+
+    # Upper bound on the API weight running this plan over the given number of symbols spends, assuming nothing is
+    # cached. Tickers are always fetched in bulk and the exchange index is refreshed in the background.
+    def expected_weight(self, num_symbols, limit):
+        num_shown_symbols = min(num_symbols, limit)
+        all_symbol_sources = set(self.order_sources) | self.predicate_sources
+        reads_tickers = (num_symbols and _reads_tickers(all_symbol_sources)) or (
+            num_shown_symbols and _reads_tickers(self.field_sources)
+        )
+        return (
+            (request_weight("/api/v3/ticker/24hr") if reads_tickers else 0)
+            + num_symbols * _depth_weight_of_sources(all_symbol_sources)
+            + num_shown_symbols * _depth_weight_of_sources(self.field_sources)
+        )
+
+    def execute(self, binance, symbols, limit, budget):
+        # Also makes sure every ticker satisfies the budget, with at most one bulk request
+        snapshot = binance.market_snapshot(budget) if self._reads_tickers() else None
+        columns = _SymbolColumns(symbols, budget, snapshot, binance.order_book_service)
+        columns.load(
+            self._with_first_predicate(self._order_reads()), range(len(symbols))
+        )
+        rows = self._select(columns, len(symbols), limit)
+        return self._project(columns, rows)
+
+    # Same as execute, but market data is fetched without blocking the event loop. Fields that where predicates or
+    # the order read are loaded for every symbol up front, rather than just for those left after filtering.
+    async def execute_async(self, binance, symbols, limit, budget, account=None):
+        snapshot = (
+            await binance.market_snapshot_async(budget, account)
+            if self._reads_tickers()
+            else None
+        )
+        columns = _SymbolColumns(symbols, budget, snapshot, binance.order_book_service)
+        await columns.load_async(
+            self._predicate_reads() + self._order_reads(), range(len(symbols)), account
+        )
+        rows = self._select(columns, len(symbols), limit)
+        await columns.load_async(self.field_functions, rows, account)
+        return self._project(columns, rows)
+
+    # The (field, accessor, sources) reads of the where predicates and of the order, for loading ahead of time
+    def _predicate_reads(self):
+        return [
+            (field, function, sources)
+            for (field, function, _, _, sources) in self.predicates
+        ]
+
+    def _order_reads(self):
+        if not self.order_function:
+            return []
+        return [(self.order_field, self.order_function, self.order_sources)]
+
+    # The first where predicate reads its order books for every symbol, so other fields reading no deeper books are
+    # loaded along with it, for every symbol, rather than fetching those books again once it has filtered them
+    def _with_first_predicate(self, field_reads):
+        if not self.predicates:
+            return []
+        (first_read, *other_predicate_reads) = self._predicate_reads()
+        num_levels = _max_depth_levels(first_read[2])
+        if not num_levels:
+            return []
+        return [first_read] + [
+            (field, function, sources)
+            for (field, function, sources) in other_predicate_reads + field_reads
+            if (_max_depth_levels(sources) or 0) <= num_levels
+        ]
+
+    def _reads_tickers(self):
+        return _reads_tickers(
+            set(self.order_sources) | self.predicate_sources | self.field_sources
+        )
+
+    # Rows of the symbols to output, in order
+    def _select(self, columns, num_symbols, limit):
+        rows = self._filter(columns, range(num_symbols))
+        if self.order_function:
+            with order_stage.time():
+                keys = dict(
+                    zip(
+                        rows,
+                        columns.read(
+                            self.order_field,
+                            self.order_function,
+                            rows,
+                            self.order_sources,
+                        ),
+                    )
+                )
+                # Same order as sorting and slicing, but only the top of the list is kept sorted. Symbols without
+                # a value to order by go last.
+                select = heapq.nlargest if self.reverse else heapq.nsmallest
+                rows = select(
+                    limit,
+                    [row for row in rows if keys[row] is not None],
+                    key=keys.__getitem__,
+                ) + [row for row in rows if keys[row] is None]
+        return rows[:limit]
+
+    def _project(self, columns, rows):
+        with read_fields_stage.time():
+            field_columns = [
+                (field, columns.read(field, function, rows, sources))
+                for (field, function, sources) in self.field_functions
+            ]
+            return [
+                {field: column[position] for (field, column) in field_columns}
+                for position in range(len(rows))
+            ]
+
+    # Rows of the symbols satisfying every where predicate
+    def _filter(self, columns, rows):
+        if not self.predicates:
+            return rows
+        with filter_stage.time():
+            for (field, function, compare, value, sources) in self.predicates:
+                # Only for the rows earlier predicates left
+                rows = [
+                    row
+                    for (row, row_value) in zip(
+                        rows, columns.read(field, function, rows, sources)
+                    )
+                    if row_value is not None and compare(row_value, value)
+                ]
+            return rows
+
+
+# A query that groups symbols by base or quote asset and outputs aggregates of their fields for each group, rather than
+# fields of each symbol. Groups can be ordered by the asset or any aggregate, e.g. "sum(volume)[desc]".
+class GroupedQueryPlan(QueryPlan):
+    def __init__(self, group_by, aggregates, order_by=None, where=()):
+        super().__init__([], None, where)
+        if group_by not in GROUP_BY_FIELDS:
+            raise ValueError(
+                f'"{group_by}" is not a valid group. Must be one of {GROUP_BY_FIELDS}'
+            )
+        self.group_by = group_by
+        self.aggregates = [_compile_aggregate(aggregate) for aggregate in aggregates]
+        self.aggregate_sources = {
+            source for (_, _, _, _, sources) in self.aggregates for source in sources
+        }
+        self.group_order = _get_order(order_by) if order_by else (group_by, False)
+        possible_orders = [group_by] + [name for (name, _, _, _, _) in self.aggregates]
+        if self.group_order[0] not in possible_orders:
+            raise ValueError(
+                f'Groups can\'t be ordered by "{self.group_order[0]}". Must be one of {possible_orders}'
+            )
+
+    # Every symbol is aggregated, so any market data aggregates read is needed for all of them
+    def expected_weight(self, num_symbols, limit):
+        all_symbol_sources = self.aggregate_sources | self.predicate_sources
+        reads_tickers = num_symbols and _reads_tickers(all_symbol_sources)
+        return (request_weight("/api/v3/ticker/24hr") if reads_tickers else 0) + (
+            num_symbols * _depth_weight_of_sources(all_symbol_sources)
+        )
+
+    def execute(self, binance, symbols, limit, budget):
+        all_symbol_sources = self.aggregate_sources | self.predicate_sources
+        snapshot = (
+            binance.market_snapshot(budget)
+            if _reads_tickers(all_symbol_sources)
+            else None
+        )
+        columns = _SymbolColumns(symbols, budget, snapshot, binance.order_book_service)
+        columns.load(
+            self._with_first_predicate(self._aggregate_reads()), range(len(symbols))
+        )
+        return self._aggregate(binance, symbols, limit, columns)
+
+    def _aggregate(self, binance, symbols, limit, columns):
+        rows = self._filter(columns, range(len(symbols)))
+        # Each field is read once for every symbol, no matter how many aggregates use it
+        field_values = {}
+        with read_fields_stage.time():
+            for (_, field, function, _, sources) in self.aggregates:
+                if field is not None and field not in field_values:
+                    field_values[field] = dict(
+                        zip(rows, columns.read(field, function, rows, sources))
+                    )
+        with group_stage.time():
+            return self._group(binance, symbols, rows, field_values, limit)
+
+    def _aggregate_reads(self):
+        return [
+            (field, function, sources)
+            for (_, field, function, _, sources) in self.aggregates
+            if field is not None
+        ]
+
+    # The aggregates of each asset's rows, in order
+    def _group(self, binance, symbols, rows, field_values, limit):
+        symbol_rows = {symbols[row].symbol: row for row in rows}
+        groups = []
+        for (asset, asset_symbols) in binance.symbols_by_asset(self.group_by).items():
+            group_rows = [
+                symbol_rows[symbol_data.symbol]
+                for symbol_data in asset_symbols
+                if symbol_data.symbol in symbol_rows
+            ]
+            if not group_rows:
+                continue
+            group = {self.group_by: asset}
+            for (name, field, _, aggregate_function, _) in self.aggregates:
+                values = (
+                    group_rows
+                    if field is None
+                    else [
+                        field_values[field][row]
+                        for row in group_rows
+                        if field_values[field][row] is not None
+                    ]
+                )
+                group[name] = aggregate_function(values)
+            groups.append(group)
+        (order_name, reverse) = self.group_order
+        # Groups without a value to order by go last
+        ordered_groups = sorted(
+            [group for group in groups if group[order_name] is not None],
+            key=lambda group: group[order_name],
+            reverse=reverse,
+        ) + [group for group in groups if group[order_name] is None]
+        return ordered_groups[:limit]
+
+    # Same as execute, but market data is fetched without blocking the event loop. Every field predicates and
+    # aggregates read is loaded for every symbol up front, after which aggregating finds everything it reads loaded.
+    async def execute_async(self, binance, symbols, limit, budget, account=None):
+        all_symbol_sources = self.aggregate_sources | self.predicate_sources
+        snapshot = (
+            await binance.market_snapshot_async(budget, account)
+            if _reads_tickers(all_symbol_sources)
+            else None
+        )
+        columns = _SymbolColumns(symbols, budget, snapshot, binance.order_book_service)
+        await columns.load_async(
+            self._predicate_reads() + self._aggregate_reads(),
+            range(len(symbols)),
+            account,
+        )
+        # Runs without yielding to other coroutines, so the thread's account is this query's throughout
+        with weight_account(account):
+            return self._aggregate(binance, symbols, limit, columns)
+
+
+# Values of fields for rows of a list of symbols. Fields that are market snapshot columns are read from the
+# snapshot, the rest through their accessors one symbol at a time. Fields that read order books are loaded in batches
+# of rows, fetching the order books of a batch at once and reading them before fetching the next, with batches no
+# bigger than the order book cache holds so that none are evicted before they're read.
+class _SymbolColumns:
+    def __init__(self, symbols, budget, snapshot, order_book_service):
+        self.symbols = symbols
+        self.budget = budget
+        self.snapshot = snapshot
+        self.order_book_service = order_book_service
+        self._symbol_ids = None
+        # Values of the fields that read order books, by field and row
+        self._loaded = {}
+
+    def read(self, field, function, rows, sources=()):
+        if self.snapshot is not None and field in SNAPSHOT_COLUMNS:
+            if self._symbol_ids is None:
+                self._symbol_ids = self.snapshot.ids(
+                    [symbol.symbol for symbol in self.symbols]
+                )
+            symbol_ids = self._symbol_ids
+            return self.snapshot.take(field, [symbol_ids[row] for row in rows])
+        if not _max_depth_levels(sources):
+            return self._compute(function, rows)
+        self.load([(field, function, sources)], rows)
+        loaded = self._loaded[field]
+        return [loaded[row] for row in rows]
+
+    # Loads (field, accessor, sources) field reads for the rows ahead of time. The fields are loaded together batch
+    # by batch, so that order books several of them read are only fetched once.
+    def load(self, field_reads, rows):
+        (field_reads, num_levels, batches) = self._batches(field_reads, rows)
+        for batch in batches:
+            self.order_book_service.prefetch(
+                self._symbol_names(batch), num_levels, self.budget
+            )
+            self._load_batch(field_reads, batch)
+
+    # Same as load, but order books are fetched without blocking the event loop
+    async def load_async(self, field_reads, rows, account=None):
+        (field_reads, num_levels, batches) = self._batches(field_reads, rows)
+        for batch in batches:
+            await self.order_book_service.prefetch_async(
+                self._symbol_names(batch), num_levels, self.budget, account
+            )
+            # Runs without yielding to other coroutines, so the thread's account is this query's throughout
+            with weight_account(account):
+                self._load_batch(field_reads, batch)
+
+    # Returns the field reads that read order books, the most levels they read and the rows any of them hasn't
+    # loaded yet, split into batches whose order books the cache holds together
+    def _batches(self, field_reads, rows):
+        field_reads = [
+            (field, function, sources)
+            for (field, function, sources) in field_reads
+            if _max_depth_levels(sources)
+        ]
+        if not field_reads:
+            return field_reads, None, []
+        num_levels = max(_max_depth_levels(sources) for (_, _, sources) in field_reads)
+        for (field, _, _) in field_reads:
+            self._loaded.setdefault(field, {})
+        missing_rows = [
+            row
+            for row in rows
+            if any(row not in self._loaded[field] for (field, _, _) in field_reads)
+        ]
+        batch_size = self.order_book_service.batch_size(num_levels)
+        return (
+            field_reads,
+            num_levels,
+            [
+                missing_rows[start : start + batch_size]
+                for start in range(0, len(missing_rows), batch_size)
+            ],
+        )
+
+    def _load_batch(self, field_reads, rows):
+        for (field, function, _) in field_reads:
+            self._loaded[field].update(zip(rows, self._compute(function, rows)))
+
+    def _symbol_names(self, rows):
+        return [self.symbols[row].symbol for row in rows]
+
+    def _compute(self, function, rows):
+        symbols = self.symbols
+        budget = self.budget
+        return [function(symbols[row], budget) for row in rows]
+
+
+@lru_cache(maxsize=QUERY_PLAN_CACHE_SIZE)
+def get_query_plan(fields, order_by=None, where=()):
+    return QueryPlan(fields, order_by, where)
+
+
+@lru_cache(maxsize=QUERY_PLAN_CACHE_SIZE)
+def get_grouped_query_plan(group_by, aggregates, order_by=None, where=()):
+    return GroupedQueryPlan(group_by, aggregates, order_by, where)
+
+
+def _reads_tickers(sources):
+    return any(source == TICKER_SOURCE for (source, _) in sources)
+
+
+def _depth_weight_of_sources(sources):
+    num_levels = _max_depth_levels(sources)
+    if not num_levels:
+        return 0
+    return request_weight("/api/v3/depth", {"limit": num_levels})
+
+
+# Deepest order book any of the sources reads, None if they don't read any
+def _max_depth_levels(sources):
+    return max(
+        [num_levels for (source, num_levels) in sources if source == DEPTH_SOURCE],
+        default=None,
+    )
+
+
+# Returns the accessor of a field along with the (source, parameter) market data it reads
+@lru_cache(maxsize=QUERY_PLAN_CACHE_SIZE)
+def _compile_field(field):
+    for (_, matcher, function, _, _, sources) in _COMPILED_FIELD_FUNCTIONS:
         matches = matcher.match(field)
         if matches:
-            return function(matches.groups())
+            return function(matches.groups()), sources(matches.groups())
     raise ValueError(
-        f'"{field}" is not a valid field. Must be one of {[name for (name, _, _, _, _) in FIELD_FUNCTIONS]}'
+        f'"{field}" is not a valid field. Must be one of {[name for (name, _, _, _, _, _) in FIELD_FUNCTIONS]}'
     )
 
 
+# Whether symbols can be ordered by a (valid) field
+def _can_order(field):
+    for (_, matcher, _, can_order, _, _) in _COMPILED_FIELD_FUNCTIONS:
+        if matcher.match(field):
+            return can_order
+
+
+# Returns the field, accessor, comparison, number and sources of a where predicate
+def _compile_predicate(predicate):
+    matches = PREDICATE_REGEX.match(predicate)
+    if not matches:
+        raise ValueError(
+            f'"{predicate}" is not a valid predicate. Must be a field, one of {list(PREDICATE_OPERATORS)} and a '
+            f'number (e.g. "volume>1000000")'
+        )
+    (field, comparison, raw_value) = matches.groups()
+    try:
+        value = Decimal(raw_value)
+    except InvalidOperation:
+        raise ValueError(f'"{raw_value}" in predicate "{predicate}" is not a number')
+    (function, sources) = _compile_field(field)
+    if field in NON_NUMERIC_FIELDS:
+        raise ValueError(
+            f'"{predicate}" is not a valid predicate. "{field}" isn\'t numeric, so it can\'t be compared to a number'
+        )
+    return field, function, PREDICATE_OPERATORS[comparison], value, sources
+
+
+# Returns the name, field (None for a bare count), accessor, aggregate function and sources of an aggregate
+def _compile_aggregate(aggregate):
+    if aggregate == "count":
+        return aggregate, None, None, len, []
+    matches = AGGREGATE_REGEX.match(aggregate)
+    if not matches:
+        raise ValueError(
+            f'"{aggregate}" is not a valid aggregate. Must be "count" or one of {list(AGGREGATE_FUNCTIONS)} of a '
+            f'field (e.g. "sum(volume)")'
+        )
+    (aggregate_name, field) = matches.groups()
+    (function, sources) = _compile_field(field)
+    if aggregate_name != "count" and field in NON_NUMERIC_FIELDS:
+        raise ValueError(
+            f'"{aggregate}" is not a valid aggregate. "{field}" isn\'t numeric, so it can only be counted '
+            f'(e.g. "count({field})")'
+        )
+    return aggregate, field, function, AGGREGATE_FUNCTIONS[aggregate_name], sources
+
+
 def _get_order(field):
-    for (possible_field, function) in ORDER_FUNCTIONS:
-        matcher = re.compile(possible_field)
+    for (matcher, function) in _COMPILED_ORDER_FUNCTIONS:
         matches = matcher.match(field)
         if matches:
             return function(matches.groups())
@@ -151,37 +828,121 @@ def symbol_analysis(
     order_by: Optional[str] = None,
     limit: int = 5,
     fields: Optional[Iterable[str]] = None,
+    max_age_ms: int = 0,
+    max_weight: Optional[int] = None,
+    where: Optional[Iterable[str]] = None,
+    group_by: Optional[str] = None,
+    aggregates: Optional[Iterable[str]] = None,
+    budget: Optional[StalenessBudget] = None,
 ):
-    binance = get_exchange()
-    symbols = binance.symbols(base_assets=base_assets, quote_assets=quote_assets)
-    if order_by:
-        ordering = _get_order(order_by)
-        symbols = sorted(symbols, key=ordering[0], reverse=ordering[1])
-    symbols = symbols[:limit]
-    fields = fields or ["symbol"]
-    return [
-        {field: _get_field_function(field)(symbol) for field in fields}
-        for symbol in symbols
-    ]
+    (binance, symbols, plan, budget) = _plan_symbol_analysis(
+        quote_assets,
+        base_assets,
+        order_by,
+        limit,
+        fields,
+        max_age_ms,
+        max_weight,
+        where,
+        group_by,
+        aggregates,
+        budget,
+    )
+    with weight_account(WeightAccount()) as account:
+        rows = plan.execute(binance, symbols, limit, budget)
+    query_weight_metric.observe(account.weight)
+    return rows
 
 
-def get_delta_tracker(
+# Same as symbol_analysis, for servers running on asyncio
+async def symbol_analysis_async(
     quote_assets: Optional[Iterable[str]] = None,
     base_assets: Optional[Iterable[str]] = None,
     order_by: Optional[str] = None,
     limit: int = 5,
     fields: Optional[Iterable[str]] = None,
-    delta_fields: Optional[Iterable[str]] = None,
-    interval_ms: int = 60000,
+    max_age_ms: int = 0,
+    max_weight: Optional[int] = None,
+    where: Optional[Iterable[str]] = None,
+    group_by: Optional[str] = None,
+    aggregates: Optional[Iterable[str]] = None,
+    budget: Optional[StalenessBudget] = None,
 ):
+    (binance, symbols, plan, budget) = _plan_symbol_analysis(
+        quote_assets,
+        base_assets,
+        order_by,
+        limit,
+        fields,
+        max_age_ms,
+        max_weight,
+        where,
+        group_by,
+        aggregates,
+        budget,
+    )
+    account = WeightAccount()
+    rows = await plan.execute_async(binance, symbols, limit, budget, account)
+    query_weight_metric.observe(account.weight)
+    return rows
+
+
+@plan_stage.time()
+def _plan_symbol_analysis(
+    quote_assets,
+    base_assets,
+    order_by,
+    limit,
+    fields,
+    max_age_ms,
+    max_weight,
+    where,
+    group_by,
+    aggregates,
+    budget,
+):
+    # A budget given outright lets several analyses agree on what counts as fresh, and so share the market data
+    # fetched for the first of them
+    budget = budget or StalenessBudget.from_ms(max_age_ms)
+    binance = get_exchange()
+    symbols = binance.symbols(base_assets=base_assets, quote_assets=quote_assets)
+    if group_by:
+        if fields:
+            raise ValueError(
+                "Fields can't be output for grouped symbols, use aggregates instead."
+            )
+        plan = get_grouped_query_plan(
+            group_by, tuple(aggregates or ["count"]), order_by, tuple(where or [])
+        )
+    else:
+        plan = get_query_plan(tuple(fields or ["symbol"]), order_by, tuple(where or []))
+    check_query_weight(plan, len(symbols), limit, max_weight)
+    return binance, symbols, plan, budget
+
+
+def check_query_weight(plan, num_symbols, limit, max_weight=None):
+    if max_weight is None:
+        return
+    expected_weight = plan.expected_weight(num_symbols, limit)
+    if expected_weight > max_weight:
+        raise ValueError(
+            f"This query may spend up to {expected_weight} API weight, but only {max_weight} is allowed. "
+            f"Narrow down the symbols, lower the limit or request fewer order book levels."
+        )
+
+
+# Delta tracking needs the symbol (to match rows across ticks) and every delta field in its analysis. Delta fields
+# have to be numbers, as deltas and rolling statistics are taken of them.
+def delta_tracker_fields(fields, delta_fields):
+    for delta_field in delta_fields:
+        if delta_field in NON_NUMERIC_FIELDS:
+            raise ValueError(
+                f"Delta analysis needs numeric fields, but {delta_field} is not one."
+            )
     fields = fields or ["symbol"]
     if "symbol" not in fields:
         fields.insert(0, "symbol")
     for delta_field in delta_fields:
         if delta_field not in fields:
             fields.append(delta_field)
-
-    def baked_symbol_analysis():
-        return symbol_analysis(quote_assets, base_assets, order_by, limit, fields)
-
-    return DeltaTracker(baked_symbol_analysis, delta_fields, interval_ms)
+    return fields
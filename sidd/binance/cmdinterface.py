@@ -1,7 +1,48 @@
 import argparse
 import sys
 
-from sidd.binance.analytics import FIELD_FUNCTIONS, get_delta_tracker, symbol_analysis
+from sidd.binance.analytics import (
+    AGGREGATE_FUNCTIONS,
+    FIELD_FUNCTIONS,
+    GROUP_BY_FIELDS,
+    symbol_analysis,
+    symbol_analysis_async,
+)
+from sidd.binance.rollingstats import WINDOW_SAMPLES
+from sidd.binance.tracking import get_tracking_engine
+
+# Analyses answering questions 1-4
+QUESTION_ANALYSES = {
+    1: {
+        "quote_assets": ["BTC"],
+        "order_by": "volume[desc]",
+        "limit": 5,
+        "fields": ["symbol", "volume"],
+    },
+    2: {
+        "quote_assets": ["USDT"],
+        "order_by": "trades[desc]",
+        "limit": 5,
+        "fields": ["symbol", "trades"],
+    },
+    3: {
+        "quote_assets": ["BTC"],
+        "order_by": "volume[desc]",
+        "limit": 5,
+        "fields": [
+            "symbol",
+            "volume",
+            "order_book_bid_total_value[200]",
+            "order_book_ask_total_value[200]",
+        ],
+    },
+    4: {
+        "quote_assets": ["USDT"],
+        "order_by": "trades[desc]",
+        "limit": 5,
+        "fields": ["symbol", "trades", "spread"],
+    },
+}
 
 
 # Overriding error so that the server doesn't crash due to bad commands
@@ -37,7 +78,26 @@ def add_symbol_analysis_subparser(subparsers):
         help="Order and display calculated fields on any symbol from Binance.",
     )
     _add_symbol_analysis_arguments(symbol_analysis_parser)
-    symbol_analysis_parser.set_defaults(handler=handle_symbol_analysis)
+    symbol_analysis_parser.add_argument(
+        "-g",
+        "--group_by",
+        type=str,
+        choices=GROUP_BY_FIELDS,
+        default=None,
+        help="Output aggregates for groups of symbols sharing this asset instead of fields for each symbol. Groups "
+        'can be ordered by the asset or any aggregate (e.g. "sum(volume)[desc]").',
+    )
+    symbol_analysis_parser.add_argument(
+        "-a",
+        "--aggregates",
+        type=str,
+        default=None,
+        help=f"Comma separated list. Aggregates to output for each group. Accepted values are count or any of "
+        f'{list(AGGREGATE_FUNCTIONS)} of a field (e.g. "sum(volume),median(spread)"). Defaults to count.',
+    )
+    symbol_analysis_parser.set_defaults(
+        handler=handle_symbol_analysis, async_handler=handle_symbol_analysis_async
+    )
 
 
 def add_delta_analysis_subparser(subparsers):
@@ -46,7 +106,7 @@ def add_delta_analysis_subparser(subparsers):
     )
     _add_symbol_analysis_arguments(delta_analysis_parser)
     possible_delta_fields = [
-        field for (field, _, _, _, can_delta) in FIELD_FUNCTIONS if can_delta
+        field for (field, _, _, _, can_delta, _) in FIELD_FUNCTIONS if can_delta
     ]
     delta_analysis_parser.add_argument(
         "-d",
@@ -62,6 +122,14 @@ def add_delta_analysis_subparser(subparsers):
         default=60000,
         help="Interval (in milliseconds) between re-fetching data from Binance to do delta comparisons with.",
     )
+    delta_analysis_parser.add_argument(
+        "-n",
+        "--window",
+        type=int,
+        default=WINDOW_SAMPLES,
+        help="Number of most recent intervals rolling statistics (EWMA, mean, standard deviation, min, max and "
+        "percent change) of each delta field are computed over.",
+    )
     delta_analysis_parser.set_defaults(handler=handle_delta_analysis)
 
 
@@ -76,10 +144,20 @@ def add_question_subparser(subparsers):
         choices=[1, 2, 3, 4, 5],
         help="Choose which question whose solution you want displayed from the output of this command.",
     )
-    question_parser.set_defaults(handler=handle_question)
+    question_parser.set_defaults(
+        handler=handle_question, async_handler=handle_question_async
+    )
 
 
 def handle_symbol_analysis(args):
+    return symbol_analysis(**symbol_analysis_options(args))
+
+
+async def handle_symbol_analysis_async(args):
+    return await symbol_analysis_async(**symbol_analysis_options(args))
+
+
+def symbol_analysis_options(args):
     base_assets = (
         [asset.strip().upper() for asset in args.base_assets.split(",")]
         if args.base_assets
@@ -95,10 +173,40 @@ def handle_symbol_analysis(args):
     fields = (
         [field.strip() for field in args.fields.split(",")] if args.fields else None
     )
-    return symbol_analysis(quote_assets, base_assets, order_by, limit, fields)
+    max_age_ms = args.max_age
+    max_weight = args.max_weight
+    where = (
+        [predicate.strip() for predicate in args.where.split(",")]
+        if args.where
+        else None
+    )
+    group_by = args.group_by
+    aggregates = (
+        [aggregate.strip() for aggregate in args.aggregates.split(",")]
+        if args.aggregates
+        else None
+    )
+    return {
+        "quote_assets": quote_assets,
+        "base_assets": base_assets,
+        "order_by": order_by,
+        "limit": limit,
+        "fields": fields,
+        "max_age_ms": max_age_ms,
+        "max_weight": max_weight,
+        "where": where,
+        "group_by": group_by,
+        "aggregates": aggregates,
+    }
 
 
 def handle_delta_analysis(args):
+    # Iterating the subscription gives a generator, which binance_analyzer.py knows to print row by row
+    return iter(subscribe_delta_analysis(args))
+
+
+def subscribe_delta_analysis(args):
+    check_delta_analysis_args(args)
     base_assets = (
         [asset.strip().upper() for asset in args.base_assets.split(",")]
         if args.base_assets
@@ -120,7 +228,13 @@ def handle_delta_analysis(args):
         else None
     )
     interval_ms = args.interval
-    delta_tracker = get_delta_tracker(
+    max_age_ms = args.max_age
+    where = (
+        [predicate.strip() for predicate in args.where.split(",")]
+        if args.where
+        else None
+    )
+    return get_tracking_engine().subscribe(
         base_assets=base_assets,
         quote_assets=quote_assets,
         order_by=order_by,
@@ -128,57 +242,50 @@ def handle_delta_analysis(args):
         fields=fields,
         delta_fields=delta_fields,
         interval_ms=interval_ms,
+        max_age_ms=max_age_ms,
+        where=where,
+        window=args.window,
+        max_weight=args.max_weight,
     )
-    return delta_tracker.start()
 
 
-def handle_question(args):
-    q = args.question
-    if q == 1:
-        return symbol_analysis(
-            quote_assets=["BTC"],
-            order_by="volume[desc]",
-            limit=5,
-            fields=["symbol", "volume"],
-        )
-    elif q == 2:
-        return symbol_analysis(
-            quote_assets=["USDT"],
-            order_by="trades[desc]",
-            limit=5,
-            fields=["symbol", "trades"],
+# Catches arguments that would only fail once the tracker ticks, so streams get an error response instead
+def check_delta_analysis_args(args):
+    if args.interval < 1:
+        raise ValueError(
+            f"The interval must be at least 1 millisecond, but was given {args.interval}."
         )
-    elif q == 3:
-        return symbol_analysis(
-            quote_assets=["BTC"],
-            order_by="volume[desc]",
-            limit=5,
-            fields=[
-                "symbol",
-                "volume",
-                "order_book_bid_total_value[200]",
-                "order_book_ask_total_value[200]",
-            ],
-        )
-    elif q == 4:
-        return symbol_analysis(
-            quote_assets=["USDT"],
-            order_by="trades[desc]",
-            limit=5,
-            fields=["symbol", "trades", "spread"],
+    if args.window < 1:
+        raise ValueError(
+            f"The window must be at least 1 interval, but was given {args.window}."
         )
+
+
+def handle_question(args):
+    q = args.question
+    if q in QUESTION_ANALYSES:
+        return symbol_analysis(**QUESTION_ANALYSES[q])
     elif q == 5:
-        return get_delta_tracker(
-            quote_assets=["USDT"],
-            order_by="trades[desc]",
-            limit=5,
-            fields=["symbol", "trades", "spread"],
-            delta_fields=["spread"],
-            interval_ms=10000,
-        ).start()
+        return iter(
+            get_tracking_engine().subscribe(
+                quote_assets=["USDT"],
+                order_by="trades[desc]",
+                limit=5,
+                fields=["symbol", "trades", "spread"],
+                delta_fields=["spread"],
+                interval_ms=10000,
+            )
+        )
     return None
 
 
+async def handle_question_async(args):
+    q = args.question
+    if q in QUESTION_ANALYSES:
+        return await symbol_analysis_async(**QUESTION_ANALYSES[q])
+    raise ValueError(f"Question {q} can't be answered asynchronously.")
+
+
 def _add_symbol_analysis_arguments(subparser):
     subparser.add_argument(
         "-b",
@@ -195,7 +302,7 @@ def _add_symbol_analysis_arguments(subparser):
         help="Comma separated list. Filter symbols to those that include this asset as a quote asset.",
     )
     possible_order_fields = [
-        field for (field, _, _, can_order, _) in FIELD_FUNCTIONS if can_order
+        field for (field, _, _, can_order, _, _) in FIELD_FUNCTIONS if can_order
     ]
     subparser.add_argument(
         "-o",
@@ -214,7 +321,15 @@ def _add_symbol_analysis_arguments(subparser):
         help="Limit number of symbols to display/analyze. This is especially important for doing market "
         "depth queries as we may exhaust the API limit.",
     )
-    possible_fields = [field for (field, _, _, _, _) in FIELD_FUNCTIONS]
+    subparser.add_argument(
+        "-W",
+        "--where",
+        type=str,
+        default=None,
+        help="Comma separated list. Only consider symbols whose fields compare to a number as given, using one of "
+        '<, <=, >, >=, = or != (e.g. "volume>1000000,spread<0.01").',
+    )
+    possible_fields = [field for (field, _, _, _, _, _) in FIELD_FUNCTIONS]
     subparser.add_argument(
         "-f",
         "--fields",
@@ -222,3 +337,18 @@ def _add_symbol_analysis_arguments(subparser):
         default=None,
         help=f"Fields to output for each selected symbol. Accepted values are {possible_fields}",
     )
+    subparser.add_argument(
+        "-m",
+        "--max_age",
+        type=int,
+        default=0,
+        help="Maximum age (in milliseconds) of cached tickers and order books that may be used to answer this "
+        "query. By default, everything is re-fetched from Binance.",
+    )
+    subparser.add_argument(
+        "-w",
+        "--max_weight",
+        type=int,
+        default=None,
+        help="Refuse to run queries that may spend more than this much Binance API weight. No limit by default.",
+    )
@@ -0,0 +1,302 @@
+import asyncio
+import json
+import logging
+from time import monotonic
+
+import aiohttp
+from binance.error import ClientError, ServerError
+from binance.lib.utils import cleanNoneValue, encoded_string
+
+from sidd.binance.connector.clientadapter import (
+    CONNECT_TIMEOUT_S,
+    LIMIT_LABEL,
+    MAX_ATTEMPTS,
+    POOL_SIZE,
+    RATE_LIMITED_STATUS_CODES,
+    READ_TIMEOUT_S,
+    ReplayClient,
+    get_client,
+    handle_limits_from_response,
+    hedged_requests_metric,
+    loads_json,
+    request_latency_metric,
+    spend_weight,
+)
+from sidd.binance.connector.ratelimit import request_weight
+from sidd.binance.connector.sharedcache import (
+    FETCHER_CONNECT_TIMEOUT_S,
+    SharedClient,
+    encode_fetch_request,
+)
+from sidd.binance.connector.staleness import StalenessBudget, fetch_time
+
+_async_client = None
+
+
+def get_async_client():
+    global _async_client
+    # Only ever called from the event loop's thread, so no lock is needed
+    if _async_client is None:
+        client = get_client()
+        if isinstance(client, SharedClient):
+            _async_client = AsyncSharedClient(client)
+        elif isinstance(client, ReplayClient):
+            _async_client = AsyncReplayClient(client)
+        else:
+            _async_client = AsyncSafeClient(client)
+    return _async_client
+
+
+# SafeClient's public market data requests for asyncio, so that waiting on Binance doesn't hold a thread. Weight and
+# hosts are shared with the (threaded) SafeClient, so both stay within the same rate limit and agree on which hosts
+# are healthy. Coroutines share a thread, so weight is charged to the WeightAccount passed in rather than the thread's.
+class AsyncSafeClient:
+    def __init__(
+        self,
+        client,
+        pool_size=POOL_SIZE,
+        connect_timeout_s=CONNECT_TIMEOUT_S,
+        read_timeout_s=READ_TIMEOUT_S,
+    ):
+        self.scheduler = client.scheduler
+        self.hosts = client.hosts
+        self.hedge_delay_s = client.hedge_delay_s
+        self.recorder = client.recorder
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=connect_timeout_s, sock_read=read_timeout_s
+        )
+        # Sessions belong to an event loop, so this is made on first use
+        self._session = None
+
+    async def depth(self, symbol, limit=100, account=None):
+        return await self.query(
+            "/api/v3/depth", {"symbol": symbol, "limit": limit}, account
+        )
+
+    async def ticker_24hr(self, symbol=None, account=None):
+        return await self.query("/api/v3/ticker/24hr", {"symbol": symbol}, account)
+
+    async def query_within(self, url_path, payload=None, budget=None, account=None):
+        fetched_at = fetch_time()
+        return fetched_at, await self.query(url_path, payload, account)
+
+    async def query(self, url_path, payload=None, account=None):
+        weight = request_weight(url_path, payload)
+        await self.scheduler.acquire_async(weight)
+        spend_weight(url_path, weight, account)
+        logging.info(f"Calling url_path={url_path} with payload={payload}.")
+        started_at = monotonic()
+        try:
+            response = await self._query_with_failover(
+                url_path, payload, weight, account
+            )
+        except ClientError as e:
+            if self.recorder is not None:
+                self.recorder.record(url_path, payload, started_at, error=e)
+            if e.status_code in RATE_LIMITED_STATUS_CODES:
+                retry_after = e.header.get("Retry-After") if e.header else None
+                self.scheduler.back_off(
+                    int(retry_after) if retry_after is not None else None
+                )
+            raise
+        finally:
+            request_latency_metric.labels(endpoint=url_path).observe(
+                monotonic() - started_at
+            )
+        if self.recorder is not None:
+            self.recorder.record(url_path, payload, started_at, response)
+        self.scheduler.observe_used_weight(int(response["limit_usage"][LIMIT_LABEL]))
+        return handle_limits_from_response(response, self.scheduler.limit)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _query_with_failover(self, url_path, payload, weight, account):
+        tried_hosts = []
+        while True:
+            try:
+                return await self._hedged_query(
+                    url_path, payload, weight, account, tried_hosts
+                )
+            except ClientError:
+                raise
+            except Exception:
+                if (
+                    len(tried_hosts) >= MAX_ATTEMPTS
+                    or self.hosts.choose(exclude=tried_hosts) is None
+                ):
+                    raise
+                logging.warning(
+                    f"Request to {tried_hosts[-1].url} failed, retrying on another host.",
+                    exc_info=True,
+                )
+                await self.scheduler.acquire_async(weight)
+                spend_weight(url_path, weight, account)
+
+    async def _hedged_query(self, url_path, payload, weight, account, tried_hosts):
+        primary_host = self.hosts.choose(exclude=tried_hosts)
+        tried_hosts.append(primary_host)
+        primary = asyncio.ensure_future(
+            self._query_host(primary_host, url_path, payload)
+        )
+        if self.hedge_delay_s is None:
+            return await primary
+        (done, _) = await asyncio.wait([primary], timeout=self.hedge_delay_s)
+        if done:
+            return primary.result()
+        secondary_host = self.hosts.choose(exclude=tried_hosts)
+        # Hedging spends extra weight, so only do it when that weight is free right now
+        if secondary_host is None or not self.scheduler.try_acquire(weight):
+            return await primary
+        spend_weight(url_path, weight, account)
+        tried_hosts.append(secondary_host)
+        secondary = asyncio.ensure_future(
+            self._query_host(secondary_host, url_path, payload)
+        )
+        pending = {primary, secondary}
+        while True:
+            (done, pending) = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for future in done:
+                if future.exception() is None or not pending:
+                    winner = "primary" if future is primary else "secondary"
+                    hedged_requests_metric.labels(winner=winner).inc()
+                    for pending_future in pending:
+                        pending_future.cancel()
+                    return future.result()
+
+    async def _query_host(self, host, url_path, payload):
+        start = monotonic()
+        try:
+            response = await self._send_request(host.url, url_path, payload)
+        except ClientError:
+            # The host answered, we just asked for something we shouldn't have
+            self.hosts.record_success(host, monotonic() - start)
+            raise
+        except asyncio.CancelledError:
+            # Lost a hedge, which says nothing about the host
+            raise
+        except Exception:
+            self.hosts.record_failure(host)
+            raise
+        self.hosts.record_success(host, monotonic() - start)
+        return response
+
+    # Same request and response handling as binance-connector's API.send_request, with limit usage always shown
+    async def _send_request(self, base_url, url_path, payload):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.pool_size),
+                timeout=self.timeout,
+            )
+        url = base_url + url_path
+        params = encoded_string(cleanNoneValue(payload or {}))
+        async with self._session.get(url, params=params) as response:
+            body = await response.read()
+            if response.status >= 400:
+                text = body.decode("utf-8", "replace")
+            if 400 <= response.status < 500:
+                try:
+                    error = json.loads(text)
+                except ValueError:
+                    raise ClientError(response.status, None, text, response.headers)
+                raise ClientError(
+                    response.status, error["code"], error["msg"], response.headers
+                )
+            if response.status >= 500:
+                raise ServerError(response.status, text)
+            limit_usage = {
+                key.lower(): value
+                for (key, value) in response.headers.items()
+                if key.lower().startswith(
+                    ("x-mbx-used-weight", "x-mbx-order-count", "x-sapi-used")
+                )
+            }
+        return {"limit_usage": limit_usage, "data": loads_json(body)}
+
+
+# ReplayClient for asyncio
+class AsyncReplayClient:
+    def __init__(self, client):
+        self.client = client
+        self.scheduler = client.scheduler
+
+    async def depth(self, symbol, limit=100, account=None):
+        return await self.query(
+            "/api/v3/depth", {"symbol": symbol, "limit": limit}, account
+        )
+
+    async def ticker_24hr(self, symbol=None, account=None):
+        return await self.query("/api/v3/ticker/24hr", {"symbol": symbol}, account)
+
+    async def query_within(self, url_path, payload=None, budget=None, account=None):
+        fetched_at = fetch_time()
+        return fetched_at, await self.query(url_path, payload, account)
+
+    async def query(self, url_path, payload=None, account=None):
+        weight = request_weight(url_path, payload)
+        await self.scheduler.acquire_async(weight)
+        spend_weight(url_path, weight, account)
+        entry = self.client.replay(url_path, payload)
+        await asyncio.sleep(entry["latency"] / self.client.speed)
+        request_latency_metric.labels(endpoint=url_path).observe(
+            entry["latency"] / self.client.speed
+        )
+        return self.client.respond(entry)
+
+    async def close(self):
+        pass
+
+
+# SharedClient for asyncio, asking the fetcher for fresh responses without holding a thread
+class AsyncSharedClient:
+    def __init__(self, client):
+        self.client = client
+        self.scheduler = client.scheduler
+
+    async def depth(self, symbol, limit=100, account=None):
+        return await self.query(
+            "/api/v3/depth", {"symbol": symbol, "limit": limit}, account
+        )
+
+    async def ticker_24hr(self, symbol=None, account=None):
+        return await self.query("/api/v3/ticker/24hr", {"symbol": symbol}, account)
+
+    async def query_within(self, url_path, payload=None, budget=None, account=None):
+        payload = cleanNoneValue(payload or {})
+        budget = budget or StalenessBudget(0)
+        published = self.client.store.read(url_path, payload)
+        if published is None or not budget.allows(published[0]):
+            reply = await self._request(url_path, payload, budget)
+            self.client.handle_reply(url_path, reply, account)
+            published = self.client.store.read(url_path, payload)
+        return published
+
+    async def query(self, url_path, payload=None, account=None):
+        return (await self.query_within(url_path, payload, None, account))[1]
+
+    async def close(self):
+        pass
+
+    async def _request(self, url_path, payload, budget):
+        request = encode_fetch_request(url_path, payload, budget)
+        deadline = monotonic() + FETCHER_CONNECT_TIMEOUT_S
+        while True:
+            try:
+                (reader, writer) = await asyncio.open_unix_connection(
+                    self.client.socket_path
+                )
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+        try:
+            writer.write(request)
+            return json.loads(await reader.readline())
+        finally:
+            writer.close()
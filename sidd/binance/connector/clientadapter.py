@@ -1,32 +1,436 @@
+import atexit
+import gzip
+import json
 import logging
+import os
+import threading
+from bisect import bisect_right
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import wait
+from time import monotonic, sleep
 
+from binance.error import ClientError
+from binance.lib.utils import cleanNoneValue, encoded_string
 from binance.spot import Spot
+from prometheus_client import Counter, Gauge, Histogram
+from requests.adapters import HTTPAdapter
 
-URLS = [
-    "https://api.binance.com",
-    "https://api1.binance.com",
-    "https://api2.binance.com",
-    "https://api3.binance.com",
-]
+from sidd.binance.connector.hostpool import HostPool
+from sidd.binance.connector.ratelimit import (
+    LIMIT,
+    WeightScheduler,
+    current_weight_account,
+    request_weight,
+)
+from sidd.binance.connector.staleness import fetch_time
+
+try:
+    # Optional. Parses responses straight from bytes, several times faster than json on full order books.
+    from orjson import loads as loads_json
+except ImportError:
+    from json import loads as loads_json
+
+URLS = (
+    os.environ["BINANCE_API_URLS"].split(",")
+    if os.environ.get("BINANCE_API_URLS")
+    else [
+        "https://api.binance.com",
+        "https://api1.binance.com",
+        "https://api2.binance.com",
+        "https://api3.binance.com",
+    ]
+)
 LIMIT_LABEL = "x-mbx-used-weight"
-LIMIT = 1200  # Should really try to get this dynamically
 WARNING_THRESHOLD = 0.7
+# Keep-alive connections kept per Binance host. Should be at least the number of threads making requests.
+POOL_SIZE = int(os.environ.get("BINANCE_HTTP_POOL_SIZE", 16))
+CONNECT_TIMEOUT_S = float(os.environ.get("BINANCE_HTTP_CONNECT_TIMEOUT_S", 3.05))
+READ_TIMEOUT_S = float(os.environ.get("BINANCE_HTTP_READ_TIMEOUT_S", 10))
+# Responses Binance sends when we have exceeded (429) or been banned for exceeding (418) the rate limit
+RATE_LIMITED_STATUS_CODES = [418, 429]
+# A request still running after this long is also sent to a second host, and whichever answers first is used.
+# Set to 0 to disable hedging.
+HEDGE_DELAY_S = float(os.environ.get("BINANCE_HEDGE_DELAY_S", 1)) or None
+# Hosts a request is tried on before giving up when hosts fail (rather than reject the request)
+MAX_ATTEMPTS = 2
+# Record every response from Binance to this file (gzipped JSON lines), so that it can be replayed later
+RECORD_FILE = os.environ.get("BINANCE_RECORD_FILE")
+# Serve responses from this recording instead of Binance
+REPLAY_FILE = os.environ.get("BINANCE_REPLAY_FILE")
+# How many times faster than it was recorded a recording is replayed. Speeds up the market (which recorded response
+# is current), request latency and the rate limit alike.
+REPLAY_SPEED = float(os.environ.get("BINANCE_REPLAY_SPEED", 1))
+# Directory, ideally memory backed (e.g. under /dev/shm), that market data is shared between processes through. When
+# set, requests go through the fetcher process (fetcher.py) that owns all Binance I/O, and market data it already
+# published is read from here rather than fetched again.
+SHARED_CACHE_DIR = os.environ.get("BINANCE_SHARED_CACHE_DIR")
+
+connection_reuse_metric = Gauge(
+    "binance_http_connection_reuse_ratio",
+    "Fraction of requests to Binance served over an already open connection",
+)
+hedged_requests_metric = Counter(
+    "binance_hedged_requests",
+    "Requests sent to a second host because the first was slow",
+    ["winner"],
+)
+request_latency_metric = Histogram(
+    "binance_request_seconds",
+    "Time requests to Binance took once they had the API weight to be sent, including failovers and hedging",
+    ["endpoint"],
+)
+request_weight_metric = Counter(
+    "binance_request_weight", "API weight spent on requests to Binance", ["endpoint"]
+)
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                if SHARED_CACHE_DIR:
+                    # Imports this module, so it can't be imported up top
+                    from sidd.binance.connector.sharedcache import SharedClient
+
+                    _client = SharedClient(SHARED_CACHE_DIR)
+                elif REPLAY_FILE:
+                    _client = ReplayClient(Recording.load(REPLAY_FILE), REPLAY_SPEED)
+                else:
+                    _client = SafeClient(
+                        recorder=Recorder(RECORD_FILE) if RECORD_FILE else None
+                    )
+                    connection_reuse_metric.set_function(_client.connection_reuse_ratio)
+    return _client
+
+
+# Counts weight spent on an endpoint, and charges it to the WeightAccount of the query it was spent for, if any
+def spend_weight(url_path, weight, account=None):
+    request_weight_metric.labels(endpoint=url_path).inc(weight)
+    if account is not None:
+        account.spend(weight)
 
 
 class SafeClient(Spot):
-    def __init__(self):
-        super().__init__(show_limit_usage=True, base_url=URLS[0])
+    def __init__(
+        self,
+        pool_size=POOL_SIZE,
+        timeout=(CONNECT_TIMEOUT_S, READ_TIMEOUT_S),
+        urls=URLS,
+        hedge_delay_s=HEDGE_DELAY_S,
+        recorder=None,
+    ):
+        super().__init__(show_limit_usage=True, base_url=urls[0], timeout=timeout)
+        self.adapter = HTTPAdapter(pool_connections=len(urls), pool_maxsize=pool_size)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.scheduler = WeightScheduler()
+        self.hosts = HostPool(urls)
+        # One plain client per host, all sharing our pooled session
+        self.host_clients = {}
+        for url in urls:
+            host_client = _HostClient(
+                show_limit_usage=True, base_url=url, timeout=timeout
+            )
+            host_client.session = self.session
+            self.host_clients[url] = host_client
+        self.hedge_delay_s = hedge_delay_s
+        self._hedge_executor = (
+            ThreadPoolExecutor(max_workers=2 * pool_size)
+            if hedge_delay_s is not None and len(urls) > 1
+            else None
+        )
+        self.recorder = recorder
 
     def query(self, url_path, payload=None):
+        weight = request_weight(url_path, payload)
+        self.scheduler.acquire(weight)
+        spend_weight(url_path, weight, current_weight_account())
         logging.info(f"Calling url_path={url_path} with payload={payload}.")
-        response = super().query(url_path, payload)
-        return handle_limits_from_response(response)
+        started_at = monotonic()
+        try:
+            response = self._query_with_failover(url_path, payload, weight)
+        except ClientError as e:
+            if self.recorder is not None:
+                self.recorder.record(url_path, payload, started_at, error=e)
+            if e.status_code in RATE_LIMITED_STATUS_CODES:
+                retry_after = e.header.get("Retry-After") if e.header else None
+                self.scheduler.back_off(
+                    int(retry_after) if retry_after is not None else None
+                )
+            raise
+        finally:
+            request_latency_metric.labels(endpoint=url_path).observe(
+                monotonic() - started_at
+            )
+        if self.recorder is not None:
+            self.recorder.record(url_path, payload, started_at, response)
+        self.scheduler.observe_used_weight(int(response["limit_usage"][LIMIT_LABEL]))
+        return handle_limits_from_response(response, self.scheduler.limit)
+
+    # Returns when a response was fetched along with the response. It's always fetched anew, which satisfies any
+    # budget, while clients sharing market data between processes may answer from what another process fetched.
+    def query_within(self, url_path, payload=None, budget=None):
+        fetched_at = fetch_time()
+        return fetched_at, self.query(url_path, payload)
+
+    def _query_with_failover(self, url_path, payload, weight):
+        tried_hosts = []
+        while True:
+            try:
+                if self._hedge_executor is None:
+                    host = self.hosts.choose(exclude=tried_hosts)
+                    tried_hosts.append(host)
+                    return self._query_host(host, url_path, payload)
+                return self._hedged_query(url_path, payload, weight, tried_hosts)
+            except ClientError:
+                raise
+            except Exception:
+                if (
+                    len(tried_hosts) >= MAX_ATTEMPTS
+                    or self.hosts.choose(exclude=tried_hosts) is None
+                ):
+                    raise
+                logging.warning(
+                    f"Request to {tried_hosts[-1].url} failed, retrying on another host.",
+                    exc_info=True,
+                )
+                self.scheduler.acquire(weight)
+                spend_weight(url_path, weight, current_weight_account())
+
+    def _hedged_query(self, url_path, payload, weight, tried_hosts):
+        primary_host = self.hosts.choose(exclude=tried_hosts)
+        tried_hosts.append(primary_host)
+        primary = self._hedge_executor.submit(
+            self._query_host, primary_host, url_path, payload
+        )
+        try:
+            return primary.result(timeout=self.hedge_delay_s)
+        except FutureTimeoutError:
+            pass
+        secondary_host = self.hosts.choose(exclude=tried_hosts)
+        # Hedging spends extra weight, so only do it when that weight is free right now
+        if secondary_host is None or not self.scheduler.try_acquire(weight):
+            return primary.result()
+        spend_weight(url_path, weight, current_weight_account())
+        tried_hosts.append(secondary_host)
+        secondary = self._hedge_executor.submit(
+            self._query_host, secondary_host, url_path, payload
+        )
+        pending = {primary, secondary}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None or not pending:
+                    winner = "primary" if future is primary else "secondary"
+                    hedged_requests_metric.labels(winner=winner).inc()
+                    return future.result()
+
+    def _query_host(self, host, url_path, payload):
+        start = monotonic()
+        try:
+            response = self.host_clients[host.url].query(url_path, payload)
+        except ClientError:
+            # The host answered, we just asked for something we shouldn't have
+            self.hosts.record_success(host, monotonic() - start)
+            raise
+        except Exception:
+            self.hosts.record_failure(host)
+            raise
+        self.hosts.record_success(host, monotonic() - start)
+        return response
+
+    def remaining_weight(self):
+        return self.scheduler.available_weight()
+
+    def connection_reuse_ratio(self):
+        pools = self.adapter.poolmanager.pools
+        num_requests = 0
+        num_connections = 0
+        for key in pools.keys():
+            connection_pool = pools.get(key)
+            if connection_pool is not None:
+                num_requests += connection_pool.num_requests
+                num_connections += connection_pool.num_connections
+        if num_requests == 0:
+            return 0
+        return 1 - num_connections / num_requests
+
+
+# Spot, with responses parsed straight from their bytes. Spot decodes (and charset sniffs) the text of every response
+# to log it, and then again to parse it, which costs more than the parsing itself for large order books.
+class _HostClient(Spot):
+    # Same request and response handling as binance-connector's API.send_request, with limit usage always shown
+    def send_request(self, http_method, url_path, payload=None):
+        params = cleanNoneValue(
+            {
+                "url": self.base_url + url_path,
+                "params": self._prepare_params(payload or {}),
+                "timeout": self.timeout,
+                "proxies": self.proxies,
+            }
+        )
+        response = self._dispatch_request(http_method)(**params)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("raw response from server:" + response.text)
+        self._handle_exception(response)
+        try:
+            data = loads_json(response.content)
+        except ValueError:
+            data = response.text
+        limit_usage = {
+            key.lower(): value
+            for (key, value) in response.headers.items()
+            if key.lower().startswith(
+                ("x-mbx-used-weight", "x-mbx-order-count", "x-sapi-used")
+            )
+        }
+        return {"limit_usage": limit_usage, "data": data}
+
+
+# Writes every response SafeClient and AsyncSafeClient get (or client error they're given) to a gzipped file, one JSON
+# object per line with when the request was sent (seconds since recording started), how long it took, the request and
+# the response.
+class Recorder:
+    def __init__(self, path):
+        self.path = path
+        self._file = gzip.open(path, "wt")
+        self._started_at = monotonic()
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def record(self, url_path, payload, started_at, response=None, error=None):
+        entry = {
+            "at": started_at - self._started_at,
+            "latency": monotonic() - started_at,
+            "url_path": url_path,
+            "payload": cleanNoneValue(payload or {}),
+        }
+        if error is not None:
+            retry_after = error.header.get("Retry-After") if error.header else None
+            entry["error"] = [
+                error.status_code,
+                error.error_code,
+                error.error_message,
+                retry_after,
+            ]
+        else:
+            entry["limit_usage"] = response["limit_usage"]
+            entry["data"] = response["data"]
+        line = json.dumps(entry, separators=(",", ":"))
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+# A Recorder's responses, by request
+class Recording:
+    def __init__(self, responses):
+        # Request key -> (times the request was sent, entries), both ordered by time
+        self.responses = responses
+
+    @classmethod
+    def load(cls, path):
+        entries = defaultdict(list)
+        with gzip.open(path, "rt") as recording_file:
+            for line in recording_file:
+                entry = json.loads(line)
+                entries[_request_key(entry["url_path"], entry["payload"])].append(entry)
+        responses = {}
+        for (key, request_entries) in entries.items():
+            # Concurrent requests are written as they finish, which isn't always the order they were sent in
+            request_entries.sort(key=lambda entry: entry["at"])
+            responses[key] = (
+                [entry["at"] for entry in request_entries],
+                request_entries,
+            )
+        return Recording(responses)
+
+    # The entry for the request sent closest to the given time. A replay running at the recorded pace sends each
+    # request a little before or after it was recorded, so this is more forgiving than the latest entry before it.
+    def at(self, url_path, payload, at):
+        recorded = self.responses.get(_request_key(url_path, payload))
+        if recorded is None:
+            raise ValueError(
+                f"Nothing was recorded for url_path={url_path} with payload={payload}."
+            )
+        (times, entries) = recorded
+        position = bisect_right(times, at)
+        if position == len(times) or (
+            position > 0 and at - times[position - 1] < times[position] - at
+        ):
+            position -= 1
+        return entries[position]
+
+
+# Serves a recording in place of SafeClient. Each request gets the response that was current at the same point of
+# the recording, after the latency it was recorded with.
+class ReplayClient(Spot):
+    def __init__(self, recording, speed=REPLAY_SPEED):
+        super().__init__(show_limit_usage=True)
+        self.recording = recording
+        self.speed = speed
+        self.scheduler = WeightScheduler(time_scale=speed)
+        self._started_at = monotonic()
+
+    def query(self, url_path, payload=None):
+        weight = request_weight(url_path, payload)
+        self.scheduler.acquire(weight)
+        spend_weight(url_path, weight, current_weight_account())
+        entry = self.replay(url_path, payload)
+        sleep(entry["latency"] / self.speed)
+        request_latency_metric.labels(endpoint=url_path).observe(
+            entry["latency"] / self.speed
+        )
+        return self.respond(entry)
+
+    def query_within(self, url_path, payload=None, budget=None):
+        fetched_at = fetch_time()
+        return fetched_at, self.query(url_path, payload)
+
+    def replay(self, url_path, payload):
+        return self.recording.at(
+            url_path, payload, (monotonic() - self._started_at) * self.speed
+        )
+
+    # Returns the data of an entry as query would have, or raises the client error it recorded
+    def respond(self, entry):
+        if "error" in entry:
+            (status_code, error_code, error_message, retry_after) = entry["error"]
+            if status_code in RATE_LIMITED_STATUS_CODES:
+                self.scheduler.back_off(
+                    int(retry_after) if retry_after is not None else None
+                )
+            raise ClientError(
+                status_code,
+                error_code,
+                error_message,
+                {} if retry_after is None else {"Retry-After": retry_after},
+            )
+        self.scheduler.observe_used_weight(int(entry["limit_usage"][LIMIT_LABEL]))
+        return handle_limits_from_response(entry, self.scheduler.limit)
+
+    def remaining_weight(self):
+        return self.scheduler.available_weight()
+
+
+def _request_key(url_path, payload):
+    return f"{url_path}?{encoded_string(sorted(cleanNoneValue(payload or {}).items()))}"
 
 
-def handle_limits_from_response(response):
+def handle_limits_from_response(response, limit=LIMIT):
     usage = int(response["limit_usage"][LIMIT_LABEL])
     log_func = logging.info
-    if usage / LIMIT > WARNING_THRESHOLD:
+    if usage / limit > WARNING_THRESHOLD:
         log_func = logging.warning
-    log_func(f"API usage is at usage={usage} of limit={LIMIT}.")
+    log_func(f"API usage is at usage={usage} of limit={limit}.")
     return response["data"]
@@ -0,0 +1,235 @@
+import logging
+import os
+import threading
+from bisect import bisect_left, insort
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from time import sleep
+
+from prometheus_client import Counter, Gauge
+
+from sidd.binance.connector.clientadapter import get_client
+from sidd.binance.connector.ratelimit import BACKGROUND, request_priority
+from sidd.binance.connector.staleness import fetch_time
+
+# Depth of the REST snapshot each local order book is bootstrapped from. This is also the deepest read the local
+# book can answer, as levels beyond the snapshot were never seen.
+SNAPSHOT_LEVELS = int(os.environ.get("BINANCE_DEPTH_STREAM_SNAPSHOT_LEVELS", 1000))
+# Symbols beyond this many keep being served over REST
+MAX_STREAMED_SYMBOLS = int(os.environ.get("BINANCE_DEPTH_STREAM_MAX_SYMBOLS", 50))
+STREAM_SPEED_MS = 100
+# Streams push every STREAM_SPEED_MS while the book changes. A book that hasn't had an update for longer than this
+# can't be told apart from one whose stream died or is reconnecting, so it is read over REST until updates resume.
+STREAM_STALE_S = 5
+# Pause before re-snapshotting when the previous snapshot turned out to be too old to line up with the stream
+STALE_SNAPSHOT_RETRY_S = 1
+
+depth_stream_reads_metric = Counter(
+    "binance_depth_stream_reads",
+    "Order book reads answered by (or falling back from) a local streamed book",
+    ["result"],
+)
+depth_stream_resyncs_metric = Counter(
+    "binance_depth_stream_resyncs", "Local order book resyncs from a REST snapshot"
+)
+depth_stream_symbols_metric = Gauge(
+    "binance_depth_stream_symbols", "Symbols with a local streamed order book"
+)
+
+
+# Local order books kept up to date from <symbol>@depth diff streams, following
+# https://binance-docs.github.io/apidocs/spot/en/#how-to-manage-a-local-order-book-correctly
+class DepthStreams:
+    def __init__(
+        self, snapshot_levels=SNAPSHOT_LEVELS, max_symbols=MAX_STREAMED_SYMBOLS
+    ):
+        self.snapshot_levels = snapshot_levels
+        self.max_symbols = max_symbols
+        self.books = {}
+        self._lock = threading.Lock()
+        # Snapshots are taken off the stream thread so one slow snapshot doesn't hold up every stream
+        self._snapshot_executor = ThreadPoolExecutor(max_workers=4)
+
+    # Returns the top (bids, asks) as lists of (price, quantity) along with when the book last had an update applied,
+    # or None if the local book can't answer (yet)
+    def levels(self, symbol, num_levels):
+        if num_levels > self.snapshot_levels:
+            depth_stream_reads_metric.labels(result="too_deep").inc()
+            return None
+        local_order_book = self.books.get(symbol)
+        if local_order_book is None:
+            self._subscribe(symbol)
+            depth_stream_reads_metric.labels(result="subscribing").inc()
+            return None
+        levels = local_order_book.levels(num_levels)
+        if levels is None:
+            result = "syncing"
+        elif fetch_time() - levels[2] >= STREAM_STALE_S:
+            result = "stale"
+            levels = None
+        else:
+            result = "served"
+        depth_stream_reads_metric.labels(result=result).inc()
+        return levels
+
+    def _subscribe(self, symbol):
+        # Twisted is only pulled in once streaming is actually used
+        from sidd.binance.connector.streams import (
+            get_stream_client,
+            next_subscription_id,
+        )
+
+        with self._lock:
+            if symbol in self.books or len(self.books) >= self.max_symbols:
+                return
+            local_order_book = LocalOrderBook(
+                symbol, self.snapshot_levels, self._snapshot_executor
+            )
+            self.books[symbol] = local_order_book
+            depth_stream_symbols_metric.set(len(self.books))
+        get_stream_client().diff_book_depth(
+            symbol, next_subscription_id(), STREAM_SPEED_MS, local_order_book.on_event
+        )
+        local_order_book.resync()
+
+
+class LocalOrderBook:
+    def __init__(self, symbol, snapshot_levels, snapshot_executor):
+        self.symbol = symbol
+        self.snapshot_levels = snapshot_levels
+        self.synced = False
+        self.last_update_id = None
+        # When the last stream update was applied. Snapshots don't count, as they say nothing about the stream.
+        self.updated_at = None
+        self._bids = _BookSide(descending=True, max_levels=2 * snapshot_levels)
+        self._asks = _BookSide(descending=False, max_levels=2 * snapshot_levels)
+        self._buffer = []
+        self._resyncing = False
+        self._lock = threading.Lock()
+        self._snapshot_executor = snapshot_executor
+
+    def on_event(self, event):
+        if event.get("e") == "error":
+            logging.error(f"Depth stream for {self.symbol} failed: {event}.")
+            with self._lock:
+                self.synced = False
+            return
+        if event.get("e") != "depthUpdate":
+            # e.g. the response to our subscription request
+            return
+        with self._lock:
+            if not self.synced:
+                self._buffer.append(event)
+            elif event["u"] <= self.last_update_id:
+                return
+            elif event["U"] > self.last_update_id + 1:
+                logging.warning(
+                    f"Gap in depth stream for {self.symbol} after update {self.last_update_id}, resyncing."
+                )
+                self._start_resync()
+                self._buffer.append(event)
+            else:
+                self._apply(event)
+
+    def levels(self, num_levels):
+        with self._lock:
+            if not self.synced:
+                self._start_resync()
+                return None
+            if self.updated_at is None:
+                # Synced from a snapshot, but the stream hasn't vouched for it yet
+                return None
+            return (
+                self._bids.top(num_levels),
+                self._asks.top(num_levels),
+                self.updated_at,
+            )
+
+    def resync(self):
+        with self._lock:
+            self._start_resync()
+
+    def _start_resync(self, delay_s=0):
+        self.synced = False
+        if self._resyncing:
+            return
+        self._resyncing = True
+        self._buffer = []
+        depth_stream_resyncs_metric.inc()
+        self._snapshot_executor.submit(self._bootstrap, delay_s)
+
+    def _bootstrap(self, delay_s=0):
+        sleep(delay_s)
+        try:
+            with request_priority(BACKGROUND):
+                raw_depth = get_client().depth(self.symbol, limit=self.snapshot_levels)
+        except Exception:
+            logging.exception(f"Failed to snapshot order book for {self.symbol}.")
+            with self._lock:
+                self._resyncing = False
+            return
+        with self._lock:
+            self._resyncing = False
+            self._bids.reset(raw_depth["bids"])
+            self._asks.reset(raw_depth["asks"])
+            self.last_update_id = raw_depth["lastUpdateId"]
+            self.updated_at = None
+            buffered_events, self._buffer = self._buffer, []
+            for event in buffered_events:
+                if event["u"] <= self.last_update_id:
+                    continue
+                if event["U"] > self.last_update_id + 1:
+                    # The snapshot is older than anything we still have buffered
+                    self._start_resync(STALE_SNAPSHOT_RETRY_S)
+                    return
+                self._apply(event)
+            self.synced = True
+
+    def _apply(self, event):
+        for (price, quantity) in event["b"]:
+            self._bids.update(Decimal(price), Decimal(quantity))
+        for (price, quantity) in event["a"]:
+            self._asks.update(Decimal(price), Decimal(quantity))
+        self.last_update_id = event["u"]
+        self.updated_at = fetch_time()
+
+
+# One side of a local order book. Prices are kept sorted best first (bids are stored negated), so reading the top
+# levels is a slice.
+class _BookSide:
+    def __init__(self, descending, max_levels):
+        self.descending = descending
+        self.max_levels = max_levels
+        self.quantities = {}
+        self.sort_keys = []
+
+    def reset(self, raw_levels):
+        self.quantities = {
+            Decimal(price): Decimal(quantity) for (price, quantity) in raw_levels
+        }
+        self.sort_keys = sorted(self._sort_key(price) for price in self.quantities)
+
+    def update(self, price, quantity):
+        sort_key = self._sort_key(price)
+        if quantity == 0:
+            if self.quantities.pop(price, None) is not None:
+                del self.sort_keys[bisect_left(self.sort_keys, sort_key)]
+            return
+        if price not in self.quantities:
+            insort(self.sort_keys, sort_key)
+            # Levels far from the top were never in the snapshot and can't be trusted anyway
+            if len(self.sort_keys) > self.max_levels:
+                evicted_price = self._sort_key(self.sort_keys.pop())
+                if evicted_price == price:
+                    return
+                del self.quantities[evicted_price]
+        self.quantities[price] = quantity
+
+    def top(self, num_levels):
+        return [
+            (price, self.quantities[price])
+            for price in map(self._sort_key, self.sort_keys[:num_levels])
+        ]
+
+    def _sort_key(self, price):
+        return -price if self.descending else price
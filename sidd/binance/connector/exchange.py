@@ -1,39 +1,113 @@
+import logging
+import os
+import threading
 from collections import defaultdict
+from time import perf_counter
 
-from sidd.binance.connector.clientadapter import SafeClient
+from prometheus_client import Counter, Histogram
+
+from sidd.binance.connector.clientadapter import get_client
 from sidd.binance.connector.orderbook import OrderBookCache
+from sidd.binance.connector.ratelimit import BACKGROUND, request_priority
+from sidd.binance.connector.snapshot import MarketSnapshotCache
+from sidd.binance.connector.staleness import ANY_AGE, StalenessBudget
 from sidd.binance.connector.ticker24hr import Ticker24HrCache
+from sidd.binance.profiling import stage_timer
+
+# How long the symbol/base/quote indexes are trusted before being rebuilt in the background
+EXCHANGE_INFO_TTL_S = float(os.environ.get("BINANCE_EXCHANGE_INFO_TTL_S", 300))
+
+exchange_lookups_metric = Counter(
+    "exchange_registry_lookups",
+    "Lookups of the process-wide exchange registry",
+    ["result"],
+)
+exchange_refresh_latency_metric = Histogram(
+    "exchange_info_refresh_seconds",
+    "Time taken to download and index exchange info",
+)
+exchange_refresh_failures_metric = Counter(
+    "exchange_info_refresh_failures", "Failed background exchange info refreshes"
+)
+fetch_exchange_info_stage = stage_timer("fetch_exchange_info")
+index_exchange_info_stage = stage_timer("index_exchange_info")
+
+_exchange = None
+_exchange_lock = threading.Lock()
 
 
 def get_exchange():
-    return IndexedExchangeInfo()
+    global _exchange
+    exchange = _exchange
+    if exchange is None:
+        with _exchange_lock:
+            if _exchange is None:
+                exchange_lookups_metric.labels(result="miss").inc()
+                _exchange = IndexedExchangeInfo()
+                ExchangeRefreshThread(_exchange).start()
+                return _exchange
+            exchange = _exchange
+    exchange_lookups_metric.labels(result="hit").inc()
+    return exchange
+
+
+# Keeps the process-wide exchange indexes up to date without making any caller wait on exchange_info
+class ExchangeRefreshThread(threading.Thread):
+    def __init__(self, exchange, ttl_s=EXCHANGE_INFO_TTL_S):
+        super().__init__(daemon=True)
+        self.exchange = exchange
+        self.ttl_s = ttl_s
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.ttl_s):
+            try:
+                with request_priority(BACKGROUND):
+                    self.exchange.refresh()
+            except Exception:
+                exchange_refresh_failures_metric.inc()
+                logging.exception(
+                    "Failed to refresh exchange info, keeping the previous index."
+                )
+
+    def stop(self):
+        self._stopped.set()
 
 
 class IndexedExchangeInfo:
     def __init__(self):
-        client = SafeClient()
-        raw_exchange_info = client.exchange_info()
-        self._symbol_index = dict()
-        self._base_asset_index = defaultdict(list)
-        self._quote_asset_index = defaultdict(list)
-        for raw_symbol_info in raw_exchange_info["symbols"]:
-            symbol_info = SymbolData(raw_symbol_info, self)
-            self._symbol_index[symbol_info.symbol] = symbol_info
-            self._base_asset_index[symbol_info.base_asset].append(symbol_info)
-            self._quote_asset_index[symbol_info.quote_asset].append(symbol_info)
-
+        self._index = None
         self.ticker_24hr_service = Ticker24HrCache()
         self.order_book_service = OrderBookCache()
+        self.market_snapshot_service = MarketSnapshotCache(self.ticker_24hr_service)
+        self.refresh()
+
+    def refresh(self):
+        start = perf_counter()
+        client = get_client()
+        with fetch_exchange_info_stage.time():
+            # Exchange info as recent as the indexes are trusted for, which processes sharing market data may
+            # already have fetched
+            (_, raw_exchange_info) = client.query_within(
+                "/api/v3/exchangeInfo", None, StalenessBudget(EXCHANGE_INFO_TTL_S)
+            )
+        # The new index is built off to the side and swapped in with a single assignment, so readers on other
+        # threads only ever see a complete index
+        with index_exchange_info_stage.time():
+            self._index = _ExchangeIndex(raw_exchange_info, self)
+        client.scheduler.configure(raw_exchange_info.get("rateLimits", []))
+        exchange_refresh_latency_metric.observe(perf_counter() - start)
 
     def symbols(self, quote_assets=None, base_assets=None):
+        index = self._index
         quote_asset_filtered_symbols = set(
             [
                 symbol_data
                 for quote_asset in quote_assets
-                for symbol_data in self._quote_asset_index[quote_asset]
+                for symbol_data in index.quote_asset_index.get(quote_asset, [])
             ]
             if quote_assets is not None
-            else self._symbol_index.values()
+            else index.symbol_index.values()
         )
         if len(quote_asset_filtered_symbols) == 0:
             raise ValueError(
@@ -43,10 +117,10 @@ class IndexedExchangeInfo:
             [
                 symbol_data
                 for base_asset in base_assets
-                for symbol_data in self._base_asset_index[base_asset]
+                for symbol_data in index.base_asset_index.get(base_asset, [])
             ]
             if base_assets is not None
-            else self._symbol_index.values()
+            else index.symbol_index.values()
         )
         if len(base_asset_filtered_symbols) == 0:
             raise ValueError(
@@ -54,11 +128,54 @@ class IndexedExchangeInfo:
             )
         return list(quote_asset_filtered_symbols & base_asset_filtered_symbols)
 
+    # Symbols keyed by their base or quote asset
+    def symbols_by_asset(self, group_by):
+        if group_by == "base_asset":
+            return self._base_asset_index
+        if group_by == "quote_asset":
+            return self._quote_asset_index
+        raise ValueError(f'Symbols can\'t be grouped by "{group_by}".')
+
+    # Columnar snapshot of every symbol with tickers satisfying the budget
+    def market_snapshot(self, budget=ANY_AGE):
+        return self.market_snapshot_service.get(self._index.symbol_index, budget)
+
+    async def market_snapshot_async(self, budget=ANY_AGE, account=None):
+        index = self._index
+        await self.ticker_24hr_service.refresh_async(
+            index.symbol_index, budget, account
+        )
+        # Every ticker now satisfies the budget, so this doesn't fetch anything
+        return self.market_snapshot_service.get(index.symbol_index, budget)
+
+    @property
+    def _base_asset_index(self):
+        return self._index.base_asset_index
+
+    @property
+    def _quote_asset_index(self):
+        return self._index.quote_asset_index
+
     def __getitem__(self, symbol):
-        return self._symbol_index[symbol]
+        return self._index.symbol_index[symbol]
 
     def __repr__(self):
-        return str(self._symbol_index.items())
+        return str(self._index.symbol_index.items())
+
+
+# Immutable once built. IndexedExchangeInfo swaps whole instances of this on refresh.
+class _ExchangeIndex:
+    def __init__(self, raw_exchange_info, exchange):
+        self.symbol_index = dict()
+        base_asset_index = defaultdict(list)
+        quote_asset_index = defaultdict(list)
+        for raw_symbol_info in raw_exchange_info["symbols"]:
+            symbol_info = SymbolData(raw_symbol_info, exchange)
+            self.symbol_index[symbol_info.symbol] = symbol_info
+            base_asset_index[symbol_info.base_asset].append(symbol_info)
+            quote_asset_index[symbol_info.quote_asset].append(symbol_info)
+        self.base_asset_index = dict(base_asset_index)
+        self.quote_asset_index = dict(quote_asset_index)
 
 
 class SymbolData:
@@ -68,13 +185,13 @@ class SymbolData:
         self.quote_asset = raw_symbol_data["quoteAsset"]
         self.exchange = exchange
 
-    def depth(self, num_levels=100, cached=True):
+    def depth(self, num_levels=100, budget=ANY_AGE):
         return self.exchange.order_book_service.get(
-            self.symbol, num_levels, cached=cached
+            self.symbol, num_levels, budget=budget
         )
 
-    def ticker_24hr(self, cached=True, bulk_request=False):
-        return self.exchange.ticker_24hr_service.get(self.symbol, cached, bulk_request)
+    def ticker_24hr(self, budget=ANY_AGE, bulk_request=False):
+        return self.exchange.ticker_24hr_service.get(self.symbol, budget, bulk_request)
 
     def __hash__(self):
         return hash(self.symbol)
@@ -0,0 +1,129 @@
+import random
+import threading
+from collections import deque
+from time import monotonic
+
+from prometheus_client import Counter, Gauge
+
+# Number of recent request latencies kept per host for percentiles
+LATENCY_WINDOW = 200
+# Weight given to the newest latency sample in a host's moving average
+LATENCY_EWMA_ALPHA = 0.2
+# A host is ejected after this many consecutive failures...
+MAX_CONSECUTIVE_FAILURES = 3
+# ...or once it is this many times slower than the fastest healthy host
+SLOW_HOST_FACTOR = 3
+# Samples a host needs before it can be considered slow
+MIN_SAMPLES_FOR_SLOW = 20
+EJECTION_S = 30
+
+host_healthy_metric = Gauge(
+    "binance_host_healthy", "Whether a Binance host is taking requests", ["host"]
+)
+host_latency_metric = Gauge(
+    "binance_host_latency_seconds",
+    "Recent request latency to a Binance host",
+    ["host", "quantile"],
+)
+host_requests_metric = Counter(
+    "binance_host_requests", "Requests sent to a Binance host", ["host", "result"]
+)
+host_ejections_metric = Counter(
+    "binance_host_ejections", "Times a Binance host was ejected", ["host", "reason"]
+)
+
+
+class HostState:
+    def __init__(self, url):
+        self.url = url
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.latency_ewma = None
+        self.consecutive_failures = 0
+        self.ejected_until = 0
+        host_healthy_metric.labels(host=url).set_function(
+            lambda: 0 if self.is_ejected() else 1
+        )
+        for quantile in [0.5, 0.99]:
+            host_latency_metric.labels(host=url, quantile=str(quantile)).set_function(
+                lambda quantile=quantile: self.latency_percentile(quantile) or 0
+            )
+
+    def is_ejected(self, now=None):
+        return (monotonic() if now is None else now) < self.ejected_until
+
+    def latency_percentile(self, quantile):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(quantile * len(latencies)))]
+
+    def __repr__(self):
+        return f"<{self.url} ewma={self.latency_ewma} failures={self.consecutive_failures}>"
+
+
+# Spreads requests over a set of equivalent hosts. Each request goes to the faster of two randomly chosen healthy
+# hosts, which keeps load spread out while steering away from slow hosts. Hosts that keep failing or fall far behind
+# the others are ejected for a while and come back with a clean slate.
+class HostPool:
+    def __init__(self, urls):
+        self.hosts = [HostState(url) for url in urls]
+        self._lock = threading.Lock()
+
+    def choose(self, exclude=()):
+        now = monotonic()
+        candidates = [host for host in self.hosts if host not in exclude]
+        if not candidates:
+            return None
+        healthy_hosts = [host for host in candidates if not host.is_ejected(now)]
+        if not healthy_hosts:
+            # Everything is ejected. Better to try the host that has been out the longest than to fail outright.
+            return min(candidates, key=lambda host: host.ejected_until)
+        if len(healthy_hosts) == 1:
+            return healthy_hosts[0]
+        return min(random.sample(healthy_hosts, 2), key=_expected_latency)
+
+    def record_success(self, host, latency_s):
+        host_requests_metric.labels(host=host.url, result="success").inc()
+        with self._lock:
+            host.latencies.append(latency_s)
+            host.latency_ewma = (
+                latency_s
+                if host.latency_ewma is None
+                else LATENCY_EWMA_ALPHA * latency_s
+                + (1 - LATENCY_EWMA_ALPHA) * host.latency_ewma
+            )
+            host.consecutive_failures = 0
+            if len(host.latencies) >= MIN_SAMPLES_FOR_SLOW and self._is_slow(host):
+                self._eject(host, "slow")
+
+    def record_failure(self, host):
+        host_requests_metric.labels(host=host.url, result="failure").inc()
+        with self._lock:
+            host.consecutive_failures += 1
+            if host.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                self._eject(host, "failures")
+
+    def _is_slow(self, host):
+        now = monotonic()
+        other_latencies = [
+            other_host.latency_ewma
+            for other_host in self.hosts
+            if other_host is not host
+            and other_host.latency_ewma is not None
+            and not other_host.is_ejected(now)
+        ]
+        return bool(other_latencies) and host.latency_ewma > SLOW_HOST_FACTOR * min(
+            other_latencies
+        )
+
+    def _eject(self, host, reason):
+        host_ejections_metric.labels(host=host.url, reason=reason).inc()
+        host.ejected_until = monotonic() + EJECTION_S
+        host.latencies.clear()
+        host.latency_ewma = None
+        host.consecutive_failures = 0
+
+
+# Hosts we know nothing about yet are tried first so they get a chance to prove themselves
+def _expected_latency(host):
+    return 0 if host.latency_ewma is None else host.latency_ewma
@@ -1,49 +1,214 @@
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+from itertools import accumulate, chain, islice
+from operator import mul
 
-from sidd.binance.connector.clientadapter import SafeClient
+from sidd.binance.connector.clientadapter import (
+    POOL_SIZE,
+    WARNING_THRESHOLD,
+    get_client,
+)
+from sidd.binance.connector.depthstream import DepthStreams
+from sidd.binance.connector.ratelimit import (
+    current_priority,
+    current_weight_account,
+    depth_weight,
+    request_priority,
+    weight_account,
+)
+from sidd.binance.connector.staleness import ANY_AGE, fetch_time
+from sidd.binance.profiling import stage_timer
 
 REPR_LIMIT = 5
+# Binance quotes prices and quantities with 8 decimal places, so they are stored as integer multiples of 10^-8
+SCALE_DIGITS = 8
 VALID_NUM_LEVELS = [5, 10, 20, 50, 100, 500, 1000, 5000]
+# Upper bound on the number of price levels (per side) kept across all cached order books. Least recently used
+# books are evicted first.
+ORDER_BOOK_CACHE_MAX_LEVELS = int(
+    os.environ.get("BINANCE_ORDER_BOOK_CACHE_MAX_LEVELS", 250000)
+)
+# Most order books fetched at once when prefetching. Fewer are fetched at once when little API weight remains.
+PREFETCH_MAX_WORKERS = int(os.environ.get("BINANCE_PREFETCH_MAX_WORKERS", POOL_SIZE))
+# Serve order books from local books maintained off Binance's diff depth streams instead of REST snapshots
+STREAMING = os.environ.get("BINANCE_ORDER_BOOK_STREAMING", "").lower() in [
+    "1",
+    "true",
+    "yes",
+]
+
+fetch_depth_stage = stage_timer("fetch_depth")
+parse_depth_stage = stage_timer("parse_depth")
 
 
 class OrderBookCache:
-    def __init__(self):
-        self.cache = {}
-
-    def get(self, symbol, num_levels, cached=True):
-        if not (
-            cached
-            and symbol in self.cache
-            and self.cache[symbol].num_levels >= num_levels
-        ):
-            self.fetch(symbol, num_levels)
-        return self.cache[symbol].with_num_levels(num_levels)
-
-    def fetch(self, symbol, num_levels):
-        client = SafeClient()
-        if num_levels > VALID_NUM_LEVELS[-1]:
-            raise ValueError(
-                f"Given {num_levels} levels for order book request, but only up to {VALID_NUM_LEVELS[-1]} are allowed."
+    def __init__(self, max_levels=ORDER_BOOK_CACHE_MAX_LEVELS, streaming=STREAMING):
+        self.cache = OrderedDict()
+        self.max_levels = max_levels
+        self._cached_levels = 0
+        self._lock = threading.Lock()
+        self.depth_streams = DepthStreams() if streaming else None
+
+    def get(self, symbol, num_levels, budget=ANY_AGE):
+        order_book = self._lookup(symbol, num_levels, budget)
+        if order_book is None:
+            order_book = self.fetch(symbol, num_levels, budget)
+        return order_book.with_num_levels(num_levels)
+
+    def prefetch(self, symbols, num_levels, budget=ANY_AGE):
+        missing_symbols = [
+            symbol
+            for symbol in symbols
+            if self._lookup(symbol, num_levels, budget) is None
+        ]
+        if not missing_symbols:
+            return
+        max_workers = _max_concurrent_fetches(len(missing_symbols), num_levels)
+        # Pool threads don't inherit the caller's thread-local request priority or weight account
+        priority = current_priority()
+        account = current_weight_account()
+
+        def fetch_with_priority(symbol):
+            with request_priority(priority), weight_account(account):
+                return self.fetch(symbol, num_levels, budget)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(fetch_with_priority, missing_symbols))
+
+    # Most order books of num_levels to prefetch at once, so that they're still cached when they're read. Half of what
+    # the cache holds, leaving room for the books of other queries.
+    def batch_size(self, num_levels):
+        return max(1, self.max_levels // (2 * _request_num_levels(num_levels)))
+
+    async def prefetch_async(self, symbols, num_levels, budget=ANY_AGE, account=None):
+        missing_symbols = [
+            symbol
+            for symbol in symbols
+            if self._lookup(symbol, num_levels, budget) is None
+        ]
+        if not missing_symbols:
+            return
+        max_fetches = asyncio.Semaphore(
+            _max_concurrent_fetches(len(missing_symbols), num_levels)
+        )
+
+        async def fetch_when_allowed(symbol):
+            async with max_fetches:
+                await self.fetch_async(symbol, num_levels, budget, account)
+
+        await asyncio.gather(
+            *[fetch_when_allowed(symbol) for symbol in missing_symbols]
+        )
+
+    # The budget is one the fetched order book must satisfy, which any order book fetched now does. Clients sharing
+    # market data between processes may find one that another process fetched.
+    def fetch(self, symbol, num_levels, budget=None):
+        client = get_client()
+        num_levels = _request_num_levels(num_levels)
+        with fetch_depth_stage.time():
+            (fetched_at, raw_depth) = client.query_within(
+                "/api/v3/depth", {"symbol": symbol, "limit": num_levels}, budget
+            )
+        with parse_depth_stage.time():
+            order_book = OrderBook.from_raw_input(raw_depth, num_levels, fetched_at)
+        self._store(symbol, order_book)
+        return order_book
+
+    async def fetch_async(self, symbol, num_levels, budget=None, account=None):
+        # Only imported by servers running on asyncio
+        from sidd.binance.connector.asyncclient import get_async_client
+
+        num_levels = _request_num_levels(num_levels)
+        with fetch_depth_stage.time():
+            (fetched_at, raw_depth) = await get_async_client().query_within(
+                "/api/v3/depth",
+                {"symbol": symbol, "limit": num_levels},
+                budget,
+                account,
             )
-        num_levels = list(
-            filter(lambda valid_level: valid_level >= num_levels, VALID_NUM_LEVELS)
-        )[0]
-        raw_depth = client.depth(symbol, limit=num_levels)
-        self.cache[symbol] = OrderBook.from_raw_input(raw_depth, num_levels)
+        with parse_depth_stage.time():
+            order_book = OrderBook.from_raw_input(raw_depth, num_levels, fetched_at)
+        self._store(symbol, order_book)
+        return order_book
+
+    def _lookup(self, symbol, num_levels, budget):
+        if self.depth_streams is not None:
+            levels = self.depth_streams.levels(symbol, num_levels)
+            if levels is not None and budget.allows(levels[2]):
+                return OrderBook.from_levels(*levels, num_levels)
+        with self._lock:
+            order_book = self.cache.get(symbol)
+            if order_book is not None:
+                self.cache.move_to_end(symbol)
+        if (
+            order_book is not None
+            and order_book.num_levels >= num_levels
+            and budget.allows(order_book.fetched_at)
+        ):
+            return order_book
+        return None
+
+    def _store(self, symbol, order_book):
+        with self._lock:
+            previous_order_book = self.cache.pop(symbol, None)
+            if previous_order_book is not None:
+                self._cached_levels -= previous_order_book.num_levels
+            self.cache[symbol] = order_book
+            self._cached_levels += order_book.num_levels
+            while self._cached_levels > self.max_levels and len(self.cache) > 1:
+                _, evicted_order_book = self.cache.popitem(last=False)
+                self._cached_levels -= evicted_order_book.num_levels
+
+
+# Smallest number of levels Binance serves that covers num_levels
+def _request_num_levels(num_levels):
+    if num_levels > VALID_NUM_LEVELS[-1]:
+        raise ValueError(
+            f"Given {num_levels} levels for order book request, but only up to {VALID_NUM_LEVELS[-1]} are allowed."
+        )
+    return list(
+        filter(lambda valid_level: valid_level >= num_levels, VALID_NUM_LEVELS)
+    )[0]
+
+
+# Keeps concurrent requests from spending the API weight we would like to hold in reserve
+def _max_concurrent_fetches(num_fetches, num_levels):
+    client = get_client()
+    spare_weight = client.remaining_weight() - client.scheduler.limit * (
+        1 - WARNING_THRESHOLD
+    )
+    affordable_fetches = int(spare_weight // depth_weight(num_levels))
+    return max(1, min(PREFETCH_MAX_WORKERS, num_fetches, affordable_fetches))
 
 
 class OrderBook:
-    def __init__(self, bids, asks, num_levels):
+    def __init__(self, bids, asks, num_levels, fetched_at=None):
         self.bids = bids
         self.asks = asks
         self.num_levels = num_levels
+        self.fetched_at = fetch_time() if fetched_at is None else fetched_at
+
+    @classmethod
+    def from_raw_input(cls, raw_depth, num_levels, fetched_at=None):
+        return OrderBook(
+            BookSide.from_raw_input(raw_depth["bids"], descending=True),
+            BookSide.from_raw_input(raw_depth["asks"], descending=False),
+            num_levels,
+            fetched_at,
+        )
 
     @classmethod
-    def from_raw_input(cls, raw_depth, num_levels):
+    # Order book of a local streamed book, as of its last update
+    def from_levels(cls, bids, asks, updated_at, num_levels):
         return OrderBook(
-            [Order(raw_bid) for raw_bid in raw_depth["bids"]],
-            [Order(raw_ask) for raw_ask in raw_depth["asks"]],
+            BookSide.from_raw_input(bids, descending=True),
+            BookSide.from_raw_input(asks, descending=False),
             num_levels,
+            updated_at,
         )
 
     def with_num_levels(self, num_levels):
@@ -51,13 +216,65 @@ class OrderBook:
             raise IndexError(
                 f"Requested {num_levels} from this order book, but only {self.num_levels} exist."
             )
-        return OrderBook(self.bids[:num_levels], self.asks[:num_levels], num_levels)
+        return OrderBook(
+            self.bids.with_num_levels(num_levels),
+            self.asks.with_num_levels(num_levels),
+            num_levels,
+            self.fetched_at,
+        )
 
     def total_notional_value_of_bids(self):
-        return _total_notional_value_of_side(self.bids)
+        return self.bids.total_notional_value()
 
     def total_notional_value_of_asks(self):
-        return _total_notional_value_of_side(self.asks)
+        return self.asks.total_notional_value()
+
+    def mid_price(self):
+        if not self.bids or not self.asks:
+            return None
+        return (self.bids.best_price() + self.asks.best_price()) / 2
+
+    # Notional value of the bids priced at least mid * (1 - bps / 10000)
+    def notional_value_of_bids_within_bps(self, bps):
+        mid_price = self.mid_price()
+        if mid_price is None:
+            return 0
+        return self.bids.total_notional_value_within(
+            mid_price * (1 - Decimal(bps) / 10000)
+        )
+
+    # Notional value of the asks priced at most mid * (1 + bps / 10000)
+    def notional_value_of_asks_within_bps(self, bps):
+        mid_price = self.mid_price()
+        if mid_price is None:
+            return 0
+        return self.asks.total_notional_value_within(
+            mid_price * (1 + Decimal(bps) / 10000)
+        )
+
+    # Quantity that has to be sold into the bids to push the best bid down by the given percentage
+    def quantity_to_move_bids(self, percent):
+        if not self.bids:
+            return 0
+        return self.bids.total_quantity_before(
+            self.bids.best_price() * (1 - Decimal(percent) / 100)
+        )
+
+    # Quantity that has to be bought from the asks to push the best ask up by the given percentage
+    def quantity_to_move_asks(self, percent):
+        if not self.asks:
+            return 0
+        return self.asks.total_quantity_before(
+            self.asks.best_price() * (1 + Decimal(percent) / 100)
+        )
+
+    # Average price of selling the given quantity into the bids, or None if the book isn't deep enough
+    def vwap_to_sell(self, quantity):
+        return self.bids.vwap(quantity)
+
+    # Average price of buying the given quantity from the asks, or None if the book isn't deep enough
+    def vwap_to_buy(self, quantity):
+        return self.asks.vwap(quantity)
 
     def __repr__(self):
         bids_repr = self.bids[:REPR_LIMIT]
@@ -67,6 +284,185 @@ class OrderBook:
         return f"<bids={bids_repr}{bids_truncated} asks={asks_repr}{asks_truncated}>"
 
 
+# One side of an order book, stored as columns of fixed-point integers (value * 10^SCALE_DIGITS) rather than an
+# Order object per level. Sides cut down with with_num_levels share their columns with the side they came from,
+# including the cumulative quantity and notional values, which are computed at most once per snapshot. Levels are
+# ordered best first, so questions about price bands and fill sizes are searches over those prefix sums, starting
+# from the top so that only the levels near the answer are ever decoded.
+class BookSide:
+    def __init__(self, columns, descending, num_levels=None):
+        self._columns = columns
+        self.descending = descending
+        self.num_levels = (
+            columns.num_levels
+            if num_levels is None
+            else min(num_levels, columns.num_levels)
+        )
+
+    @classmethod
+    def from_raw_input(cls, raw_levels, descending):
+        return BookSide(_Columns(raw_levels), descending)
+
+    def with_num_levels(self, num_levels):
+        return BookSide(
+            self._columns, self.descending, min(num_levels, self.num_levels)
+        )
+
+    def best_price(self):
+        self._columns.decode(1)
+        return _from_fixed(self._columns.prices[0], SCALE_DIGITS)
+
+    def total_notional_value(self, num_levels=None):
+        num_levels = self.num_levels if num_levels is None else num_levels
+        if num_levels == 0:
+            return 0
+        cumulative_notional = self._columns.cumulative_notional(num_levels)
+        return _from_fixed(cumulative_notional[num_levels], 2 * SCALE_DIGITS)
+
+    def total_quantity(self, num_levels=None):
+        num_levels = self.num_levels if num_levels is None else num_levels
+        if num_levels == 0:
+            return 0
+        cumulative_quantity = self._columns.cumulative_quantity(num_levels)
+        return _from_fixed(cumulative_quantity[num_levels], SCALE_DIGITS)
+
+    # Notional value of the levels priced at the given price or better
+    def total_notional_value_within(self, price):
+        return self.total_notional_value(self._num_levels_within(price, True))
+
+    # Quantity of the levels priced strictly better than the given price
+    def total_quantity_before(self, price):
+        return self.total_quantity(self._num_levels_within(price, False))
+
+    def vwap(self, quantity):
+        fixed_quantity = _to_fixed(quantity)
+        if fixed_quantity <= 0:
+            return None
+        columns = self._columns
+        # Index of the first level that fills the given quantity, counting from 1
+        filled_at = 1 + _prefix_length(
+            lambda level: columns.cumulative_quantity(level + 1)[level + 1]
+            < fixed_quantity,
+            self.num_levels,
+        )
+        if filled_at > self.num_levels:
+            return None
+        cumulative_quantity = columns.cumulative_quantity(filled_at)
+        cumulative_notional = columns.cumulative_notional(filled_at)
+        fixed_notional = (
+            cumulative_notional[filled_at - 1]
+            + (fixed_quantity - cumulative_quantity[filled_at - 1])
+            * self._columns.prices[filled_at - 1]
+        )
+        return Decimal(fixed_notional) / Decimal(fixed_quantity).scaleb(SCALE_DIGITS)
+
+    # Number of levels from the top priced better than (or, if inclusive, at) the given price
+    def _num_levels_within(self, price, inclusive):
+        fixed_price = Decimal(price).scaleb(SCALE_DIGITS)
+        columns = self._columns
+
+        def is_within(level):
+            columns.decode(level + 1)
+            return self._is_within(columns.prices[level], fixed_price, inclusive)
+
+        return _prefix_length(is_within, self.num_levels)
+
+    def _is_within(self, fixed_level_price, fixed_price, inclusive):
+        if fixed_level_price == fixed_price:
+            return inclusive
+        return (fixed_level_price > fixed_price) == self.descending
+
+    def __len__(self):
+        return self.num_levels
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.num_levels))]
+        if index < 0:
+            index += self.num_levels
+        if not 0 <= index < self.num_levels:
+            raise IndexError(f"Level {index} is out of range.")
+        self._columns.decode(index + 1)
+        return Order(
+            (
+                _from_fixed(self._columns.prices[index], SCALE_DIGITS),
+                _from_fixed(self._columns.quantities[index], SCALE_DIGITS),
+            )
+        )
+
+    def __repr__(self):
+        return str(self[:REPR_LIMIT])
+
+
+# Levels are decoded from the raw [price, quantity] strings only once something reads them, top first, and kept for
+# every later read. A 5000 level snapshot answering a 100 level query never decodes the other 4900. Reads of levels
+# that are already decoded don't take the lock.
+class _Columns:
+    def __init__(self, raw_levels):
+        self.num_levels = len(raw_levels)
+        # Plain lists of ints rather than 64-bit arrays, which overflow for levels of 9.2e10 or more, e.g. the
+        # quantities on books of very low priced assets
+        self.prices = []
+        self.quantities = []
+        # Levels at the top of prices and quantities, which may be appended to before this is bumped
+        self.num_decoded = 0
+        self._raw_levels = raw_levels
+        self._cumulative_notional = [0]
+        self._cumulative_quantity = [0]
+        self._lock = threading.Lock()
+
+    def decode(self, num_levels):
+        if num_levels <= self.num_decoded:
+            return
+        with self._lock:
+            num_decoded = self.num_decoded
+            # Another thread may have decoded these levels, and dropped the raw ones, since the check above
+            if num_levels <= num_decoded:
+                return
+            raw_levels = self._raw_levels[num_decoded:num_levels]
+            self.prices.extend([_to_fixed(price) for (price, _) in raw_levels])
+            self.quantities.extend(
+                [_to_fixed(quantity) for (_, quantity) in raw_levels]
+            )
+            self.num_decoded = num_decoded + len(raw_levels)
+            if self.num_decoded == self.num_levels:
+                self._raw_levels = None
+
+    # Cumulative notional values of the top levels, with at least num_levels + 1 entries
+    def cumulative_notional(self, num_levels):
+        cumulative_notional = self._cumulative_notional
+        if len(cumulative_notional) <= num_levels:
+            self.decode(num_levels)
+            with self._lock:
+                start = len(cumulative_notional) - 1
+                # Products of two fixed-point values overflow 64 bits, so these are kept as arbitrary precision ints
+                cumulative_notional.extend(
+                    _accumulate_from(
+                        cumulative_notional[-1],
+                        map(
+                            mul,
+                            self.prices[start:num_levels],
+                            self.quantities[start:num_levels],
+                        ),
+                    )
+                )
+        return cumulative_notional
+
+    # Cumulative quantities of the top levels, with at least num_levels + 1 entries
+    def cumulative_quantity(self, num_levels):
+        cumulative_quantity = self._cumulative_quantity
+        if len(cumulative_quantity) <= num_levels:
+            self.decode(num_levels)
+            with self._lock:
+                start = len(cumulative_quantity) - 1
+                cumulative_quantity.extend(
+                    _accumulate_from(
+                        cumulative_quantity[-1], self.quantities[start:num_levels]
+                    )
+                )
+        return cumulative_quantity
+
+
 class Order:
     def __init__(self, raw_order):
         self.price = Decimal(raw_order[0])
@@ -79,5 +475,42 @@ class Order:
         return f"<price={self.price} qty={self.quantity}>"
 
 
-def _total_notional_value_of_side(orders):
-    return sum([order.notional_value() for order in orders])
+# Running totals of values, starting from (but not including) initial
+def _accumulate_from(initial, values):
+    return islice(accumulate(chain([initial], values)), 1, None)
+
+
+# Number of levels from the top that satisfy a condition holding for every level down to some depth and none below
+# it. Looks 1, 3, 7, ... levels down before binary searching, so only levels up to about twice that depth are read.
+def _prefix_length(condition, num_levels):
+    # Every level above low satisfies the condition
+    low = 0
+    probe = 0
+    while probe < num_levels and condition(probe):
+        low = probe + 1
+        probe = 2 * probe + 1
+    high = min(probe, num_levels)
+    while low < high:
+        middle = (low + high) // 2
+        if condition(middle):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def _to_fixed(raw_value):
+    raw_value = str(raw_value)
+    whole, _, fraction = raw_value.partition(".")
+    if len(fraction) <= SCALE_DIGITS and "E" not in raw_value.upper():
+        return int(whole + fraction.ljust(SCALE_DIGITS, "0"))
+    scaled_value = Decimal(raw_value).scaleb(SCALE_DIGITS)
+    if scaled_value != scaled_value.to_integral_value():
+        raise ValueError(
+            f"{raw_value} has more than {SCALE_DIGITS} decimal places of precision."
+        )
+    return int(scaled_value)
+
+
+def _from_fixed(fixed_value, scale_digits):
+    return Decimal(fixed_value).scaleb(-scale_digits)
@@ -0,0 +1,246 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+from contextlib import contextmanager
+from time import monotonic
+
+from prometheus_client import Gauge, Histogram
+
+LIMIT = 1200  # Used until the real limit is read from exchange_info's rateLimits
+LIMIT_INTERVAL_S = 60
+RATE_LIMIT_TYPE = "REQUEST_WEIGHT"
+INTERVAL_SECONDS = {"SECOND": 1, "MINUTE": 60, "HOUR": 3600, "DAY": 86400}
+# How long to stop sending requests after a 429/418 that doesn't say how long to wait
+DEFAULT_BACK_OFF_S = 60
+
+# Lower values are scheduled first
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_LABELS = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+# (maximum limit, request weight) pairs for the depth endpoint
+DEPTH_WEIGHTS = [(100, 1), (500, 5), (1000, 10), (5000, 50)]
+# Request weight of each endpoint, as a function of the request payload
+ENDPOINT_WEIGHTS = {
+    "/api/v3/depth": lambda payload: depth_weight(payload.get("limit", 100)),
+    "/api/v3/ticker/24hr": lambda payload: 1 if payload.get("symbol") else 40,
+    "/api/v3/exchangeInfo": lambda payload: 10,
+}
+
+queue_depth_metric = Gauge(
+    "binance_request_queue_depth",
+    "Requests waiting for API weight to become available",
+    ["priority"],
+)
+wait_time_metric = Histogram(
+    "binance_request_wait_seconds",
+    "Time requests spent waiting for API weight",
+    ["priority"],
+)
+available_weight_metric = Gauge(
+    "binance_request_weight_available", "API weight currently available to spend"
+)
+
+_priority = threading.local()
+_weight_account = threading.local()
+
+
+@contextmanager
+def request_priority(priority):
+    previous_priority = current_priority()
+    _priority.value = priority
+    try:
+        yield
+    finally:
+        _priority.value = previous_priority
+
+
+def current_priority():
+    return getattr(_priority, "value", INTERACTIVE)
+
+
+# Charges the weight of requests this thread sends to account, until the block exits
+@contextmanager
+def weight_account(account):
+    previous_account = current_weight_account()
+    _weight_account.value = account
+    try:
+        yield account
+    finally:
+        _weight_account.value = previous_account
+
+
+def current_weight_account():
+    return getattr(_weight_account, "value", None)
+
+
+# API weight spent on behalf of one query, which may be fetching from several threads at once
+class WeightAccount:
+    def __init__(self):
+        self.weight = 0
+        self._lock = threading.Lock()
+
+    def spend(self, weight):
+        with self._lock:
+            self.weight += weight
+
+
+def depth_weight(limit):
+    for (max_limit, weight) in DEPTH_WEIGHTS:
+        if limit <= max_limit:
+            return weight
+    return DEPTH_WEIGHTS[-1][1]
+
+
+def request_weight(url_path, payload=None):
+    weight_function = ENDPOINT_WEIGHTS.get(url_path)
+    return weight_function(payload or {}) if weight_function else 1
+
+
+# Token bucket holding API weight. It refills continuously at limit/interval and is pulled down whenever Binance
+# reports that more weight has been used than we accounted for (e.g. by another process sharing our IP). Waiting
+# requests are served strictly in (priority, arrival) order, so background polling never gets ahead of an
+# interactive query that is already waiting.
+class WeightScheduler:
+    # A time_scale above 1 runs the scheduler that many times faster, e.g. when replaying a recording sped up
+    def __init__(self, limit=LIMIT, interval_s=LIMIT_INTERVAL_S, time_scale=1):
+        self.limit = limit
+        self.time_scale = time_scale
+        self.interval_s = interval_s / time_scale
+        self._tokens = limit
+        self._refilled_at = monotonic()
+        self._paused_until = 0
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def configure(self, rate_limits):
+        for rate_limit in rate_limits:
+            if rate_limit.get("rateLimitType") != RATE_LIMIT_TYPE:
+                continue
+            interval_s = (
+                INTERVAL_SECONDS[rate_limit["interval"]]
+                * rate_limit["intervalNum"]
+                / self.time_scale
+            )
+            with self._condition:
+                self._tokens = min(self._tokens, rate_limit["limit"])
+                self.limit = rate_limit["limit"]
+                self.interval_s = interval_s
+                self._condition.notify_all()
+            logging.info(f"Using API weight limit={self.limit} per {interval_s}s.")
+            return
+
+    def acquire(self, weight, priority=None):
+        priority = current_priority() if priority is None else priority
+        priority_label = PRIORITY_LABELS.get(priority, str(priority))
+        ticket = (priority, next(self._sequence))
+        start = monotonic()
+        queue_depth_metric.labels(priority=priority_label).inc()
+        try:
+            with self._condition:
+                heapq.heappush(self._waiting, ticket)
+                try:
+                    while not self._try_take(ticket, weight):
+                        self._condition.wait(self._time_until_available(weight))
+                finally:
+                    if ticket in self._waiting:
+                        self._waiting.remove(ticket)
+                        heapq.heapify(self._waiting)
+                    self._condition.notify_all()
+        finally:
+            queue_depth_metric.labels(priority=priority_label).dec()
+        wait_time_metric.labels(priority=priority_label).observe(monotonic() - start)
+
+    # Same as acquire, for coroutines. The condition can't be awaited, so waiters poll for their turn instead of
+    # being woken up.
+    async def acquire_async(self, weight, priority=None):
+        priority = current_priority() if priority is None else priority
+        priority_label = PRIORITY_LABELS.get(priority, str(priority))
+        ticket = (priority, next(self._sequence))
+        start = monotonic()
+        queue_depth_metric.labels(priority=priority_label).inc()
+        try:
+            with self._condition:
+                heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    with self._condition:
+                        if self._try_take(ticket, weight):
+                            break
+                        wait_s = self._time_until_available(weight)
+                    await asyncio.sleep(wait_s)
+            finally:
+                with self._condition:
+                    if ticket in self._waiting:
+                        self._waiting.remove(ticket)
+                        heapq.heapify(self._waiting)
+                    self._condition.notify_all()
+        finally:
+            queue_depth_metric.labels(priority=priority_label).dec()
+        wait_time_metric.labels(priority=priority_label).observe(monotonic() - start)
+
+    def try_acquire(self, weight):
+        with self._condition:
+            self._refill()
+            if (
+                self._waiting
+                or monotonic() < self._paused_until
+                or self._tokens < weight
+            ):
+                return False
+            self._tokens -= weight
+            available_weight_metric.set(self._tokens)
+            return True
+
+    def observe_used_weight(self, used_weight):
+        with self._condition:
+            self._refill()
+            self._tokens = min(self._tokens, self.limit - used_weight)
+            available_weight_metric.set(self._tokens)
+
+    def back_off(self, retry_after_s=None):
+        retry_after_s = (
+            DEFAULT_BACK_OFF_S if retry_after_s is None else retry_after_s
+        ) / self.time_scale
+        logging.warning(f"Rate limited by Binance, pausing for {retry_after_s}s.")
+        with self._condition:
+            self._paused_until = max(self._paused_until, monotonic() + retry_after_s)
+            self._tokens = 0
+
+    def available_weight(self):
+        with self._condition:
+            self._refill()
+            return max(0, int(self._tokens))
+
+    def _try_take(self, ticket, weight):
+        self._refill()
+        if self._waiting[0] != ticket or monotonic() < self._paused_until:
+            return False
+        # A request heavier than the whole limit would otherwise never run
+        if self._tokens < min(weight, self.limit):
+            return False
+        heapq.heappop(self._waiting)
+        self._tokens -= weight
+        available_weight_metric.set(self._tokens)
+        return True
+
+    def _time_until_available(self, weight):
+        now = monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        deficit = min(weight, self.limit) - self._tokens
+        # Requests behind the head of the queue are woken whenever it changes
+        return max(deficit, 1) * self.interval_s / self.limit
+
+    def _refill(self):
+        now = monotonic()
+        if now > self._paused_until:
+            refill_from = max(self._refilled_at, self._paused_until)
+            self._tokens = min(
+                self.limit,
+                self._tokens + (now - refill_from) * self.limit / self.interval_s,
+            )
+        self._refilled_at = now
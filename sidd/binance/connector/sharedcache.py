@@ -0,0 +1,247 @@
+import json
+import logging
+import mmap
+import os
+import re
+import socket
+import socketserver
+from time import monotonic, sleep
+
+from binance.error import ClientError
+from binance.lib.utils import cleanNoneValue
+from binance.spot import Spot
+
+from sidd.binance.connector.clientadapter import (
+    get_client,
+    loads_json,
+    spend_weight,
+)
+from sidd.binance.connector.ratelimit import (
+    LIMIT,
+    WeightScheduler,
+    current_weight_account,
+    request_weight,
+)
+from sidd.binance.connector.staleness import StalenessBudget, fetch_time
+from sidd.binance.responsecache import ResponseCache
+
+try:
+    from orjson import dumps as dumps_json
+except ImportError:
+
+    def dumps_json(data):
+        return json.dumps(data, separators=(",", ":")).encode()
+
+
+# Socket in the shared cache directory the fetcher takes requests on
+SOCKET_NAME = "fetcher.sock"
+# How long workers keep trying to reach a fetcher that isn't up yet, e.g. while everything is starting
+FETCHER_CONNECT_TIMEOUT_S = 10
+EXCHANGE_INFO_PATH = "/api/v3/exchangeInfo"
+
+
+# Binance responses published as one file per request, each a JSON line of metadata followed by the response as
+# JSON. Files are replaced whole (written aside and renamed over), so readers never see a partial response, and
+# are read through mmap, so responses are parsed straight out of the page cache that every process shares. Times
+# are time.monotonic(), which every process on the host agrees on.
+class SharedStore:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def publish(self, url_path, payload, fetched_at, data):
+        path = self._path(url_path, payload)
+        partial_path = f"{path}.{os.getpid()}.partial"
+        with open(partial_path, "wb") as partial_file:
+            partial_file.write(dumps_json({"fetched_at": fetched_at}) + b"\n")
+            partial_file.write(dumps_json(data))
+        os.replace(partial_path, path)
+
+    # When the published response to a request was fetched, None if none was
+    def fetched_at(self, url_path, payload):
+        try:
+            with open(self._path(url_path, payload), "rb") as published_file:
+                return json.loads(published_file.readline())["fetched_at"]
+        except FileNotFoundError:
+            return None
+
+    # Returns when the published response to a request was fetched along with the response, None if none was
+    def read(self, url_path, payload):
+        try:
+            published_file = open(self._path(url_path, payload), "rb")
+        except FileNotFoundError:
+            return None
+        with published_file, mmap.mmap(
+            published_file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as published:
+            data_start = published.find(b"\n") + 1
+            fetched_at = json.loads(published[:data_start])["fetched_at"]
+            with memoryview(published) as view, view[data_start:] as data_view:
+                data = loads_json(_loadable(data_view))
+        return fetched_at, data
+
+    # Drops everything published, e.g. by a fetcher that ran before
+    def clear(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if name.endswith(".json") or name.endswith(".partial"):
+                os.remove(os.path.join(self.directory, name))
+
+    def _path(self, url_path, payload):
+        name = "_".join(
+            [url_path.strip("/")]
+            + [f"{key}={value}" for (key, value) in sorted(payload.items())]
+        )
+        return os.path.join(self.directory, re.sub(r"[^\w=.-]", "_", name) + ".json")
+
+
+# Client for worker processes sharing market data through a fetcher. Responses the fetcher already published are
+# used if they satisfy the budget, otherwise the fetcher is asked to fetch (and publish) a fresh one. Only the
+# fetcher spends API weight, so the scheduler here only tracks the limit.
+class SharedClient(Spot):
+    def __init__(self, directory):
+        super().__init__(show_limit_usage=True)
+        self.store = SharedStore(directory)
+        self.socket_path = os.path.join(directory, SOCKET_NAME)
+        self.scheduler = WeightScheduler()
+        # As of the fetcher's last reply
+        self._available_weight = LIMIT
+
+    def query(self, url_path, payload=None):
+        return self.query_within(url_path, payload)[1]
+
+    def query_within(self, url_path, payload=None, budget=None):
+        payload = cleanNoneValue(payload or {})
+        budget = budget or StalenessBudget(0)
+        published = self.store.read(url_path, payload)
+        if published is None or not budget.allows(published[0]):
+            self.handle_reply(url_path, self._request(url_path, payload, budget))
+            published = self.store.read(url_path, payload)
+        return published
+
+    def remaining_weight(self):
+        return self._available_weight
+
+    def _request(self, url_path, payload, budget):
+        request = encode_fetch_request(url_path, payload, budget)
+        deadline = monotonic() + FETCHER_CONNECT_TIMEOUT_S
+        while True:
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as fetcher:
+                    fetcher.connect(self.socket_path)
+                    fetcher.sendall(request)
+                    with fetcher.makefile("rb") as replies:
+                        return json.loads(replies.readline())
+            except (FileNotFoundError, ConnectionRefusedError):
+                if monotonic() > deadline:
+                    raise
+                sleep(0.1)
+
+    def handle_reply(self, url_path, reply, account=None):
+        if "error" in reply:
+            (status_code, error_code, error_message, retry_after) = reply["error"]
+            if status_code is None:
+                raise ConnectionError(f"The fetcher failed to fetch: {error_message}")
+            raise ClientError(
+                status_code,
+                error_code,
+                error_message,
+                {} if retry_after is None else {"Retry-After": retry_after},
+            )
+        self._available_weight = reply["available_weight"]
+        spend_weight(
+            url_path,
+            reply["weight"],
+            current_weight_account() if account is None else account,
+        )
+
+
+# Owns all Binance I/O for the workers sharing a cache directory. Workers ask for a request's response no older than
+# their budget allows, and get it published to the directory, fetched anew unless the published one is recent enough.
+# Identical requests arriving together share one fetch, whose weight is reported to the worker that asked first.
+class MarketDataFetcher:
+    def __init__(self, directory, client=None):
+        self.store = SharedStore(directory)
+        self.socket_path = os.path.join(directory, SOCKET_NAME)
+        self.client = client or get_client()
+        self.flights = ResponseCache(ttl_s=0)
+
+    def serve_forever(self):
+        self.store.clear()
+        # Workers' exchange info refreshes configure their own schedulers, which spend nothing, so the fetcher
+        # learns Binance's rate limits itself before spending any weight on their behalf
+        try:
+            self._fetch(EXCHANGE_INFO_PATH, {})
+        except Exception:
+            logging.exception(
+                "Failed to fetch exchange info, keeping the default rate limits until a worker refreshes it."
+            )
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        fetcher = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                reply = fetcher.handle(json.loads(self.rfile.readline()))
+                self.wfile.write(dumps_json(reply) + b"\n")
+
+        server = _ThreadingUnixStreamServer(self.socket_path, Handler)
+        server.serve_forever()
+
+    def handle(self, request):
+        url_path = request["url_path"]
+        payload = request["payload"]
+        budget = StalenessBudget(request["max_age_s"], request["as_of"])
+        fetched_at = self.store.fetched_at(url_path, payload)
+        # Weight of the fetch made for this request, if any
+        spent = []
+
+        def fetch():
+            self._fetch(url_path, payload)
+            spent.append(request_weight(url_path, payload))
+
+        try:
+            if fetched_at is None or not budget.allows(fetched_at):
+                self.flights.get(
+                    "fetcher", (url_path, tuple(sorted(payload.items()))), fetch
+                )
+        except ClientError as e:
+            retry_after = e.header.get("Retry-After") if e.header else None
+            return {
+                "error": [e.status_code, e.error_code, e.error_message, retry_after]
+            }
+        except Exception as e:
+            return {"error": [None, None, str(e), None]}
+        return {
+            "weight": sum(spent),
+            "available_weight": self.client.remaining_weight(),
+        }
+
+    def _fetch(self, url_path, payload):
+        fetched_at = fetch_time()
+        data = self.client.query(url_path, payload)
+        self.store.publish(url_path, payload, fetched_at, data)
+        if url_path == EXCHANGE_INFO_PATH:
+            self.client.scheduler.configure(data.get("rateLimits", []))
+
+
+def encode_fetch_request(url_path, payload, budget):
+    return (
+        json.dumps(
+            {
+                "url_path": url_path,
+                "payload": payload,
+                "max_age_s": budget.max_age_s,
+                "as_of": budget.as_of,
+            }
+        ).encode()
+        + b"\n"
+    )
+
+
+# orjson parses straight out of the mapped file, json needs its own copy
+def _loadable(view):
+    return view if loads_json is not json.loads else bytes(view)
+
+
+class _ThreadingUnixStreamServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
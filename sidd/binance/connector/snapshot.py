@@ -0,0 +1,89 @@
+from sidd.binance.connector.staleness import ANY_AGE
+from sidd.binance.profiling import stage_timer
+
+# Ticker attributes kept as snapshot columns, next to symbol, base_asset and quote_asset
+TICKER_COLUMNS = ["volume", "trades", "bid_price", "ask_price", "spread"]
+COLUMNS = ["symbol", "base_asset", "quote_asset"] + TICKER_COLUMNS
+
+build_snapshot_stage = stage_timer("build_snapshot")
+
+# Ticker column value that hasn't been read from its ticker yet
+_UNREAD = object()
+
+
+# Every symbol's exchange info and 24 hour ticker at one point in time, stored column by column. Each symbol has an
+# id, its position in every column. Symbols without a ticker (e.g. ones that aren't trading) have None in each ticker
+# column. Ticker columns are filled in as they are read, so that tickers only decode the values queries ask for. Once
+# read, a value stays put even if a streamed ticker changes after.
+class MarketSnapshot:
+    def __init__(self, symbols, columns, tickers_24hr):
+        self.symbols = symbols
+        self.columns = columns
+        self.tickers_24hr = tickers_24hr
+        self.symbol_ids = {
+            symbol: symbol_id for (symbol_id, symbol) in enumerate(symbols)
+        }
+        for column in TICKER_COLUMNS:
+            self.columns[column] = [_UNREAD] * len(symbols)
+
+    @classmethod
+    def from_exchange(cls, symbol_index, tickers_24hr):
+        symbols = list(symbol_index)
+        columns = {
+            "symbol": symbols,
+            "base_asset": [symbol_index[symbol].base_asset for symbol in symbols],
+            "quote_asset": [symbol_index[symbol].quote_asset for symbol in symbols],
+        }
+        return MarketSnapshot(
+            symbols, columns, [tickers_24hr.get(symbol) for symbol in symbols]
+        )
+
+    # Ids of the given symbols, None for symbols this snapshot doesn't know about
+    def ids(self, symbols):
+        symbol_ids = self.symbol_ids
+        return [symbol_ids.get(symbol) for symbol in symbols]
+
+    # Values of a column for the given ids
+    def take(self, column, symbol_ids):
+        values = self.columns[column]
+        taken_values = [
+            None if symbol_id is None else values[symbol_id] for symbol_id in symbol_ids
+        ]
+        if column in TICKER_COLUMNS:
+            for (position, value) in enumerate(taken_values):
+                if value is _UNREAD:
+                    symbol_id = symbol_ids[position]
+                    ticker_24hr = self.tickers_24hr[symbol_id]
+                    value = (
+                        None if ticker_24hr is None else getattr(ticker_24hr, column)
+                    )
+                    values[symbol_id] = value
+                    taken_values[position] = value
+        return taken_values
+
+    def __len__(self):
+        return len(self.symbols)
+
+
+# Rebuilds the snapshot only when the exchange index or any ticker has changed since it was last built
+class MarketSnapshotCache:
+    def __init__(self, ticker_24hr_service):
+        self.ticker_24hr_service = ticker_24hr_service
+        # (symbol index, ticker version, snapshot), swapped with a single assignment
+        self._built = (None, None, None)
+
+    def get(self, symbol_index, budget=ANY_AGE):
+        self.ticker_24hr_service.refresh(symbol_index, budget)
+        # Read before building, so tickers changing mid-build only cause another rebuild next time
+        ticker_version = self.ticker_24hr_service.version
+        (built_symbol_index, built_ticker_version, snapshot) = self._built
+        if (
+            built_symbol_index is not symbol_index
+            or built_ticker_version != ticker_version
+        ):
+            with build_snapshot_stage.time():
+                snapshot = MarketSnapshot.from_exchange(
+                    symbol_index, self.ticker_24hr_service.cache
+                )
+            self._built = (symbol_index, ticker_version, snapshot)
+        return snapshot
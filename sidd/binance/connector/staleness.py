@@ -0,0 +1,27 @@
+from time import monotonic
+
+
+# Describes how old cached market data is allowed to be. Ages are measured relative to as_of (by default, when
+# the budget was created) so that every lookup made on behalf of one analysis agrees on what counts as fresh,
+# even if the analysis itself takes a while to run.
+class StalenessBudget:
+    def __init__(self, max_age_s=None, as_of=None):
+        self.max_age_s = max_age_s
+        self.as_of = monotonic() if as_of is None else as_of
+
+    @classmethod
+    def from_ms(cls, max_age_ms):
+        return cls(None if max_age_ms is None else max_age_ms / 1000)
+
+    def allows(self, fetched_at):
+        return self.max_age_s is None or self.as_of - fetched_at <= self.max_age_s
+
+    def __repr__(self):
+        return f"<max_age_s={self.max_age_s} as_of={self.as_of}>"
+
+
+ANY_AGE = StalenessBudget()
+
+
+def fetch_time():
+    return monotonic()
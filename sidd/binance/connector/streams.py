@@ -0,0 +1,42 @@
+import itertools
+import os
+import threading
+from urllib.parse import urlparse
+
+from autobahn.twisted.websocket import connectWS
+from binance.websocket.spot.websocket_client import SpotWebsocketClient
+from twisted.internet import ssl
+
+STREAM_URL = os.environ.get("BINANCE_STREAM_URL", "wss://stream.binance.com:9443")
+
+_stream_client = None
+_stream_client_lock = threading.Lock()
+_subscription_ids = itertools.count(1)
+
+
+# Twisted's reactor can only be run once per process, so every stream shares this client
+def get_stream_client():
+    global _stream_client
+    if _stream_client is None:
+        with _stream_client_lock:
+            if _stream_client is None:
+                stream_client = StreamClient(STREAM_URL)
+                stream_client.daemon = True
+                stream_client.start()
+                _stream_client = stream_client
+    return _stream_client
+
+
+def next_subscription_id():
+    return next(_subscription_ids)
+
+
+class StreamClient(SpotWebsocketClient):
+    # Plain ws:// is allowed on top of wss:// so that we can run against local stand-in stream servers
+    def add_connection(self, stream_name, url):
+        factory = self.factories[stream_name]
+        if url.startswith("ws://"):
+            self._conns[stream_name] = connectWS(factory)
+        else:
+            options = ssl.optionsForClientTLS(hostname=urlparse(url).hostname)
+            self._conns[stream_name] = connectWS(factory, options)
@@ -1,52 +1,228 @@
+import logging
+import os
+import threading
 from decimal import Decimal
 
-from sidd.binance.connector.clientadapter import SafeClient
+from prometheus_client import Counter
+
+from sidd.binance.connector.clientadapter import get_client
+from sidd.binance.connector.staleness import ANY_AGE, fetch_time
+from sidd.binance.profiling import stage_timer
+
+# Keep tickers current from Binance's all-market !ticker@arr and !bookTicker streams instead of polling REST
+STREAMING = os.environ.get("BINANCE_TICKER_STREAMING", "").lower() in [
+    "1",
+    "true",
+    "yes",
+]
+# !ticker@arr pushes every second. If it has been quiet for longer than this, we go back to REST.
+STREAM_STALE_S = 5
+
+ticker_stream_reads_metric = Counter(
+    "binance_ticker_stream_reads",
+    "Ticker reads answered from the ticker streams or over REST",
+    ["result"],
+)
+fetch_tickers_stage = stage_timer("fetch_tickers")
+parse_tickers_stage = stage_timer("parse_tickers")
 
 
 class Ticker24HrCache:
-    def __init__(self):
+    def __init__(self, streaming=STREAMING):
         self.cache = {}
+        self.streaming = streaming
+        # Bumped whenever any cached ticker changes
+        self.version = 0
+        self._bulk_fetched_at = None
+        self._streamed_at = None
+        self._subscribed = False
+        self._subscribe_lock = threading.Lock()
 
-    def get(self, symbol, cached=True, bulk_request=False):
-        if not (cached and symbol in self.cache):
+    def get(self, symbol, budget=ANY_AGE, bulk_request=False):
+        ticker_24hr = self.cache.get(symbol)
+        if self.streaming:
+            self._subscribe()
+            # A live stream only pushes tickers that changed, so everything else is also still current
+            if ticker_24hr is not None and self._stream_is_live():
+                ticker_stream_reads_metric.labels(result="stream").inc()
+                return ticker_24hr
+            ticker_stream_reads_metric.labels(result="rest").inc()
+        if ticker_24hr is None or not budget.allows(ticker_24hr.fetched_at):
             fetch_symbol = None if bulk_request else symbol
-            self.fetch(fetch_symbol)
-        return self.cache[symbol]
+            self.fetch(fetch_symbol, budget)
+            ticker_24hr = self.cache[symbol]
+        return ticker_24hr
+
+    # Makes sure the tickers of all the given symbols satisfy the budget, with at most one bulk request
+    def refresh(self, symbols, budget=ANY_AGE):
+        if self._needs_refresh(symbols, budget):
+            self.fetch(budget=budget)
+
+    async def refresh_async(self, symbols, budget=ANY_AGE, account=None):
+        if self._needs_refresh(symbols, budget):
+            # Only imported by servers running on asyncio
+            from sidd.binance.connector.asyncclient import get_async_client
+
+            with fetch_tickers_stage.time():
+                (fetched_at, raw_tickers_24hr) = await get_async_client().query_within(
+                    "/api/v3/ticker/24hr", None, budget, account
+                )
+            self._store(raw_tickers_24hr, fetched_at)
+
+    def _needs_refresh(self, symbols, budget):
+        if self.streaming:
+            self._subscribe()
+            if self._stream_is_live():
+                return False
+        if self._bulk_fetched_at is not None and budget.allows(self._bulk_fetched_at):
+            return False
+        cache = self.cache
+        for symbol in symbols:
+            ticker_24hr = cache.get(symbol)
+            if ticker_24hr is None or not budget.allows(ticker_24hr.fetched_at):
+                return True
+        return False
 
-    def fetch(self, symbol=None):
-        client = SafeClient()
-        raw_tickers_24hr = client.ticker_24hr(symbol)
+    # Like OrderBookCache.fetch, the fetched tickers satisfy the budget
+    def fetch(self, symbol=None, budget=None):
+        client = get_client()
+        with fetch_tickers_stage.time():
+            (fetched_at, raw_tickers_24hr) = client.query_within(
+                "/api/v3/ticker/24hr", {"symbol": symbol}, budget
+            )
+        self._store(raw_tickers_24hr, fetched_at, symbol)
+
+    def _store(self, raw_tickers_24hr, fetched_at, symbol=None):
         if symbol:
             raw_tickers_24hr = [raw_tickers_24hr]
-        self.cache.update(
-            {
+        with parse_tickers_stage.time():
+            tickers_24hr = {
                 raw_symbol_ticker_24hr["symbol"]: Ticker24Hr.from_raw_input(
-                    raw_symbol_ticker_24hr
+                    raw_symbol_ticker_24hr, fetched_at
                 )
                 for raw_symbol_ticker_24hr in raw_tickers_24hr
             }
+        self.cache.update(tickers_24hr)
+        self.version += 1
+        if not symbol:
+            self._bulk_fetched_at = fetched_at
+
+    def _subscribe(self):
+        if self._subscribed:
+            return
+        with self._subscribe_lock:
+            if self._subscribed:
+                return
+            # Twisted is only pulled in once streaming is actually used
+            from sidd.binance.connector.streams import (
+                get_stream_client,
+                next_subscription_id,
+            )
+
+            stream_client = get_stream_client()
+            stream_client.ticker(next_subscription_id(), self._on_ticker_event)
+            stream_client.book_ticker(
+                next_subscription_id(), self._on_book_ticker_event
+            )
+            self._subscribed = True
+
+    def _stream_is_live(self):
+        return (
+            self._streamed_at is not None
+            and fetch_time() - self._streamed_at < STREAM_STALE_S
         )
 
+    def _on_ticker_event(self, raw_tickers_24hr):
+        if not isinstance(raw_tickers_24hr, list):
+            if raw_tickers_24hr.get("e") == "error":
+                logging.error(f"Ticker stream failed: {raw_tickers_24hr}.")
+            return
+        fetched_at = fetch_time()
+        for raw_symbol_ticker_24hr in raw_tickers_24hr:
+            ticker_24hr = self.cache.get(raw_symbol_ticker_24hr["s"])
+            if ticker_24hr is None:
+                self.cache[
+                    raw_symbol_ticker_24hr["s"]
+                ] = Ticker24Hr.from_raw_stream_input(raw_symbol_ticker_24hr, fetched_at)
+            else:
+                ticker_24hr.update_from_raw_stream_input(
+                    raw_symbol_ticker_24hr, fetched_at
+                )
+        self.version += 1
+        self._streamed_at = fetched_at
+
+    def _on_book_ticker_event(self, raw_book_ticker):
+        if "u" not in raw_book_ticker:
+            if raw_book_ticker.get("e") == "error":
+                logging.error(f"Book ticker stream failed: {raw_book_ticker}.")
+            return
+        ticker_24hr = self.cache.get(raw_book_ticker["s"])
+        if ticker_24hr is not None:
+            ticker_24hr.update_book(
+                Decimal(raw_book_ticker["b"]),
+                Decimal(raw_book_ticker["a"]),
+                fetch_time(),
+            )
+            self.version += 1
+
     def __getitem__(self, symbol):
-        return self.get(symbol, cached=True, bulk_request=False)
+        return self.get(symbol, budget=ANY_AGE, bulk_request=False)
 
 
+# Attribute of a ticker decoded from its raw REST ticker the first time it's read, and then kept on the ticker. Setting
+# the attribute (as stream updates do) replaces it outright.
+class _Decoded:
+    def __init__(self, decode):
+        self.decode = decode
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, ticker_24hr, owner=None):
+        if ticker_24hr is None:
+            return self
+        # A stream update landing while this was decoding wins
+        return ticker_24hr.__dict__.setdefault(self.name, self.decode(ticker_24hr))
+
+
+# A bulk fetch returns the ticker of every symbol on the exchange, of which most queries read a handful, so values are
+# only decoded once they are read
 class Ticker24Hr:
-    def __init__(self, volume, trades, bid_price, ask_price):
-        self.volume = volume
-        self.trades = trades
-        self.bid_price = bid_price
-        self.ask_price = ask_price
-        self.spread = ask_price - bid_price
+    volume = _Decoded(lambda ticker_24hr: Decimal(ticker_24hr.raw["volume"]))
+    trades = _Decoded(lambda ticker_24hr: int(ticker_24hr.raw["count"]))
+    bid_price = _Decoded(lambda ticker_24hr: Decimal(ticker_24hr.raw["bidPrice"]))
+    ask_price = _Decoded(lambda ticker_24hr: Decimal(ticker_24hr.raw["askPrice"]))
+    spread = _Decoded(lambda ticker_24hr: ticker_24hr.ask_price - ticker_24hr.bid_price)
+
+    def __init__(self, raw_symbol_ticker_24hr, fetched_at=None):
+        self.raw = raw_symbol_ticker_24hr
+        self.fetched_at = fetch_time() if fetched_at is None else fetched_at
 
     @classmethod
-    def from_raw_input(cls, raw_symbol_ticker_24hr):
-        return Ticker24Hr(
-            Decimal(raw_symbol_ticker_24hr["volume"]),
-            int(raw_symbol_ticker_24hr["count"]),
-            Decimal(raw_symbol_ticker_24hr["bidPrice"]),
-            Decimal(raw_symbol_ticker_24hr["askPrice"]),
+    def from_raw_input(cls, raw_symbol_ticker_24hr, fetched_at=None):
+        return Ticker24Hr(raw_symbol_ticker_24hr, fetched_at)
+
+    # !ticker@arr events carry the same data as the REST ticker under abbreviated keys
+    @classmethod
+    def from_raw_stream_input(cls, raw_symbol_ticker_24hr, fetched_at=None):
+        ticker_24hr = Ticker24Hr(None, fetched_at)
+        ticker_24hr.update_from_raw_stream_input(raw_symbol_ticker_24hr, fetched_at)
+        return ticker_24hr
+
+    def update_from_raw_stream_input(self, raw_symbol_ticker_24hr, fetched_at):
+        self.volume = Decimal(raw_symbol_ticker_24hr["v"])
+        self.trades = int(raw_symbol_ticker_24hr["n"])
+        self.update_book(
+            Decimal(raw_symbol_ticker_24hr["b"]),
+            Decimal(raw_symbol_ticker_24hr["a"]),
+            fetched_at,
         )
 
+    def update_book(self, bid_price, ask_price, fetched_at):
+        self.bid_price = bid_price
+        self.ask_price = ask_price
+        self.spread = ask_price - bid_price
+        self.fetched_at = fetched_at
+
     def __repr__(self):
         return f"<vol={self.volume} trades={self.trades} bbo={self.bid_price}/{self.ask_price}>"
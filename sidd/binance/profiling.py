@@ -0,0 +1,67 @@
+import sys
+import threading
+from collections import Counter as StackCounter
+from time import monotonic, sleep
+
+from prometheus_client import Histogram
+
+# Longest profile that can be taken in one go
+MAX_PROFILE_S = 60
+# Most frames of a stack kept in a profile, innermost first
+MAX_PROFILE_DEPTH = 64
+
+stage_latency_metric = Histogram(
+    "analysis_stage_seconds",
+    "Time spent in each stage of answering a query, from fetching market data to encoding the response",
+    ["stage"],
+)
+
+_profile_lock = threading.Lock()
+
+
+# Histogram of one stage, e.g. "with stage_timer("parse_depth").time():". Children are looked up ahead of time by
+# the modules timing them, as labels() takes a lock on every call.
+def stage_timer(stage):
+    return stage_latency_metric.labels(stage=stage)
+
+
+# Samples the stack of every thread (but this one) every interval_s for duration_s, and returns how often each stack
+# was seen in collapsed stack format ("thread;outermost frame;...;innermost frame count" lines, most seen first), which
+# flame graph tools read. Only one profile is taken at a time.
+def sample_profile(duration_s, interval_s=0.01):
+    if not 0 < duration_s <= MAX_PROFILE_S:
+        raise ValueError(f"Profiles must take between 0 and {MAX_PROFILE_S} seconds.")
+    if not 0 < interval_s <= duration_s:
+        raise ValueError(
+            "The sampling interval must be positive and within the profile."
+        )
+    if not _profile_lock.acquire(blocking=False):
+        raise ValueError("A profile is already being taken, try again once it's done.")
+    try:
+        own_thread_id = threading.get_ident()
+        stacks = StackCounter()
+        deadline = monotonic() + duration_s
+        while monotonic() < deadline:
+            thread_names = {
+                thread.ident: thread.name for thread in threading.enumerate()
+            }
+            for (thread_id, frame) in sys._current_frames().items():
+                if thread_id != own_thread_id:
+                    stacks[
+                        (thread_names.get(thread_id, str(thread_id)),) + _stack(frame)
+                    ] += 1
+            sleep(interval_s)
+    finally:
+        _profile_lock.release()
+    return "".join(
+        f"{';'.join(stack)} {count}\n" for (stack, count) in stacks.most_common()
+    )
+
+
+def _stack(frame):
+    stack = []
+    while frame is not None and len(stack) < MAX_PROFILE_DEPTH:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return tuple(reversed(stack))
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from prometheus_client import Counter, Gauge
+
+# How long a response is served to identical requests after it was computed. 0 disables caching, but identical
+# requests arriving together still share one computation.
+RESPONSE_CACHE_TTL_S = int(os.environ.get("RESPONSE_CACHE_TTL_MS", 1000)) / 1000
+# Most responses kept. Least recently used responses are evicted first.
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 1024))
+
+response_cache_requests_metric = Counter(
+    "response_cache_requests",
+    "Requests answered from a cached response (hit), by waiting on an identical request already being computed "
+    "(coalesced) or by computing a response (miss)",
+    ["endpoint", "result"],
+)
+response_cache_entries_metric = Gauge(
+    "response_cache_entries", "Responses currently cached"
+)
+
+
+# Short lived responses keyed on normalized queries. A request for a response that is already being computed waits
+# for it rather than computing it again (single flight), whether it is served from a thread or a coroutine.
+class ResponseCache:
+    def __init__(
+        self, ttl_s=RESPONSE_CACHE_TTL_S, max_entries=RESPONSE_CACHE_MAX_ENTRIES
+    ):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        # key -> (computed at, seconds it's served for, response)
+        self._entries = OrderedDict()
+        # key -> _Flight of a thread computing it
+        self._flights = {}
+        # key -> future of a coroutine computing it. Only touched from the event loop's thread.
+        self._async_flights = {}
+        self._lock = threading.Lock()
+
+    # Responses are served for ttl_s, or for max_ttl_s if that's shorter, e.g. for responses built from market data
+    # that may only be so old
+    def get(self, endpoint, key, compute, max_ttl_s=None):
+        ttl_s = self._ttl_s(max_ttl_s)
+        with self._lock:
+            response = self._lookup(endpoint, key)
+            if response is not None:
+                return response
+            flight = self._flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = _Flight()
+                self._flights[key] = flight
+        if not is_leader:
+            response_cache_requests_metric.labels(
+                endpoint=endpoint, result="coalesced"
+            ).inc()
+            return flight.wait()
+        response_cache_requests_metric.labels(endpoint=endpoint, result="miss").inc()
+        try:
+            response = compute()
+            self._store(key, response, ttl_s)
+        except Exception as e:
+            flight.fail(e)
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+        flight.finish(response)
+        return response
+
+    # Same as get, with a coroutine function computing the response
+    async def get_async(self, endpoint, key, compute, max_ttl_s=None):
+        ttl_s = self._ttl_s(max_ttl_s)
+        with self._lock:
+            response = self._lookup(endpoint, key)
+        if response is not None:
+            return response
+        future = self._async_flights.get(key)
+        if future is not None:
+            response_cache_requests_metric.labels(
+                endpoint=endpoint, result="coalesced"
+            ).inc()
+            # Shielded so that one waiter going away doesn't cancel the others' response
+            return await asyncio.shield(future)
+        response_cache_requests_metric.labels(endpoint=endpoint, result="miss").inc()
+        future = asyncio.ensure_future(self._compute_async(key, compute, ttl_s))
+        self._async_flights[key] = future
+        future.add_done_callback(lambda _: self._async_flights.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _compute_async(self, key, compute, ttl_s):
+        response = await compute()
+        self._store(key, response, ttl_s)
+        return response
+
+    def _ttl_s(self, max_ttl_s):
+        return self.ttl_s if max_ttl_s is None else min(self.ttl_s, max_ttl_s)
+
+    # Must hold the lock
+    def _lookup(self, endpoint, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        (computed_at, ttl_s, response) = entry
+        if monotonic() - computed_at > ttl_s:
+            del self._entries[key]
+            response_cache_entries_metric.set(len(self._entries))
+            return None
+        self._entries.move_to_end(key)
+        response_cache_requests_metric.labels(endpoint=endpoint, result="hit").inc()
+        return response
+
+    def _store(self, key, response, ttl_s):
+        if ttl_s <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (monotonic(), ttl_s, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            response_cache_entries_metric.set(len(self._entries))
+
+
+# A response being computed by one thread, that other threads wait on
+class _Flight:
+    def __init__(self):
+        self.response = None
+        self.exception = None
+        self._done = threading.Event()
+
+    def finish(self, response):
+        self.response = response
+        self._done.set()
+
+    def fail(self, exception):
+        self.exception = exception
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.response
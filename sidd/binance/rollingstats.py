@@ -0,0 +1,78 @@
+import os
+from collections import deque
+from math import sqrt
+
+# Most recent samples each rolling window holds, per symbol and delta field
+WINDOW_SAMPLES = int(os.environ.get("DELTA_WINDOW_SAMPLES", 60))
+
+
+# Statistics over the last `size` samples of one field of one symbol. Adding a sample is O(1) (amortized, for
+# min/max). Mean and standard deviation are kept as running float sums, which are recomputed from the samples once
+# per window length so that rounding errors can't build up. Min, max and percent change use the samples themselves.
+class RollingWindow:
+    def __init__(self, size=WINDOW_SAMPLES, ewma_alpha=None):
+        if size < 1:
+            raise ValueError(
+                f"Rolling windows must hold at least 1 sample, but were given {size}."
+            )
+        self.size = size
+        self.ewma_alpha = 2 / (size + 1) if ewma_alpha is None else ewma_alpha
+        self.ewma = None
+        self.samples = deque()
+        self._sum = 0.0
+        self._sum_of_squares = 0.0
+        self._added = 0
+        # (sample number, value) pairs with increasing values for the minima, decreasing for the maxima. The
+        # front of each is the min/max of the window.
+        self._minima = deque()
+        self._maxima = deque()
+
+    def add(self, value):
+        if len(self.samples) == self.size:
+            evicted_value = float(self.samples.popleft())
+            self._sum -= evicted_value
+            self._sum_of_squares -= evicted_value * evicted_value
+            evicted_number = self._added - self.size
+            if self._minima[0][0] == evicted_number:
+                self._minima.popleft()
+            if self._maxima[0][0] == evicted_number:
+                self._maxima.popleft()
+        self.samples.append(value)
+        float_value = float(value)
+        self._sum += float_value
+        self._sum_of_squares += float_value * float_value
+        while self._minima and self._minima[-1][1] >= value:
+            self._minima.pop()
+        self._minima.append((self._added, value))
+        while self._maxima and self._maxima[-1][1] <= value:
+            self._maxima.pop()
+        self._maxima.append((self._added, value))
+        self._added += 1
+        if self._added % self.size == 0:
+            self._sum = sum(float(sample) for sample in self.samples)
+            self._sum_of_squares = sum(
+                float(sample) * float(sample) for sample in self.samples
+            )
+        self.ewma = (
+            float_value
+            if self.ewma is None
+            else self.ewma_alpha * float_value + (1 - self.ewma_alpha) * self.ewma
+        )
+
+    def stats(self):
+        num_samples = len(self.samples)
+        if num_samples == 0:
+            return None
+        mean = self._sum / num_samples
+        oldest_value = self.samples[0]
+        return {
+            "samples": num_samples,
+            "ewma": self.ewma,
+            "mean": mean,
+            "std": sqrt(max(0.0, self._sum_of_squares / num_samples - mean * mean)),
+            "min": self._minima[0][1],
+            "max": self._maxima[0][1],
+            "pct_change": None
+            if oldest_value == 0
+            else float((self.samples[-1] - oldest_value) / oldest_value * 100),
+        }
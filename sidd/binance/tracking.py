@@ -0,0 +1,309 @@
+import logging
+import queue
+import threading
+from time import perf_counter
+from typing import Iterable, Optional
+
+from prometheus_client import Counter, Gauge
+
+from sidd.binance.analytics import (
+    DeltaTracker,
+    MonotonicSchedule,
+    check_query_weight,
+    delta_compute_time_metric,
+    delta_tick_lag_metric,
+    delta_tracker_fields,
+    get_query_plan,
+    symbol_analysis,
+)
+from sidd.binance.connector.exchange import get_exchange
+from sidd.binance.connector.ratelimit import BACKGROUND, request_priority
+from sidd.binance.connector.staleness import StalenessBudget, fetch_time
+from sidd.binance.rollingstats import WINDOW_SAMPLES
+
+# Ticks a subscriber may fall behind by before its oldest undelivered tick is dropped
+SUBSCRIPTION_MAX_PENDING_TICKS = 100
+
+tracker_tick_failures_metric = Counter(
+    "delta_tracker_tick_failures",
+    "Delta tracker ticks that failed to run their analysis",
+)
+trackers_metric = Gauge("delta_trackers", "Delta trackers registered with the engine")
+subscriptions_metric = Gauge(
+    "delta_tracker_subscriptions", "Subscriptions to delta trackers"
+)
+dropped_ticks_metric = Counter(
+    "delta_tracker_dropped_ticks",
+    "Ticks dropped because a subscriber fell too far behind",
+)
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_tracking_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = TrackingEngine()
+    return _engine
+
+
+# Runs every delta tracker in the process. Trackers with the same definition are only run once, however many
+# subscribers they have, and trackers sharing an interval tick together against one staleness budget, so market data
+# fetched for the first of them (e.g. the bulk ticker request) is reused by the rest instead of being fetched again.
+# Each interval's ticks come from a schedule made by schedule_factory, given the interval in seconds.
+class TrackingEngine:
+    def __init__(self, schedule_factory=MonotonicSchedule):
+        self.schedule_factory = schedule_factory
+        self._trackers = {}
+        self._tick_loops = {}
+        self._lock = threading.Lock()
+
+    def subscribe(
+        self,
+        quote_assets: Optional[Iterable[str]] = None,
+        base_assets: Optional[Iterable[str]] = None,
+        order_by: Optional[str] = None,
+        limit: int = 5,
+        fields: Optional[Iterable[str]] = None,
+        delta_fields: Optional[Iterable[str]] = None,
+        interval_ms: int = 60000,
+        max_age_ms: int = 0,
+        where: Optional[Iterable[str]] = None,
+        window: int = WINDOW_SAMPLES,
+        max_weight: Optional[int] = None,
+    ):
+        delta_fields = list(delta_fields)
+        fields = delta_tracker_fields(list(fields or []), delta_fields)
+        # Checked up front, as every tick spends this much
+        if max_weight is not None:
+            symbols = get_exchange().symbols(
+                quote_assets=quote_assets, base_assets=base_assets
+            )
+            plan = get_query_plan(tuple(fields), order_by, tuple(where or []))
+            check_query_weight(plan, len(symbols), limit, max_weight)
+        definition = _TrackerDefinition(
+            _as_tuple(quote_assets),
+            _as_tuple(base_assets),
+            order_by,
+            limit,
+            tuple(fields),
+            tuple(delta_fields),
+            interval_ms,
+            max_age_ms,
+            _as_tuple(where),
+            window,
+        )
+        with self._lock:
+            tracker = self._trackers.get(definition)
+            if tracker is None:
+                tracker = _Tracker(definition)
+                self._trackers[definition] = tracker
+                trackers_metric.set(len(self._trackers))
+                tick_loop = self._tick_loops.get(interval_ms)
+                if tick_loop is None:
+                    tick_loop = _TickLoop(
+                        self, interval_ms, self.schedule_factory(interval_ms / 1000)
+                    )
+                    self._tick_loops[interval_ms] = tick_loop
+                    tick_loop.start()
+            subscription = Subscription(self, tracker)
+            tracker.subscriptions.append(subscription)
+            subscriptions_metric.inc()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            tracker = subscription.tracker
+            if subscription not in tracker.subscriptions:
+                return
+            tracker.subscriptions.remove(subscription)
+            subscriptions_metric.dec()
+            # Nobody is left to see this tracker's deltas, so it stops polling
+            if not tracker.subscriptions:
+                del self._trackers[tracker.definition]
+                trackers_metric.set(len(self._trackers))
+
+    # Trackers ticking every interval_ms, or None once there are none left (which also ends their tick loop)
+    def _trackers_for_tick(self, interval_ms):
+        with self._lock:
+            trackers = [
+                tracker
+                for tracker in self._trackers.values()
+                if tracker.definition.interval_ms == interval_ms
+            ]
+            if not trackers:
+                del self._tick_loops[interval_ms]
+                return None
+            return trackers
+
+
+class _TrackerDefinition:
+    def __init__(
+        self,
+        quote_assets,
+        base_assets,
+        order_by,
+        limit,
+        fields,
+        delta_fields,
+        interval_ms,
+        max_age_ms,
+        where,
+        window,
+    ):
+        self.quote_assets = quote_assets
+        self.base_assets = base_assets
+        self.order_by = order_by
+        self.limit = limit
+        self.fields = fields
+        self.delta_fields = delta_fields
+        self.interval_ms = interval_ms
+        self.max_age_ms = max_age_ms
+        self.where = where
+        self.window = window
+
+    def _key(self):
+        return (
+            self.quote_assets,
+            self.base_assets,
+            self.order_by,
+            self.limit,
+            self.fields,
+            self.delta_fields,
+            self.interval_ms,
+            self.max_age_ms,
+            self.where,
+            self.window,
+        )
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __eq__(self, other_definition):
+        return self._key() == other_definition._key()
+
+
+class _Tracker:
+    def __init__(self, definition):
+        self.definition = definition
+        self.delta_tracker = DeltaTracker(
+            list(definition.delta_fields), window=definition.window
+        )
+        self.subscriptions = []
+
+    def tick(self, tick_started_at):
+        definition = self.definition
+        budget = StalenessBudget(
+            None if definition.max_age_ms is None else definition.max_age_ms / 1000,
+            as_of=tick_started_at,
+        )
+        current_symbol_analysis = symbol_analysis(
+            _as_list(definition.quote_assets),
+            _as_list(definition.base_assets),
+            definition.order_by,
+            definition.limit,
+            list(definition.fields),
+            where=_as_list(definition.where),
+            budget=budget,
+        )
+        return self.delta_tracker.update(current_symbol_analysis)
+
+
+class _TickLoop(threading.Thread):
+    def __init__(self, engine, interval_ms, schedule):
+        super().__init__(daemon=True)
+        self.engine = engine
+        self.interval_ms = interval_ms
+        self.schedule = schedule
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.schedule.time_until_next_tick()):
+            trackers = self.engine._trackers_for_tick(self.interval_ms)
+            if trackers is None:
+                return
+            delta_tick_lag_metric.observe(self.schedule.lag())
+            tick_started_at = fetch_time()
+            for tracker in trackers:
+                start = perf_counter()
+                try:
+                    # Polling always yields to interactive queries for API weight
+                    with request_priority(BACKGROUND):
+                        symbol_data_with_deltas = tracker.tick(tick_started_at)
+                except Exception:
+                    tracker_tick_failures_metric.inc()
+                    logging.exception("Delta tracker tick failed.")
+                    continue
+                delta_compute_time_metric.observe(perf_counter() - start)
+                for subscription in list(tracker.subscriptions):
+                    subscription.publish(symbol_data_with_deltas)
+
+    def stop(self):
+        self._stopped.set()
+
+
+# Iterating a subscription yields the rows of every tick of its tracker, as DeltaTracker.start does, until it is
+# closed. Subscribers that fall behind lose their oldest ticks rather than holding up the tracker.
+class Subscription:
+    def __init__(
+        self, engine, tracker, max_pending_ticks=SUBSCRIPTION_MAX_PENDING_TICKS
+    ):
+        self.engine = engine
+        self.tracker = tracker
+        self._ticks = queue.Queue(maxsize=max_pending_ticks)
+        self.closed = False
+        # Called (on the tick loop's thread) after each tick is queued, for subscribers that can't block on
+        # next_tick, like coroutines
+        self.on_publish = None
+
+    def publish(self, symbol_data_with_deltas):
+        while True:
+            try:
+                self._ticks.put_nowait(symbol_data_with_deltas)
+                break
+            except queue.Full:
+                try:
+                    self._ticks.get_nowait()
+                    dropped_ticks_metric.inc()
+                except queue.Empty:
+                    pass
+        on_publish = self.on_publish
+        if on_publish is not None:
+            on_publish()
+
+    # Waits up to timeout_s for the rows of the next tick, returning None if there weren't any in time (or the
+    # subscription was closed)
+    def next_tick(self, timeout_s=None):
+        try:
+            return self._ticks.get(timeout=timeout_s)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.engine.unsubscribe(self)
+        # Wakes up anyone waiting on the next tick
+        self.publish(None)
+
+    def __iter__(self):
+        try:
+            while True:
+                symbol_data_with_deltas = self._ticks.get()
+                if symbol_data_with_deltas is None:
+                    return
+                yield from symbol_data_with_deltas
+        finally:
+            self.close()
+
+
+def _as_tuple(values):
+    return None if values is None else tuple(values)
+
+
+def _as_list(values):
+    return None if values is None else list(values)